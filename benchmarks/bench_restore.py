@@ -0,0 +1,194 @@
+"""Benchmark restoring daily hadith subscriptions at startup.
+
+Compares the original restore path (fetch every row as a dict, parse the
+local time, look up its timezone and register one run_daily job per user
+in a JobQueue) with the indexed path that loads precomputed UTC delivery
+minutes straight into the broadcast buckets.
+
+By default rows are synthetic and generated in memory. With --database
+both paths read real rows: synthetic subscribers are written to
+DATABASE_URL, the legacy path fetches them with one dict cursor and the
+indexed path streams them through iter_daily_hadith_subscriptions'
+server-side cursor. Every enabled subscriber in the database is read, so
+point it at a scratch database; the synthetic rows are deleted afterwards.
+
+    python benchmarks/bench_restore.py
+    python benchmarks/bench_restore.py --sizes 1000 100000 --memory
+    python benchmarks/bench_restore.py --database --sizes 10000 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import time as daytime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.ext import Application
+
+from broadcast import BroadcastScheduler
+from timezones import get_zone, utc_minute_of_day
+
+TIMEZONES = ['Europe/Rome', 'Europe/London', 'Asia/Karachi', 'Asia/Jakarta', 'America/New_York', 'Africa/Cairo']
+
+
+def synthetic_users(count, seed, first_user_id=0):
+    rng = random.Random(seed)
+    for n in range(count):
+        user_id = first_user_id + n
+        yield user_id, rng.randrange(24 * 60), rng.choice(TIMEZONES)
+
+
+def legacy_rows(count, seed):
+    for user_id, minutes, zone in synthetic_users(count, seed):
+        yield {'user_id': user_id, 'chat_id': user_id, 'daily_hadith_time': timedelta(minutes=minutes), 'timezone': zone}
+
+
+def indexed_rows(count, seed):
+    for user_id, minutes, zone in synthetic_users(count, seed):
+        # The stored UTC minute is precomputed, so any minute-of-day stands in for it.
+        yield (user_id, user_id, minutes, zone)
+
+
+async def send_daily_hadith(context):
+    pass
+
+
+def restore_legacy(rows):
+    # What post_init did before the broadcast buckets: one daily job per user.
+    application = Application.builder().token('123456:benchmark').build()
+    for user in rows:
+        time_obj = user['daily_hadith_time']
+        if hasattr(time_obj, 'total_seconds'):
+            total_seconds = int(time_obj.total_seconds())
+            hour, minute = total_seconds // 3600, (total_seconds % 3600) // 60
+        else:
+            hour, minute = time_obj.hour, time_obj.minute
+        application.job_queue.run_daily(
+            send_daily_hadith,
+            time=daytime(hour=hour, minute=minute, tzinfo=get_zone(user['timezone'])),
+            chat_id=user['chat_id'],
+            name=f"daily_hadith_{user['user_id']}",
+            user_id=user['user_id']
+        )
+    return len(application.job_queue.scheduler.get_jobs())
+
+
+def restore_indexed(rows):
+    async def pick_hadith():
+        return None
+
+    scheduler = BroadcastScheduler(pick_hadith, render=None)
+    return scheduler.restore(rows)
+
+
+def measure(restore, rows, memory):
+    if memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    scheduled = restore(rows())
+    elapsed = time.perf_counter() - started
+    peak = None
+    if memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, peak, scheduled
+
+
+def seed_database(count, seed, first_user_id):
+    from psycopg2.extras import execute_values
+
+    from database import db_connection
+
+    with db_connection() as conn:
+        cur = conn.cursor()
+        rows = (
+            (user_id, user_id, zone, True, daytime(minutes // 60, minutes % 60),
+             utc_minute_of_day(minutes // 60, minutes % 60, get_zone(zone)))
+            for user_id, minutes, zone in synthetic_users(count, seed, first_user_id)
+        )
+        execute_values(cur, """
+            INSERT INTO users (user_id, chat_id, timezone, daily_hadith_enabled, daily_hadith_time, delivery_minute_utc)
+            VALUES %s
+            ON CONFLICT (user_id) DO NOTHING
+        """, rows, page_size=10000)
+        conn.commit()
+        cur.close()
+
+
+def delete_seeded(count, first_user_id):
+    from database import db_connection
+
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM users WHERE user_id >= %s AND user_id < %s", (first_user_id, first_user_id + count))
+        conn.commit()
+        cur.close()
+
+
+def database_legacy_rows():
+    from psycopg2.extras import RealDictCursor
+
+    from database import db_connection
+
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            SELECT user_id, chat_id, daily_hadith_time, timezone
+            FROM users
+            WHERE daily_hadith_enabled = TRUE
+        """)
+        users = [dict(user) for user in cur.fetchall()]
+        cur.close()
+    return iter(users)
+
+
+def database_indexed_rows():
+    from database import iter_daily_hadith_subscriptions
+
+    return iter_daily_hadith_subscriptions()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 100_000, 1_000_000])
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--memory', action='store_true', help='also report peak traced memory (slower)')
+    parser.add_argument('--skip-legacy', action='store_true', help='only run the indexed restore')
+    parser.add_argument('--legacy-max', type=int, default=100_000,
+                        help='skip the legacy path above this many users (one job each is slow)')
+    parser.add_argument('--database', action='store_true', help='read the rows from DATABASE_URL')
+    parser.add_argument('--first-user-id', type=int, default=9_000_000_000)
+    args = parser.parse_args()
+
+    if args.database:
+        from database import init_database
+        init_database()
+
+    print(f"{'users':>10} {'path':>8} {'seconds':>9} {'users/s':>12} {'scheduled':>10} {'peak MiB':>9}")
+    for size in args.sizes:
+        if args.database:
+            seed_database(size, args.seed, args.first_user_id)
+            paths = [('indexed', restore_indexed, database_indexed_rows), ('legacy', restore_legacy, database_legacy_rows)]
+        else:
+            paths = [
+                ('indexed', restore_indexed, lambda: indexed_rows(size, args.seed)),
+                ('legacy', restore_legacy, lambda: legacy_rows(size, args.seed)),
+            ]
+        if args.skip_legacy or size > args.legacy_max:
+            paths = paths[:1]
+
+        try:
+            for name, restore, rows in paths:
+                elapsed, peak, scheduled = measure(restore, rows, args.memory)
+                peak_mib = f"{peak / 2**20:9.1f}" if peak is not None else f"{'-':>9}"
+                print(f"{size:>10} {name:>8} {elapsed:9.3f} {size / elapsed:12.0f} {scheduled:>10} {peak_mib}")
+        finally:
+            if args.database:
+                delete_seeded(size, args.first_user_id)
+
+
+if __name__ == '__main__':
+    main()
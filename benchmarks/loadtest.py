@@ -0,0 +1,361 @@
+"""Load-test the bot against local stand-ins for Telegram and the hadith API.
+
+Starts a fake hadithapi.com (the /hadiths page shape fetch_random_hadith
+parses) and a fake Telegram Bot API that answers sendMessage,
+editMessageText and friends. The real application, with every handler,
+is pointed at both. Synthetic users then walk through /start, "Get Random
+Hadith", "Daily Hadith Settings", "Set Time" and a time reply, and
+finally a single daily broadcast bucket is sent to a large synthetic
+audience.
+
+Needs a PostgreSQL database in DATABASE_URL; use a scratch database.
+Synthetic users get ids from --first-user-id upwards and are deleted
+afterwards unless --keep-users is given. Runs are seeded and the fakes
+answer deterministically with fixed latencies, so reports are comparable
+between commits.
+
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --users 500 --broadcast 20000 --json report.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import time
+from datetime import datetime, timezone
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TOKEN = '123456:LOADTEST'
+BOOKS = ["sahih-bukhari", "sahih-muslim", "al-tirmidhi", "abu-dawood", "ibn-e-majah", "sunan-nasai"]
+BOOK_SIZE = 5000
+WORDS = "the prophet said whoever believes in allah and the last day should speak good or keep silent".split()
+
+STEPS = ['start', 'get_hadith', 'daily_settings', 'set_time', 'time_input']
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def fake_hadith(book, number):
+    rng = random.Random(f"{book}:{number}")
+    return {
+        'id': BOOKS.index(book) * BOOK_SIZE + number,
+        'hadithNumber': str(number),
+        'hadithEnglish': " ".join(rng.choice(WORDS) for _ in range(rng.randrange(40, 400))),
+        'hadithArabic': "قال رسول الله " * rng.randrange(5, 40),
+        'status': 'Sahih',
+        'bookSlug': book,
+        'book': {'bookName': book.replace('-', ' ').title(), 'bookSlug': book},
+        'chapter': {'chapterNumber': str(number // 50 + 1), 'chapterEnglish': f"Chapter {number // 50 + 1}"},
+    }
+
+
+class FakeHadithApi:
+    """Serves deterministic /hadiths pages"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+
+    async def hadiths(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        book = request.query.get('book')
+        if book not in BOOKS:
+            return 404, 'application/json', b'{"status": 404}'
+        paginate = int(request.query.get('paginate', 50))
+        page = int(request.query.get('page', 1))
+        last_page = (BOOK_SIZE + paginate - 1) // paginate
+        first = (page - 1) * paginate + 1
+        data = [fake_hadith(book, n) for n in range(first, min(first + paginate, BOOK_SIZE + 1))]
+        body = {'status': 200, 'hadiths': {
+            'current_page': page, 'last_page': last_page, 'per_page': paginate, 'total': BOOK_SIZE, 'data': data,
+        }}
+        return 200, 'application/json', json.dumps(body).encode('utf-8')
+
+
+class FakeTelegram:
+    """Answers the Bot API methods the bot calls and counts them"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = {}
+        self._message_id = 0
+
+    def _message(self, params):
+        self._message_id += 1
+        chat_id = int(params.get('chat_id') or 0)
+        return {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text', ''),
+        }
+
+    def route(self, method):
+        async def handle(request):
+            self.calls[method] = self.calls.get(method, 0) + 1
+            await asyncio.sleep(self.latency)
+            if request.headers.get('content-type', '').startswith('application/json'):
+                params = json.loads(request.body or b'{}')
+            else:
+                params = {name: values[-1] for name, values in parse_qs(request.body.decode('utf-8')).items()}
+
+            if method == 'getMe':
+                result = {'id': 123456, 'is_bot': True, 'first_name': 'Load', 'username': 'loadtest_bot'}
+            elif method in ('sendMessage', 'editMessageText'):
+                result = self._message(params)
+            else:
+                result = True
+            return 200, 'application/json', json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        return handle
+
+
+def make_user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"}
+
+
+def message_update(update_id, user_id, text):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': make_user(user_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': make_user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': 'menu',
+            },
+        },
+    }
+
+
+async def run(args):
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    import bot
+    from database import db_connection, init_database, pool_stats, run_db
+    from health import HealthServer
+
+    hadith_api = FakeHadithApi(args.api_latency)
+    api_server = HealthServer(args.api_port, host='127.0.0.1')
+    api_server.add_route('GET', '/api/hadiths', hadith_api.hadiths)
+
+    telegram = FakeTelegram(args.telegram_latency)
+    telegram_server = HealthServer(args.telegram_port, host='127.0.0.1')
+    for method in ('getMe', 'sendMessage', 'editMessageText', 'answerCallbackQuery', 'deleteWebhook'):
+        telegram_server.add_route('POST', f'/bot{TOKEN}/{method}', telegram.route(method))
+
+    await api_server.start()
+    await telegram_server.start()
+
+    init_database()
+    app = bot.build_application(TOKEN, base_url=f'http://127.0.0.1:{args.telegram_port}/bot')
+
+    pending = {}
+    latencies = {step: [] for step in STEPS}
+
+    async def completed(update, context):
+        entry = pending.pop(update.update_id, None)
+        if entry is not None:
+            step, enqueued, done = entry
+            latencies[step].append(time.perf_counter() - enqueued)
+            done.set()
+
+    app.add_handler(TypeHandler(Update, completed), group=100)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    update_ids = iter(range(1, 10 ** 9))
+    first_user = args.first_user_id
+    users = list(range(first_user, first_user + args.users))
+
+    async def send(step, payload):
+        done = asyncio.Event()
+        update = Update.de_json(payload, app.bot)
+        pending[update.update_id] = (step, time.perf_counter(), done)
+        await app.update_queue.put(update)
+        await done.wait()
+
+    async def walk(user_id):
+        rng = random.Random(args.seed * 1_000_003 + user_id)
+        await send('start', message_update(next(update_ids), user_id, '/start'))
+        await send('get_hadith', callback_update(next(update_ids), user_id, 'get_hadith'))
+        await send('daily_settings', callback_update(next(update_ids), user_id, 'daily_settings'))
+        await send('set_time', callback_update(next(update_ids), user_id, 'set_time'))
+        await send('time_input', message_update(next(update_ids), user_id, f"{rng.randrange(24):02d}:{rng.randrange(60):02d}"))
+
+    tracemalloc_peak = None
+    if args.memory:
+        import tracemalloc
+        tracemalloc.start()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(walk(user_id) for user_id in users))
+    interactive_seconds = time.perf_counter() - started
+
+    # The broadcast audience must exist in users for the history rows.
+    recipients = {first_user + i: first_user + i for i in range(args.broadcast)}
+    for user_id in recipients:
+        bot.user_writes.save(user_id, user_id, first_name=f"User{user_id}")
+    await run_db(bot.user_writes.flush)
+
+    scheduled_at = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    report = await bot.daily_scheduler.run_bucket(app.bot, 0, recipients, scheduled_at) or {}
+    await run_db(bot.hadith_history.flush)
+    await run_db(bot.delivery_ledger.flush)
+
+    if args.memory:
+        tracemalloc_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    stats = pool_stats()
+    if not args.keep_users:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            last_user = first_user + max(args.users, args.broadcast)
+            cur.execute("DELETE FROM hadith_history WHERE user_id >= %s AND user_id < %s", (first_user, last_user))
+            cur.execute("DELETE FROM daily_deliveries WHERE user_id >= %s AND user_id < %s", (first_user, last_user))
+            cur.execute("DELETE FROM users WHERE user_id >= %s AND user_id < %s", (first_user, last_user))
+            conn.commit()
+            cur.close()
+
+    await app.stop()
+    await app.shutdown()
+    await app.post_shutdown(app)
+    await api_server.stop()
+    await telegram_server.stop()
+
+    total_updates = sum(len(values) for values in latencies.values())
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'interactive': {
+            'users': args.users,
+            'updates': total_updates,
+            'seconds': interactive_seconds,
+            'updates_per_second': total_updates / interactive_seconds if interactive_seconds else 0.0,
+            'p50_ms': percentile(all_latencies, 0.50) * 1000,
+            'p99_ms': percentile(all_latencies, 0.99) * 1000,
+            'steps': {
+                step: {
+                    'p50_ms': percentile(values, 0.50) * 1000,
+                    'p99_ms': percentile(values, 0.99) * 1000,
+                }
+                for step, values in latencies.items()
+            },
+        },
+        'broadcast': {
+            'recipients': args.broadcast,
+            'sent': report.get('sent', 0),
+            'failed': report.get('failed', 0),
+            'seconds': report.get('duration', 0.0),
+            'messages_per_second': report.get('throughput', 0.0),
+            'end_lag_seconds': report.get('end_lag', 0.0),
+        },
+        'db_connections_opened': stats.get('connections_opened', 0),
+        'db_pool_wait_seconds': stats.get('wait_seconds_total', 0.0),
+        'hadith_api_requests': hadith_api.requests,
+        'telegram_calls': telegram.calls,
+        'max_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'traced_peak_mib': tracemalloc_peak / 2 ** 20 if tracemalloc_peak is not None else None,
+    }
+
+
+def print_report(report):
+    interactive = report['interactive']
+    broadcast = report['broadcast']
+    print(f"interactive: {interactive['updates']} updates from {interactive['users']} users "
+          f"in {interactive['seconds']:.2f}s ({interactive['updates_per_second']:.1f} updates/s), "
+          f"p50 {interactive['p50_ms']:.1f} ms, p99 {interactive['p99_ms']:.1f} ms")
+    for step, values in interactive['steps'].items():
+        print(f"  {step:<15} p50 {values['p50_ms']:8.1f} ms   p99 {values['p99_ms']:8.1f} ms")
+    print(f"broadcast:   {broadcast['sent']}/{broadcast['recipients']} sent in {broadcast['seconds']:.2f}s "
+          f"({broadcast['messages_per_second']:.1f} msg/s), {broadcast['failed']} failed, "
+          f"last delivery {broadcast['end_lag_seconds']:.1f}s after the scheduled minute")
+    print(f"db:          {report['db_connections_opened']} connections opened, "
+          f"{report['db_pool_wait_seconds']:.2f}s waiting for the pool")
+    print(f"upstream:    {report['hadith_api_requests']} hadith API requests, Telegram calls {report['telegram_calls']}")
+    memory = f"max RSS {report['max_rss_mib']:.1f} MiB"
+    if report['traced_peak_mib'] is not None:
+        memory += f", traced peak {report['traced_peak_mib']:.1f} MiB"
+    print(f"memory:      {memory}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200, help='synthetic users walking the interactive flow')
+    parser.add_argument('--broadcast', type=int, default=5000, help='recipients of the daily broadcast bucket')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--first-user-id', type=int, default=9_000_000_000)
+    parser.add_argument('--api-latency', type=float, default=0.05, help='fake hadith API latency in seconds')
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help='fake Telegram latency in seconds')
+    parser.add_argument('--global-rate', type=float, default=1000, help='OUTBOX_GLOBAL_RATE for the run')
+    parser.add_argument('--chat-rate', type=float, default=1, help='OUTBOX_PRIVATE_CHAT_RATE for the run')
+    parser.add_argument('--api-port', type=int, default=18081)
+    parser.add_argument('--telegram-port', type=int, default=18082)
+    parser.add_argument('--memory', action='store_true', help='also trace Python allocations (slower)')
+    parser.add_argument('--keep-users', action='store_true', help='leave the synthetic users in the database')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    if not os.getenv('DATABASE_URL'):
+        parser.error("DATABASE_URL must point at a scratch PostgreSQL database")
+
+    # The bot reads its configuration at import time.
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': TOKEN,
+        'HADITH_API_BASE': f'http://127.0.0.1:{args.api_port}/api',
+        'HADITH_API_KEY': 'loadtest',
+        'OUTBOX_GLOBAL_RATE': str(args.global_rate),
+        'OUTBOX_PRIVATE_CHAT_RATE': str(args.chat_rate),
+        'PORT': '0',
+        'STARTUP_MODE': 'lazy',
+        'BOT_MODE': 'standalone',
+        # Keep conversation state of the synthetic users out of bot_persistence.
+        'PERSISTENCE': 'off',
+        'HADITH_CORPUS_FILE': '',
+        'HADITH_CORPUS_DUMP': '',
+    })
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.WARNING)
+
+    report = asyncio.run(run(args))
+    logging.getLogger().setLevel(logging.WARNING)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,67 @@
 from database import (
     init_database, 
-    save_user, 
     get_user, 
     update_daily_hadith_settings,
-    get_all_daily_hadith_users,
+    update_user_timezone,
+    get_subscriber_timezones,
+    rebucket_daily_hadith_subscriptions,
+    iter_daily_hadith_subscriptions,
+    run_db,
+    close_pool,
+    ping_database,
+    pool_stats,
+    user_cache_stats,
+    user_writes,
+    USER_WRITE_FLUSH_INTERVAL,
+)
+from corpus import corpus, load_corpus_dump
+from corpus_file import corpus_file, open_corpus_file
+from hadith_api import breakers, fetch_random_hadith, close_http_client, sampler
+from broadcast import BroadcastScheduler
+from timezones import (
+    DEFAULT_TIMEZONE,
+    TIMEZONE_CHECK_INTERVAL,
+    OffsetWatcher,
+    get_zone,
+    offset_minutes,
+    parse_timezone,
+    utc_minute_of_day,
+    zone_at,
+)
+from prefetch import HadithPrefetchPool
+from outbox import BROADCAST, INTERACTIVE, OutboxRateLimiter
+from metrics import instrument, registry
+from health import HealthServer
+from updates import ALLOWED_UPDATES, UPDATE_MODE, OrderedUpdateProcessor, run_webhook, run_without_updates
+from sharding import BOT_MODE, SHARDED, ShardCoordinator
+from history import HistoryRecorder, HISTORY_FLUSH_INTERVAL
+from ledger import DeliveryLedger, LEDGER_FLUSH_INTERVAL
+from search import build_search_index, search_index
+from persistence import PERSISTENCE, PostgresPersistence
+from messages import (
+    BACK_TO_MENU_KEYBOARD,
+    HOME_KEYBOARD,
+    LOCATION_KEYBOARD,
+    TIME_SET_KEYBOARD,
+    TIMEZONE_PROMPT,
+    SEARCH_PAGE_SIZE,
+    get_daily_settings_keyboard,
+    format_daily_time,
+    get_main_menu_keyboard,
+    render_hadith,
+    render_search_page,
+    render_stats,
+    search_result_keyboard,
 )
 from dotenv import load_dotenv
+import asyncio
 import os
-import requests
-import random
 import logging
-from datetime import time
-import pytz
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from functools import partial
+from warnings import filterwarnings
+from telegram import ReplyKeyboardRemove, Update
+from telegram.helpers import escape_markdown
+from telegram.warnings import PTBUserWarning
 from telegram.ext import (
     Application, 
     CommandHandler, 
@@ -20,10 +69,9 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     filters
 )
-from threading import Thread
-from http.server import HTTPServer, BaseHTTPRequestHandler
 
 load_dotenv()
 
@@ -33,139 +81,80 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Conversations are tracked per user, which is what the settings flow wants;
+# PTB warns about CallbackQueryHandler entry points regardless.
+filterwarnings(action='ignore', message=r".*CallbackQueryHandler", category=PTBUserWarning)
+
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-HADITH_API_KEY = os.getenv('HADITH_API_KEY')
-HADITH_API_BASE = "https://hadithapi.com/api"
 PORT = int(os.getenv('PORT', 8000))
+RESTORE_RETRY_INTERVAL = float(os.getenv('RESTORE_RETRY_INTERVAL', 30))
 
 WAITING_FOR_TIME = 1
+WAITING_FOR_TIMEZONE = 2
 
-BOOKS = [
-    "sahih-bukhari",
-    "sahih-muslim",
-    "al-tirmidhi",
-    "abu-dawood",
-    "ibn-e-majah",
-    "sunan-nasai"
-]
-
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'Bot is running')
-
-    def do_HEAD(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-
-    def log_message(self, format, *args):
-        pass
-
-def run_health_server():
-    server = HTTPServer(('0.0.0.0', PORT), HealthCheckHandler)
-    logger.info(f"Health check server running on port {PORT}")
-    server.serve_forever()
-
-def fetch_random_hadith():
-    """Fetch a random hadith from the API"""
-    max_attempts = 3
-    attempt = 0
-    
-    while attempt < max_attempts:
-        try:
-            book = random.choice(BOOKS)
-            
-            url = f"{HADITH_API_BASE}/hadiths?apiKey={HADITH_API_KEY}&book={book}&paginate=50"
-            
-            response = requests.get(url, timeout=10)
-            
-            if response.status_code == 404:
-                logger.warning(f"Book '{book}' returned 404, trying another book...")
-                attempt += 1
-                continue
-                
-            response.raise_for_status()
-            
-            data = response.json()
-            
-            if 'hadiths' in data and 'data' in data['hadiths'] and len(data['hadiths']['data']) > 0:
-                hadith = random.choice(data['hadiths']['data'])
-                logger.info(f"Successfully fetched hadith from {book}")
-                return hadith
-            else:
-                logger.warning(f"No hadiths found in {book}, trying another book...")
-                attempt += 1
-                
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Request error fetching hadith (attempt {attempt + 1}/{max_attempts}): {e}")
-            attempt += 1
-        except Exception as e:
-            logger.error(f"Error fetching hadith (attempt {attempt + 1}/{max_attempts}): {e}")
-            attempt += 1
-    
-    logger.error("Failed to fetch hadith after all attempts")
-    return None
-
-def format_hadith_message(hadith):
-    """Format hadith data into a readable message"""
-    if not hadith:
-        return "❌ Could not fetch hadith. Please try again."
-    
-    english = hadith.get('hadithEnglish', 'N/A')
-    arabic = hadith.get('hadithArabic', '')
-    book_name = hadith.get('book', {}).get('bookName', 'Unknown')
-    hadith_number = hadith.get('hadithNumber', 'N/A')
-    chapter = hadith.get('chapter', {}).get('chapterEnglish', 'N/A')
-    
-    message = f"📖 *{book_name}*\n"
-    message += f"📚 Hadith #{hadith_number}\n"
-    message += f"📑 Chapter: {chapter}\n\n"
-    
-    if arabic:
-        message += f"🔤 *Arabic:*\n{arabic}\n\n"
-    
-    message += f"🇬🇧 *English:*\n{english}"
-    
-    return message
-
-def get_main_menu_keyboard():
-    """Create main menu keyboard"""
-    keyboard = [
-        [InlineKeyboardButton("📿 Get Random Hadith", callback_data='get_hadith')],
-        [InlineKeyboardButton("⏰ Daily Hadith Settings", callback_data='daily_settings')],
-        [InlineKeyboardButton("ℹ️ Help", callback_data='help')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-def get_daily_settings_keyboard(is_enabled=False):
-    """Create daily hadith settings keyboard"""
-    if is_enabled:
-        keyboard = [
-            [InlineKeyboardButton("⏰ Change Time", callback_data='set_time')],
-            [InlineKeyboardButton("🔕 Disable Daily Hadith", callback_data='disable_daily')],
-            [InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]
-        ]
-    else:
-        keyboard = [
-            [InlineKeyboardButton("✅ Enable Daily Hadith", callback_data='set_time')],
-            [InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]
-        ]
-    return InlineKeyboardMarkup(keyboard)
+SEARCH_EXPIRED_MESSAGE = "This search has expired. Send /search again."
+
+BOT_ERRORS = registry.counter('bot_errors_total', 'Exceptions reported to the error handler')
+
+health_server = HealthServer(PORT)
+startup_state = {'subscriptions_restored': False}
+
+def register_health_checks(application: Application):
+    """Readiness: updates are being received, the database answers and subscriptions are loaded"""
+    async def receiving_updates():
+        if UPDATE_MODE == 'webhook' or BOT_MODE == 'worker':
+            return application.running
+        return application.updater is not None and application.updater.running
+
+    async def database_reachable():
+        return await run_db(ping_database)
+
+    async def subscriptions_restored():
+        return startup_state['subscriptions_restored']
+
+    health_server.add_check('receiving_updates', receiving_updates)
+    health_server.add_check('database', database_reachable)
+    health_server.add_check('subscriptions_restored', subscriptions_restored)
 
+async def edit_with_chunks(query, chunks, reply_markup):
+    """Edit a message to the first chunk and send any remaining chunks after it"""
+    last = len(chunks) - 1
+    await query.edit_message_text(
+        chunks[0],
+        parse_mode='Markdown',
+        reply_markup=reply_markup if last == 0 else None
+    )
+    for i, chunk in enumerate(chunks[1:], start=1):
+        await query.message.reply_text(
+            chunk,
+            parse_mode='Markdown',
+            reply_markup=reply_markup if i == last else None
+        )
+
+async def reply_with_chunks(message, chunks, reply_markup):
+    """Reply with each chunk in order, attaching the keyboard to the last one"""
+    last = len(chunks) - 1
+    for i, chunk in enumerate(chunks):
+        await message.reply_text(
+            chunk,
+            parse_mode='Markdown',
+            reply_markup=reply_markup if i == last else None
+        )
+
+@instrument()
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
     user = update.message.from_user
     
-    save_user(
+    flush_now = user_writes.save(
         user_id=user.id,
         chat_id=update.message.chat_id,
         username=user.username,
         first_name=user.first_name,
         last_name=user.last_name
     )
+    if flush_now:
+        context.application.create_task(run_db(user_writes.flush))
     
     welcome_message = (
         "السلام عليكم ورحمة الله وبركاته\n\n"
@@ -180,55 +169,45 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_main_menu_keyboard()
     )
 
-async def send_daily_hadith(context: ContextTypes.DEFAULT_TYPE):
-    """Send daily hadith to user"""
-    job = context.job
-    chat_id = job.chat_id
-    
-    hadith = fetch_random_hadith()
-    message = format_hadith_message(hadith)
-    
-    message = "🌅 *Daily Hadith*\n\n" + message
-    
-    keyboard = [
-        [InlineKeyboardButton("🔄 Get Another", callback_data='get_hadith')],
-        [InlineKeyboardButton("⚙️ Settings", callback_data='daily_settings')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    try:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=message,
-            parse_mode='Markdown',
-            reply_markup=reply_markup
-        )
-        logger.info(f"Daily hadith sent to chat_id: {chat_id}")
-    except Exception as e:
-        logger.error(f"Error sending daily hadith to {chat_id}: {e}")
+def record_delivery(context: ContextTypes.DEFAULT_TYPE, user_id, hadith):
+    """Add a sent hadith to the user's history, flushing early if the batch is full"""
+    if hadith_history.record(user_id, hadith):
+        context.application.create_task(run_db(hadith_history.flush))
 
+hadith_history = HistoryRecorder()
+delivery_ledger = DeliveryLedger()
+shard_coordinator = ShardCoordinator() if SHARDED else None
+daily_scheduler = BroadcastScheduler(
+    fetch_random_hadith,
+    partial(render_hadith, variant='daily'),
+    history=hadith_history,
+    shards=shard_coordinator,
+    ledger=delivery_ledger
+)
+hadith_pool = HadithPrefetchPool()
+offset_watcher = OffsetWatcher()
+outbox = OutboxRateLimiter()
+
+@instrument()
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button clicks"""
     query = update.callback_query
     await query.answer()
     
     if query.data == 'get_hadith':
-        await query.edit_message_text("⏳ Fetching hadith...")
+        user_id = query.from_user.id
+        seen = await hadith_history.seen(user_id)
         
-        hadith = fetch_random_hadith()
-        message = format_hadith_message(hadith)
+        hadith = hadith_pool.take(exclude=seen.excludes)
+        if hadith is None:
+            await query.edit_message_text("⏳ Fetching hadith...")
+            hadith = await fetch_random_hadith(exclude=seen.excludes)
         
-        keyboard = [
-            [InlineKeyboardButton("🔄 Get Another Hadith", callback_data='get_hadith')],
-            [InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        if hadith:
+            record_delivery(context, user_id, hadith)
         
-        await query.edit_message_text(
-            message, 
-            parse_mode='Markdown',
-            reply_markup=reply_markup
-        )
+        chunks, reply_markup = render_hadith(hadith)
+        await edit_with_chunks(query, chunks, reply_markup)
     
     elif query.data == 'main_menu':
         welcome_message = (
@@ -245,30 +224,20 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif query.data == 'daily_settings':
         user_id = query.from_user.id
-        user_data = get_user(user_id)
+        user_data = await run_db(get_user, user_id)
         
         is_enabled = user_data and user_data.get('daily_hadith_enabled', False)
         
         if is_enabled:
-            time_obj = user_data.get('daily_hadith_time')
+            time_str = format_daily_time(user_data.get('daily_hadith_time'))
             
-            if isinstance(time_obj, str):
-                time_str = time_obj
-            elif hasattr(time_obj, 'hour') and hasattr(time_obj, 'minute'):
-                time_str = f"{time_obj.hour:02d}:{time_obj.minute:02d}"
-            else:
-                total_seconds = int(time_obj.total_seconds())
-                hour = total_seconds // 3600
-                minute = (total_seconds % 3600) // 60
-                time_str = f"{hour:02d}:{minute:02d}"
-            
-            timezone_str = user_data.get('timezone', 'Europe/Rome')
+            timezone_str = user_data.get('timezone') or DEFAULT_TIMEZONE
             
             message = (
                 "⏰ *Daily Hadith Settings*\n\n"
                 f"✅ Status: Enabled\n"
                 f"🕐 Time: {time_str}\n"
-                f"🌍 Timezone: {timezone_str}\n\n"
+                f"🌍 Timezone: {escape_markdown(timezone_str)}\n\n"
                 "You will receive a hadith every day at your set time."
             )
         else:
@@ -293,16 +262,17 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Send /cancel to go back.",
             parse_mode='Markdown'
         )
-        context.user_data['awaiting_time'] = True
         return WAITING_FOR_TIME
     
+    elif query.data == 'set_timezone':
+        await query.edit_message_text(TIMEZONE_PROMPT, parse_mode='Markdown')
+        return await offer_location(query.message, context)
+    
     elif query.data == 'disable_daily':
         user_id = query.from_user.id
-        update_daily_hadith_settings(user_id, enabled=False, time_str=None)
+        await run_db(update_daily_hadith_settings, user_id, enabled=False, time_str=None)
         
-        jobs = context.job_queue.get_jobs_by_name(f"daily_hadith_{user_id}")
-        for job in jobs:
-            job.schedule_removal()
+        daily_scheduler.remove(user_id)
 
         await query.edit_message_text(
             "✅ Daily hadith has been disabled.\n\n"
@@ -317,6 +287,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/start - Show main menu\n"
             "/hadith - Get a random hadith\n"
             "/daily - Daily hadith settings\n"
+            "/timezone - Set your timezone\n"
+            "/search <words> - Search hadiths by keyword\n"
             "/cancel - Cancel current operation\n\n"
             "*Features:*\n"
             "📿 Random hadiths from 9 authentic collections\n"
@@ -333,18 +305,37 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "• Musnad Ahmad\n"
             "• Al-Silsila Sahiha"
         )
-        keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]]
         await query.edit_message_text(
             help_message,
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=BACK_TO_MENU_KEYBOARD
         )
+    
+    elif query.data.startswith('search_page:'):
+        search = context.user_data.get('search')
+        if not search:
+            await query.edit_message_text(SEARCH_EXPIRED_MESSAGE, reply_markup=HOME_KEYBOARD)
+            return
+        
+        text, reply_markup = render_search_page(
+            search['query'], search['results'], int(query.data.split(':')[1]), search_index.get
+        )
+        await query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+    
+    elif query.data.startswith('search_open:'):
+        search = context.user_data.get('search')
+        doc = int(query.data.split(':')[1])
+        if not search or doc not in search['results']:
+            await query.edit_message_text(SEARCH_EXPIRED_MESSAGE, reply_markup=HOME_KEYBOARD)
+            return
+        
+        chunks, _ = render_hadith(search_index.get(doc))
+        page = search['results'].index(doc) // SEARCH_PAGE_SIZE
+        await edit_with_chunks(query, chunks, search_result_keyboard(page))
 
+@instrument()
 async def handle_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle time input for daily hadith"""
-    if not context.user_data.get('awaiting_time'):
-        return
-    
     time_text = update.message.text.strip()
     
     try:
@@ -356,37 +347,28 @@ async def handle_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.message.from_user.id
         chat_id = update.message.chat_id
         
-        user_data = get_user(user_id)
-        user_timezone_str = user_data.get('timezone', 'Europe/Rome') if user_data else 'Europe/Rome'
-        user_timezone = pytz.timezone(user_timezone_str)
+        user_data = await run_db(get_user, user_id)
+        user_timezone_str = (user_data.get('timezone') if user_data else None) or DEFAULT_TIMEZONE
+        user_timezone = get_zone(user_timezone_str)
         
-        update_daily_hadith_settings(user_id, enabled=True, time_str=time_text)
-        
-        jobs = context.job_queue.get_jobs_by_name(f"daily_hadith_{user_id}")
-        for job in jobs:
-            job.schedule_removal()
-
-        context.job_queue.run_daily(
-            send_daily_hadith,
-            time=time(hour=hour, minute=minute, tzinfo=user_timezone),
-            chat_id=chat_id,
-            name=f"daily_hadith_{user_id}",
-            user_id=user_id
+        delivery_minute = utc_minute_of_day(hour, minute, user_timezone)
+        await run_db(
+            update_daily_hadith_settings,
+            user_id,
+            enabled=True,
+            time_str=f"{hour:02d}:{minute:02d}",
+            delivery_minute=delivery_minute
         )
         
-        context.user_data['awaiting_time'] = False
-        
-        keyboard = [
-            [InlineKeyboardButton("🔙 Back to Settings", callback_data='daily_settings')],
-            [InlineKeyboardButton("🏠 Main Menu", callback_data='main_menu')]
-        ]
+        if not SHARDED:
+            daily_scheduler.add(user_id, chat_id, delivery_minute)
         
         await update.message.reply_text(
             f"✅ Daily hadith enabled!\n\n"
             f"You will receive a hadith every day at {time_text}.\n"
             f"🌍 Timezone: {user_timezone_str}\n\n"
             f"Make sure to keep the bot unblocked to receive messages.",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=TIME_SET_KEYBOARD
         )
         
         return ConversationHandler.END
@@ -400,42 +382,61 @@ async def handle_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return WAITING_FOR_TIME
 
+@instrument()
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel current operation"""
-    context.user_data['awaiting_time'] = False
-    
-    keyboard = [[InlineKeyboardButton("🏠 Main Menu", callback_data='main_menu')]]
+    if context.user_data.pop('location_keyboard', False):
+        await update.message.reply_text("Operation cancelled.", reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
     
     await update.message.reply_text(
         "Operation cancelled.",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=HOME_KEYBOARD
     )
     return ConversationHandler.END
 
+@instrument()
 async def hadith_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /hadith command"""
-    await update.message.reply_text("⏳ Fetching hadith...")
+    user_id = update.message.from_user.id
+    seen = await hadith_history.seen(user_id)
     
-    hadith = fetch_random_hadith()
-    message = format_hadith_message(hadith)
+    hadith = hadith_pool.take(exclude=seen.excludes)
+    if hadith is None:
+        await update.message.reply_text("⏳ Fetching hadith...")
+        hadith = await fetch_random_hadith(exclude=seen.excludes)
     
-    keyboard = [
-        [InlineKeyboardButton("🔄 Get Another Hadith", callback_data='get_hadith')],
-        [InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if hadith:
+        record_delivery(context, user_id, hadith)
     
-    await update.message.reply_text(
-        message,
-        parse_mode='Markdown',
-        reply_markup=reply_markup
-    )
+    chunks, reply_markup = render_hadith(hadith)
+    await reply_with_chunks(update.message, chunks, reply_markup)
 
+@instrument()
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /search command"""
+    query_text = " ".join(context.args).strip()
+    if not query_text:
+        await update.message.reply_text(
+            "🔎 *Search Hadiths*\n\n"
+            "Send /search followed by keywords in English or Arabic.\n"
+            "Example: /search patience",
+            parse_mode='Markdown'
+        )
+        return
+    
+    results = search_index.search(query_text)
+    context.user_data['search'] = {'query': query_text, 'results': results}
+    
+    text, reply_markup = render_search_page(query_text, results, 0, search_index.get)
+    await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+
+@instrument()
 async def daily_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /daily command"""
     user_id = update.message.from_user.id
-    jobs = context.job_queue.get_jobs_by_name(f"daily_hadith_{user_id}")
-    is_enabled = len(jobs) > 0
+    user_data = await run_db(get_user, user_id)
+    is_enabled = bool(user_data and user_data.get('daily_hadith_enabled', False))
     
     if is_enabled:
         message = (
@@ -457,76 +458,325 @@ async def daily_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_daily_settings_keyboard(is_enabled)
     )
 
+async def offer_location(message, context: ContextTypes.DEFAULT_TYPE):
+    """Wait for a timezone, offering a location button as well"""
+    context.user_data['location_keyboard'] = True
+    await message.reply_text("Or share your location:", reply_markup=LOCATION_KEYBOARD)
+    return WAITING_FOR_TIMEZONE
+
+@instrument()
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /timezone command"""
+    user_data = await run_db(get_user, update.message.from_user.id)
+    timezone_str = (user_data.get('timezone') if user_data else None) or DEFAULT_TIMEZONE
+    
+    await update.message.reply_text(
+        f"🌍 Current timezone: {escape_markdown(timezone_str)}\n\n" + TIMEZONE_PROMPT,
+        parse_mode='Markdown'
+    )
+    return await offer_location(update.message, context)
+
+@instrument()
+async def handle_timezone_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle a timezone name or UTC offset sent after /timezone"""
+    timezone_str = parse_timezone(update.message.text)
+    if timezone_str is None:
+        await update.message.reply_text(
+            "❌ Unknown timezone.\n\n"
+            "Send a name like Europe/London or an offset like +3 or UTC+05:30.\n\n"
+            "Send /cancel to go back."
+        )
+        return WAITING_FOR_TIMEZONE
+    return await apply_timezone(update, context, timezone_str)
+
+@instrument()
+async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Resolve a shared location to a timezone"""
+    location = update.message.location
+    timezone_str = await asyncio.to_thread(zone_at, location.latitude, location.longitude)
+    if timezone_str is None:
+        await update.message.reply_text(
+            "❌ Could not find a timezone for that location.\n\n"
+            "Send a name like Europe/London or an offset like +3 instead."
+        )
+        return WAITING_FOR_TIMEZONE
+    return await apply_timezone(update, context, timezone_str)
+
+async def apply_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE, timezone_str):
+    """Save a user's timezone and move their daily hadith to the same local time in it"""
+    user_id = update.effective_user.id
+    user_data = await run_db(get_user, user_id)
+    
+    local_time = None
+    delivery_minute = None
+    if user_data and user_data.get('daily_hadith_enabled') and user_data.get('daily_hadith_time') is not None:
+        local_time = format_daily_time(user_data['daily_hadith_time'])
+        hour, minute = map(int, local_time.split(':'))
+        delivery_minute = utc_minute_of_day(hour, minute, get_zone(timezone_str))
+    
+    await run_db(update_user_timezone, user_id, timezone_str, delivery_minute)
+    offset_watcher.watch(timezone_str)
+    if delivery_minute is not None and not SHARDED:
+        daily_scheduler.add(user_id, update.effective_chat.id, delivery_minute)
+    
+    offset = offset_minutes(timezone_str)
+    message = (
+        f"✅ Timezone set to {timezone_str} "
+        f"(UTC{'+' if offset >= 0 else '-'}{abs(offset) // 60:02d}:{abs(offset) % 60:02d})."
+    )
+    if local_time:
+        message += f"\n\nYou will keep receiving your daily hadith at {local_time} local time."
+    
+    if context.user_data.pop('location_keyboard', False):
+        await update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
+    else:
+        await update.message.reply_text(message, reply_markup=TIME_SET_KEYBOARD)
+    return ConversationHandler.END
+
+async def rebucket_timezones(context: ContextTypes.DEFAULT_TYPE):
+    """Move subscribers of zones whose UTC offset changed (DST) to their new delivery minute in bulk"""
+    zones = await run_db(get_subscriber_timezones) if offset_watcher.needs_refresh() else None
+    changed = offset_watcher.changed(zones)
+    if not changed:
+        return
+    
+    try:
+        rows = await run_db(rebucket_daily_hadith_subscriptions, changed)
+    except Exception as e:
+        offset_watcher.forget(changed)
+        logger.error(f"Could not move subscribers after a timezone offset change: {e}")
+        return
+    
+    if rows:
+        if not SHARDED:
+            daily_scheduler.restore(rows)
+        logger.info(f"Moved {len(rows)} daily hadith subscribers in {len(changed)} timezones to new delivery minutes")
+
+@instrument()
+async def record_interaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Buffer a last_interaction update for whoever sent the update"""
+    if update.effective_user and user_writes.touch(update.effective_user.id):
+        context.application.create_task(run_db(user_writes.flush))
+
+async def flush_user_writes(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically write buffered user changes to the database"""
+    await run_db(user_writes.flush)
+
+async def flush_hadith_history(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically write batched hadith deliveries to the database"""
+    await run_db(hadith_history.flush)
+
+async def flush_delivery_ledger(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically write recorded daily deliveries to the database"""
+    await run_db(delivery_ledger.flush)
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     """Log errors caused by updates"""
+    BOT_ERRORS.inc()
     logger.error(f"Exception while handling an update: {context.error}")
 
-async def post_init(application: Application):
-    """Restore scheduled jobs from database on bot startup"""
-    logger.info("Restoring scheduled jobs from database...")
-    
-    users = get_all_daily_hadith_users()
+def register_runtime_metrics(application: Application):
+    """Expose queue sizes and cache counters, read when /metrics is scraped"""
+    registry.collect('job_queue_jobs', 'Jobs scheduled in the job queue', lambda: len(application.job_queue.jobs()))
+    registry.collect(
+        'outbox_queue_size', 'Messages waiting for a global send token',
+        lambda: {('interactive',): outbox.queue_size(INTERACTIVE), ('broadcast',): outbox.queue_size(BROADCAST)},
+        labels=['priority']
+    )
+    registry.collect(
+        'outbox_requests_total', 'Rate-limited Telegram requests by outcome',
+        lambda: {(key,): value for key, value in outbox.stats.items()},
+        labels=['outcome'], type='counter'
+    )
+    registry.collect(
+        'cache_hits_total', 'Cache hits by cache',
+        lambda: {
+            ('corpus',): corpus.hits + corpus_file.hits,
+            ('hadith_page',): sampler.hits,
+            ('user',): user_cache_stats()['hits'],
+            ('render',): render_stats['hits'],
+            ('prefetch',): hadith_pool.served,
+        },
+        labels=['cache'], type='counter'
+    )
+    registry.collect(
+        'cache_misses_total', 'Cache misses by cache',
+        lambda: {
+            ('corpus',): corpus.misses,
+            ('hadith_page',): sampler.misses,
+            ('user',): user_cache_stats()['misses'],
+            ('render',): render_stats['misses'],
+            ('prefetch',): hadith_pool.empty,
+        },
+        labels=['cache'], type='counter'
+    )
+    registry.collect(
+        'db_pool_connections', 'Database pool connections by state',
+        lambda: {(state,): pool_stats()[state] for state in ('in_use', 'idle')},
+        labels=['state']
+    )
+    registry.collect(
+        'db_pool_wait_seconds_total', 'Time spent waiting for a pooled connection',
+        lambda: pool_stats()['wait_seconds_total'], type='counter'
+    )
+    registry.collect(
+        'hadith_api_circuit_open', 'Whether a book\'s API circuit is open',
+        lambda: {(book,): int(breaker.is_open()) for book, breaker in breakers.items()},
+        labels=['book']
+    )
+    registry.collect('prefetch_queue_size', 'Prefetched hadiths ready to send', hadith_pool.size)
+    registry.collect(
+        'pending_writes', 'Buffered database writes waiting for a flush',
+        lambda: {
+            ('users',): user_writes.pending(),
+            ('hadith_history',): hadith_history.pending(),
+            ('daily_deliveries',): delivery_ledger.pending(),
+        },
+        labels=['kind']
+    )
+    registry.collect('daily_subscribers', 'Daily hadith subscribers held in memory', lambda: len(daily_scheduler))
+
+async def restore_subscriptions(application: Application):
+    """Load every daily subscription into the scheduler, retrying until the database answers"""
+    logger.info("Restoring daily hadith subscriptions from database...")
+    try:
+        rows = await run_db(lambda: list(iter_daily_hadith_subscriptions()))
+    except Exception as e:
+        logger.error(f"Could not restore daily hadith subscriptions, retrying in {RESTORE_RETRY_INTERVAL:.0f}s: {e}")
+        application.job_queue.run_once(retry_restore_subscriptions, RESTORE_RETRY_INTERVAL, name='restore_subscriptions')
+        return
     
-    for user in users:
-        user_id = user['user_id']
-        chat_id = user['chat_id']
-        time_obj = user['daily_hadith_time']
-        timezone_str = user.get('timezone', 'Europe/Rome')
-        
-        if time_obj:
-            try:
-                if isinstance(time_obj, str):
-                    hour, minute = map(int, time_obj.split(':'))
-                elif hasattr(time_obj, 'hour') and hasattr(time_obj, 'minute'):
-                    hour = time_obj.hour
-                    minute = time_obj.minute
-                else:
-                    total_seconds = int(time_obj.total_seconds())
-                    hour = total_seconds // 3600
-                    minute = (total_seconds % 3600) // 60
-                
-                user_timezone = pytz.timezone(timezone_str)
-
-                application.job_queue.run_daily(
-                    send_daily_hadith,
-                    time=time(hour=hour, minute=minute, tzinfo=user_timezone),
-                    chat_id=chat_id,
-                    name=f"daily_hadith_{user_id}",
-                    user_id=user_id
-                )
-
-                logger.info(f"Restored daily hadith job for user {user_id}: {hour:02d}:{minute:02d} ({timezone_str})")
-            except Exception as e:
-                logger.error(f"Error restoring job for user {user_id}: {e}")
-    
-    logger.info(f"Restored jobs for {len(users)} users")
+    # The buckets are only touched on the event loop, like the lazy loader does.
+    restored = daily_scheduler.restore(rows)
+    logger.info(f"Restored {restored} users into {daily_scheduler.bucket_count()} delivery buckets")
+    startup_state['subscriptions_restored'] = True
 
-def main():
-    """Start the bot"""
-    init_database()
+async def retry_restore_subscriptions(context: ContextTypes.DEFAULT_TYPE):
+    await restore_subscriptions(context.application)
 
-    health_thread = Thread(target=run_health_server, daemon=True)
-    health_thread.start()
+async def post_init(application: Application):
+    """Restore daily hadith subscriptions from database on bot startup"""
+    register_health_checks(application)
+    await health_server.start()
+    daily_scheduler.state = application.bot_data
+    
+    if SHARDED:
+        await run_db(shard_coordinator.heartbeat)
+        shard_coordinator.schedule(application.job_queue)
+        logger.info(f"Sharded delivery ({BOT_MODE}): buckets are claimed and loaded as they come due")
+    elif daily_scheduler.lazy:
+        logger.info("Lazy startup: daily hadith buckets will be loaded in the background")
+    else:
+        await restore_subscriptions(application)
+    if SHARDED or daily_scheduler.lazy:
+        startup_state['subscriptions_restored'] = True
+    
+    daily_scheduler.catch_up(application)
+    daily_scheduler.schedule(application.job_queue)
+    application.job_queue.run_repeating(
+        flush_user_writes,
+        interval=USER_WRITE_FLUSH_INTERVAL,
+        name='flush_user_writes'
+    )
+    application.job_queue.run_repeating(
+        flush_hadith_history,
+        interval=HISTORY_FLUSH_INTERVAL,
+        name='flush_hadith_history'
+    )
+    application.job_queue.run_repeating(
+        flush_delivery_ledger,
+        interval=LEDGER_FLUSH_INTERVAL,
+        name='flush_delivery_ledger'
+    )
+    if BOT_MODE != 'worker':
+        application.job_queue.run_repeating(
+            rebucket_timezones,
+            interval=TIMEZONE_CHECK_INTERVAL,
+            first=5,
+            name='rebucket_timezones'
+        )
+    if BOT_MODE != 'worker':
+        hadith_pool.start(application)
+    register_runtime_metrics(application)
+    if BOT_MODE != 'worker':
+        application.create_task(asyncio.to_thread(build_search_index))
 
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).build()
+async def post_shutdown(application: Application):
+    """Release shared resources when the bot stops"""
+    await health_server.stop()
+    if SHARDED:
+        await shard_coordinator.leave()
+    await hadith_pool.stop()
+    await close_http_client()
+    await run_db(user_writes.flush)
+    await run_db(hadith_history.flush)
+    await run_db(delivery_ledger.flush)
+    close_pool()
+
+def build_application(token=TELEGRAM_BOT_TOKEN, base_url=None):
+    """Build the application with every handler registered"""
+    builder = (
+        Application.builder()
+        .token(token)
+        .rate_limiter(outbox)
+        .concurrent_updates(OrderedUpdateProcessor())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if PERSISTENCE != 'off' and BOT_MODE != 'worker':
+        builder = builder.persistence(PostgresPersistence())
+    if base_url:
+        builder = builder.base_url(base_url)
+    app = builder.build()
+    
+    app.add_handler(TypeHandler(Update, record_interaction), group=-1)
+    
+    app.add_handler(ConversationHandler(
+        entry_points=[
+            CallbackQueryHandler(button_callback, pattern='^(set_time|set_timezone)$'),
+            CommandHandler("timezone", timezone_command),
+        ],
+        states={
+            WAITING_FOR_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_time_input)],
+            WAITING_FOR_TIMEZONE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_timezone_input),
+                MessageHandler(filters.LOCATION, handle_location),
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        allow_reentry=True,
+        name='daily_settings',
+        persistent=app.persistence is not None,
+    ))
     
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("hadith", hadith_command))
     app.add_handler(CommandHandler("daily", daily_command))
+    app.add_handler(CommandHandler("search", search_command))
     app.add_handler(CommandHandler("cancel", cancel))
     
     app.add_handler(CallbackQueryHandler(button_callback))
     
-    app.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND,
-        handle_time_input
-    ))
-    
     app.add_error_handler(error_handler)
+    return app
+
+def main():
+    """Start the bot"""
+    init_database()
+    open_corpus_file()
+    load_corpus_dump()
+
+    app = build_application()
     
     logger.info("Bot is running... Press Ctrl+C to stop.")
-    logger.info("Commands registered: /start, /hadith, /daily, /cancel")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info("Commands registered: /start, /hadith, /daily, /search, /timezone, /cancel")
+    if BOT_MODE == 'worker':
+        logger.info("Running as a delivery worker; Telegram updates are handled by the primary")
+        run_without_updates(app)
+    elif UPDATE_MODE == 'webhook':
+        run_webhook(app, health_server)
+    else:
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
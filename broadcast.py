@@ -0,0 +1,504 @@
+import asyncio
+import collections
+import logging
+import os
+import time as monotonic_time
+from datetime import datetime, time, timedelta, timezone
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.ext import ContextTypes
+
+from database import disable_daily_hadith_subscriptions, get_seen_hadith_pairs, iter_daily_hadith_subscriptions, run_db
+from history import hadith_index
+from metrics import BROADCAST_LAG_SECONDS, BROADCAST_MESSAGES
+from outbox import BROADCAST, request_never_sent
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 20))
+BROADCAST_CANDIDATES = int(os.getenv('BROADCAST_CANDIDATES', 3))
+BROADCAST_MAX_CATCHUP_MINUTES = int(os.getenv('BROADCAST_MAX_CATCHUP_MINUTES', 5))
+DELIVERY_GRACE_MINUTES = int(os.getenv('DELIVERY_GRACE_MINUTES', 60))
+CATCHUP_RATE = float(os.getenv('CATCHUP_RATE', 10))
+BROADCAST_RETRIES = int(os.getenv('BROADCAST_RETRIES', 2))
+BROADCAST_RETRY_DELAY = float(os.getenv('BROADCAST_RETRY_DELAY', 30))
+PRUNE_REPORT_INTERVAL = float(os.getenv('PRUNE_REPORT_INTERVAL', 24 * 60 * 60))
+
+STARTUP_MODE = os.getenv('STARTUP_MODE', 'eager')
+LAZY_WINDOW_HOURS = float(os.getenv('LAZY_WINDOW_HOURS', 2))
+LAZY_REFRESH_MINUTES = int(os.getenv('LAZY_REFRESH_MINUTES', 10))
+LAZY_LOAD_ATTEMPTS = 3
+LAZY_LOAD_RETRY_DELAY = 5
+
+MINUTES_PER_DAY = 24 * 60
+LAST_TICK_KEY = 'broadcast_last_tick'
+
+
+def format_minute(minute):
+    """Format a minute-of-day as HH:MM"""
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def classify_send_error(error):
+    """Return why a send failed: 'blocked' or 'chat_not_found' (the chat is gone), 'transient' or 'failed'"""
+    if isinstance(error, Forbidden):
+        return 'blocked'
+    if isinstance(error, BadRequest):
+        return 'chat_not_found' if 'chat not found' in error.message.lower() else 'failed'
+    # Other network errors and timeouts may have been delivered, so they are not retried.
+    if isinstance(error, RetryAfter) or request_never_sent(error):
+        return 'transient'
+    return 'failed'
+
+
+class Pacer:
+    """Spaces calls at most ``rate`` per second across all callers"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = monotonic_time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+                now = self._next
+            self._next = now + self.interval
+
+
+class BroadcastScheduler:
+    """Daily hadith subscriptions grouped into UTC delivery minutes.
+
+    A repeating job calls ``tick`` once a minute; each due bucket renders a
+    few candidate hadiths once and fans them out at broadcast priority,
+    giving every subscriber the first candidate they have not seen. The
+    buckets live in memory, are loaded a window at a time in lazy mode, or
+    are claimed shard by shard in the database when ``shards`` is set. An
+    optional ``ledger`` skips deliveries already made, which lets
+    ``catch_up`` resend missed buckets after a restart.
+    """
+
+    def __init__(self, pick_hadith, render, history=None, concurrency=BROADCAST_CONCURRENCY,
+                 candidates=BROADCAST_CANDIDATES, lazy=STARTUP_MODE == 'lazy', window_hours=LAZY_WINDOW_HOURS,
+                 shards=None, ledger=None):
+        self.pick_hadith = pick_hadith
+        self.shards = shards
+        self.render = render
+        self.history = history
+        self.ledger = ledger
+        self.candidates = candidates
+        self.concurrency = concurrency
+        self.lazy = lazy
+        self.window_minutes = int(window_hours * 60)
+        self._buckets = {}
+        self._user_minutes = {}
+        self._loaded_minutes = set()
+        # Where the last tick is remembered; the bot points this at its
+        # persisted bot_data so a restart catches up the minutes it missed.
+        self.state = {}
+        self.reports = collections.deque(maxlen=100)
+        self.pruned = collections.Counter()
+        self._pruned_reported = collections.Counter()
+        self._dead = set()
+        self._flushes = {}
+
+    def __len__(self):
+        return len(self._user_minutes)
+
+    def add(self, user_id, chat_id, minute):
+        """Subscribe a user at a UTC minute-of-day, replacing any previous slot"""
+        self.remove(user_id)
+        self._buckets.setdefault(minute, {})[user_id] = chat_id
+        self._user_minutes[user_id] = minute
+
+    def remove(self, user_id):
+        """Unsubscribe a user; returns True if they were subscribed"""
+        minute = self._user_minutes.pop(user_id, None)
+        if minute is None:
+            return False
+        bucket = self._buckets.get(minute)
+        if bucket is not None:
+            bucket.pop(user_id, None)
+            if not bucket:
+                del self._buckets[minute]
+        return True
+
+    def restore(self, subscriptions):
+        """Load (user_id, chat_id, minute, timezone) rows; returns how many were added"""
+        buckets = self._buckets
+        user_minutes = self._user_minutes
+        count = 0
+        for user_id, chat_id, minute, _ in subscriptions:
+            if user_id in user_minutes:
+                self.remove(user_id)
+            bucket = buckets.get(minute)
+            if bucket is None:
+                bucket = buckets[minute] = {}
+            bucket[user_id] = chat_id
+            user_minutes[user_id] = minute
+            count += 1
+        return count
+
+    def bucket_count(self):
+        """Return how many non-empty delivery minutes exist"""
+        return len(self._buckets)
+
+    async def load_minutes(self, minutes):
+        """Load the given delivery minutes from the database (lazy mode).
+
+        If the query fails the minutes stay unloaded and the error propagates.
+        """
+        minutes = [minute for minute in minutes if minute not in self._loaded_minutes]
+        if not minutes:
+            return 0
+        rows = await run_db(lambda: list(iter_daily_hadith_subscriptions(minutes)))
+        self._loaded_minutes.update(minutes)
+        return self.restore(rows)
+
+    def unload_minute(self, minute):
+        """Drop a delivered bucket so it is reloaded from the database next time"""
+        self._loaded_minutes.discard(minute)
+        for user_id in self._buckets.pop(minute, {}):
+            self._user_minutes.pop(user_id, None)
+
+    async def load_window(self, context: ContextTypes.DEFAULT_TYPE):
+        """Load every bucket due within the lazy window that is not in memory yet"""
+        now = datetime.now(timezone.utc)
+        current = now.hour * 60 + now.minute
+        upcoming = [(current + offset) % MINUTES_PER_DAY for offset in range(1, self.window_minutes + 1)]
+        started = monotonic_time.monotonic()
+        try:
+            loaded = await self.load_minutes(upcoming)
+        except Exception as e:
+            logger.error(f"Could not load upcoming daily hadith buckets, retrying at the next refresh: {e}")
+            return
+        if loaded:
+            logger.info(
+                f"Loaded {loaded} subscriptions for the next {self.window_minutes} minutes "
+                f"in {monotonic_time.monotonic() - started:.2f}s"
+            )
+
+    def schedule(self, job_queue):
+        """Register the once-a-minute tick job, aligned to the minute boundary"""
+        job_queue.run_repeating(self.report_pruned, interval=PRUNE_REPORT_INTERVAL, name='report_pruned_chats')
+        if self.lazy:
+            job_queue.run_repeating(self.load_window, interval=LAZY_REFRESH_MINUTES * 60, first=0, name='daily_broadcast_loader')
+        now = datetime.now(timezone.utc)
+        first = 60 - now.second - now.microsecond / 1_000_000
+        return job_queue.run_repeating(self.tick, interval=60, first=first, name='daily_broadcast')
+
+    async def tick(self, context: ContextTypes.DEFAULT_TYPE):
+        """Start broadcasts for every bucket due since the previous tick"""
+        now = datetime.now(timezone.utc)
+        current = now.hour * 60 + now.minute
+        minute_start = now.replace(second=0, microsecond=0)
+
+        last_tick = self.state.get(LAST_TICK_KEY)
+        if last_tick is None:
+            due = [0]
+        else:
+            behind = int((minute_start - datetime.fromisoformat(last_tick)).total_seconds() // 60)
+            if behind > BROADCAST_MAX_CATCHUP_MINUTES:
+                logger.warning(f"Broadcast tick is {behind} minutes behind, only catching up {BROADCAST_MAX_CATCHUP_MINUTES}")
+                behind = BROADCAST_MAX_CATCHUP_MINUTES
+            due = range(behind - 1, -1, -1)
+        self.state[LAST_TICK_KEY] = minute_start.isoformat()
+
+        if self.shards is not None:
+            starts = [minute_start - timedelta(minutes=offset) for offset in due]
+            context.application.create_task(self._run_sharded(context.bot, starts))
+            return
+
+        for offset in due:
+            minute = (current - offset) % MINUTES_PER_DAY
+            scheduled_at = minute_start - timedelta(minutes=offset)
+            if self.lazy:
+                context.application.create_task(self._run_lazy_bucket(context.bot, minute, scheduled_at))
+                continue
+            recipients = self._buckets.get(minute)
+            if recipients:
+                context.application.create_task(
+                    self.run_bucket(context.bot, minute, dict(recipients), scheduled_at)
+                )
+
+    def catch_up(self, application, grace_minutes=DELIVERY_GRACE_MINUTES, rate=CATCHUP_RATE):
+        """Start sending the deliveries missed since the last tick; returns the task or None
+
+        The window starts after the persisted last tick, at most
+        ``grace_minutes`` back, and ends with the current minute. Without a
+        previous tick nothing is caught up, since there is no telling what
+        the previous process already sent. The tick is moved past the
+        window, so the first tick only handles the minutes after it and
+        never races the catch-up for the same bucket. With shards, the
+        window is claimed for this worker's shards, so only deliveries
+        nobody else holds are caught up.
+        """
+        if self.ledger is None or grace_minutes <= 0:
+            return None
+        minute_start = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        last_tick = self.state.get(LAST_TICK_KEY)
+        self.state[LAST_TICK_KEY] = minute_start.isoformat()
+        if last_tick is None:
+            logger.info("No previous broadcast tick recorded, skipping catch-up")
+            return None
+        first = max(
+            datetime.fromisoformat(last_tick) + timedelta(minutes=1),
+            minute_start - timedelta(minutes=grace_minutes),
+        )
+        behind = int((minute_start - first).total_seconds() // 60)
+        if behind < 0:
+            return None
+        starts = [minute_start - timedelta(minutes=offset) for offset in range(behind, -1, -1)]
+        if self.shards is not None:
+            return application.create_task(self._run_sharded(application.bot, starts, Pacer(rate)))
+        return application.create_task(self._catch_up(application.bot, starts, Pacer(rate)))
+
+    async def _catch_up(self, bot, starts, pacer):
+        minutes = {started.hour * 60 + started.minute: started for started in starts}
+        try:
+            rows = await run_db(lambda: list(iter_daily_hadith_subscriptions(list(minutes))))
+        except Exception as e:
+            logger.error(f"Could not load subscriptions to catch up: {e}")
+            return
+
+        buckets = collections.defaultdict(dict)
+        for user_id, chat_id, minute, _ in rows:
+            buckets[minute][user_id] = chat_id
+
+        sent = 0
+        for minute, started in minutes.items():
+            if buckets.get(minute):
+                report = await self.run_bucket(bot, minute, buckets[minute], started, pacer=pacer)
+                if report is not None:
+                    sent += report['sent']
+        if sent:
+            logger.info(f"Caught up {sent} daily deliveries missed in the last {len(starts) - 1} minutes")
+
+    async def _run_lazy_bucket(self, bot, minute, scheduled_at):
+        for attempt in range(1, LAZY_LOAD_ATTEMPTS + 1):
+            try:
+                await self.load_minutes([minute])
+                break
+            except Exception as e:
+                logger.error(f"Could not load bucket {format_minute(minute)} UTC (attempt {attempt}/{LAZY_LOAD_ATTEMPTS}): {e}")
+                if attempt == LAZY_LOAD_ATTEMPTS:
+                    return
+                await asyncio.sleep(LAZY_LOAD_RETRY_DELAY)
+        recipients = self._buckets.get(minute)
+        self.unload_minute(minute)
+        if recipients:
+            await self.run_bucket(bot, minute, recipients, scheduled_at)
+
+    async def _run_sharded(self, bot, starts, pacer=None):
+        catchup = [
+            (started.date(), started.hour * 60 + started.minute)
+            for started in (starts[-1] - timedelta(minutes=k) for k in range(1, BROADCAST_MAX_CATCHUP_MINUTES + 1))
+        ]
+        buckets = [(started.date(), started.hour * 60 + started.minute) for started in starts]
+        since = starts[-1] - timedelta(minutes=DELIVERY_GRACE_MINUTES)
+        try:
+            claimed = await self.shards.claim(buckets, catchup, since=since)
+        except Exception as e:
+            logger.error(f"Could not claim broadcast shards: {e}")
+            return
+
+        won = collections.defaultdict(list)
+        for day, minute, shard in claimed:
+            won[(day, minute)].append(shard)
+
+        await asyncio.gather(*(
+            self._run_shard_bucket(bot, day, minute, shards, pacer) for (day, minute), shards in sorted(won.items())
+        ))
+
+    async def _run_shard_bucket(self, bot, day, minute, shards, pacer=None):
+        claims = [(day, minute, shard) for shard in shards]
+        try:
+            rows = await run_db(
+                lambda: list(iter_daily_hadith_subscriptions([minute], shards=(self.shards.shard_count, shards)))
+            )
+            recipients = {user_id: chat_id for user_id, chat_id, _, _ in rows}
+            if recipients:
+                scheduled_at = datetime.combine(day, time(hour=minute // 60, minute=minute % 60), tzinfo=timezone.utc)
+                await self.run_bucket(bot, minute, recipients, scheduled_at, pacer=pacer)
+        except Exception as e:
+            logger.error(f"Could not deliver shards {shards} of bucket {format_minute(minute)} UTC, releasing them: {e}")
+            done = False
+        else:
+            done = True
+        try:
+            await self.shards.finish(claims, done=done)
+        except Exception as e:
+            logger.error(f"Could not finish claims for bucket {format_minute(minute)} UTC: {e}")
+
+    async def prune(self, user_ids):
+        """Unsubscribe dead chats in one batch; failed batches are retried with the next one"""
+        for user_id in user_ids:
+            self.remove(user_id)
+        self._dead.update(user_ids)
+        dead = list(self._dead)
+        try:
+            await run_db(disable_daily_hadith_subscriptions, dead)
+        except Exception as e:
+            logger.error(f"Could not unsubscribe {len(dead)} dead chats, will retry: {e}")
+            return 0
+        self._dead.difference_update(dead)
+        return len(dead)
+
+    async def report_pruned(self, context: ContextTypes.DEFAULT_TYPE):
+        """Log how many dead chats were unsubscribed since the previous report"""
+        since = self.pruned - self._pruned_reported
+        self._pruned_reported = self.pruned.copy()
+        if not since:
+            return
+        reasons = ', '.join(f"{reason}: {count}" for reason, count in sorted(since.items()))
+        logger.info(
+            f"Pruned {sum(since.values())} dead chats from daily hadith since the last report ({reasons}); "
+            f"{sum(self.pruned.values())} in total, {len(self)} subscribers in memory"
+        )
+
+    def _flush_soon(self, recorder):
+        # Flush a full batch early, at most one flush per recorder at a time.
+        task = self._flushes.get(recorder)
+        if task is None or task.done():
+            self._flushes[recorder] = asyncio.get_running_loop().create_task(self._flush(recorder))
+
+    async def _flush(self, recorder):
+        try:
+            await run_db(recorder.flush)
+        except Exception as e:
+            logger.error(f"Flushing {type(recorder).__name__} failed: {e}")
+
+    async def _pick_candidates(self):
+        hadiths = []
+        indices = set()
+        for _ in range(self.candidates):
+            hadith = await self.pick_hadith()
+            if hadith is None:
+                continue
+            index = hadith_index(hadith)
+            if index is None or index not in indices:
+                indices.add(index)
+                hadiths.append(hadith)
+        return hadiths
+
+    async def run_bucket(self, bot, minute, recipients, scheduled_at, pacer=None):
+        """Send one bucket's message to all of its recipients, optionally paced by ``pacer``"""
+        started = datetime.now(timezone.utc)
+        start_lag = (started - scheduled_at).total_seconds()
+        day = scheduled_at.date()
+
+        if self.ledger is not None:
+            try:
+                delivered = await self.ledger.delivered(day, list(recipients))
+            except Exception as e:
+                # Sending unchecked risks a repeat; skipping would lose the day's delivery.
+                logger.error(f"Could not check delivery ledger for bucket {format_minute(minute)} UTC: {e}")
+                delivered = set()
+            if delivered:
+                BROADCAST_MESSAGES.inc('duplicate', amount=len(delivered))
+                recipients = {user_id: chat_id for user_id, chat_id in recipients.items() if user_id not in delivered}
+            if not recipients:
+                return None
+
+        hadiths = await self._pick_candidates()
+        if not hadiths:
+            logger.error(f"Could not build daily hadith for bucket {format_minute(minute)} UTC, skipping {len(recipients)} users")
+            BROADCAST_MESSAGES.inc('skipped', amount=len(recipients))
+            return None
+        contents = [self.render(hadith) for hadith in hadiths]
+        indices = [hadith_index(hadith) for hadith in hadiths]
+
+        seen_pairs = set()
+        if len(hadiths) > 1:
+            seen_pairs = await run_db(get_seen_hadith_pairs, list(recipients), [i for i in indices if i is not None])
+
+        queue = collections.deque(recipients.items())
+        retry = []
+        dead = []
+        sent = 0
+        failed = 0
+
+        async def worker():
+            nonlocal sent, failed
+            while queue:
+                user_id, chat_id = queue.popleft()
+                choice = next(
+                    (n for n, index in enumerate(indices) if (user_id, index) not in seen_pairs),
+                    0
+                )
+                chunks, reply_markup = contents[choice]
+                last = len(chunks) - 1
+                if pacer is not None:
+                    await pacer.wait()
+                i = 0
+                try:
+                    for i, chunk in enumerate(chunks):
+                        await bot.send_message(
+                            chat_id=chat_id,
+                            text=chunk,
+                            parse_mode='Markdown',
+                            reply_markup=reply_markup if i == last else None,
+                            # Retries happen here, after the bucket, not in the outbox as well.
+                            rate_limit_args={'priority': BROADCAST, 'max_retries': 0}
+                        )
+                    sent += 1
+                    BROADCAST_MESSAGES.inc('sent')
+                    BROADCAST_LAG_SECONDS.observe((datetime.now(timezone.utc) - scheduled_at).total_seconds())
+                    if self.history is not None and self.history.record(user_id, hadiths[choice]):
+                        self._flush_soon(self.history)
+                    if self.ledger is not None and self.ledger.record(day, user_id):
+                        self._flush_soon(self.ledger)
+                except Exception as e:
+                    reason = classify_send_error(e)
+                    if reason in ('blocked', 'chat_not_found'):
+                        dead.append(user_id)
+                        self.pruned[reason] += 1
+                        BROADCAST_MESSAGES.inc('pruned')
+                    elif reason == 'transient' and i == 0:
+                        # Only retry when nothing reached the chat yet, so no chunk repeats.
+                        retry.append((user_id, chat_id))
+                    else:
+                        failed += 1
+                        BROADCAST_MESSAGES.inc('failed')
+                        logger.error(f"Error sending daily hadith to {chat_id}: {e}")
+
+        for attempt in range(BROADCAST_RETRIES + 1):
+            if attempt:
+                if not retry:
+                    break
+                await asyncio.sleep(BROADCAST_RETRY_DELAY)
+                BROADCAST_MESSAGES.inc('retried', amount=len(retry))
+                queue.extend(retry)
+                retry.clear()
+            workers = min(self.concurrency, len(queue))
+            await asyncio.gather(*(worker() for _ in range(workers)))
+
+        if retry:
+            failed += len(retry)
+            BROADCAST_MESSAGES.inc('failed', amount=len(retry))
+            logger.error(f"Giving up on {len(retry)} daily hadith deliveries in bucket {format_minute(minute)} UTC after {BROADCAST_RETRIES} retries")
+        if dead:
+            await self.prune(dead)
+
+        finished = datetime.now(timezone.utc)
+        duration = (finished - started).total_seconds()
+        report = {
+            'minute': minute,
+            'recipients': len(recipients),
+            'sent': sent,
+            'failed': failed,
+            'pruned': len(dead),
+            'duration': duration,
+            'throughput': sent / duration if duration > 0 else float(sent),
+            'start_lag': start_lag,
+            'end_lag': (finished - scheduled_at).total_seconds(),
+        }
+        self.reports.append(report)
+        logger.info(
+            f"Bucket {format_minute(minute)} UTC: sent {sent}/{len(recipients)}, pruned {len(dead)} "
+            f"in {duration:.1f}s ({report['throughput']:.1f} msg/s), "
+            f"lag {start_lag:.1f}s start / {report['end_lag']:.1f}s end"
+        )
+        return report
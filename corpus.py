@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import random
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+HADITH_CORPUS_MAX_ENTRIES = int(os.getenv('HADITH_CORPUS_MAX_ENTRIES', 5000))
+HADITH_CORPUS_DUMP = os.getenv('HADITH_CORPUS_DUMP')
+
+
+def hadith_book(hadith):
+    """Return the book slug a hadith belongs to"""
+    return hadith.get('bookSlug') or hadith.get('book', {}).get('bookSlug')
+
+
+def hadith_key(hadith):
+    """Return the (book, hadith number) key used to store a hadith"""
+    return (hadith_book(hadith), str(hadith.get('hadithNumber')))
+
+
+class HadithCorpus:
+    """Bounded in-memory store of hadiths keyed by book and hadith number.
+
+    Entries are evicted oldest-first once ``max_entries`` is reached.
+    """
+
+    def __init__(self, max_entries=HADITH_CORPUS_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        # Per-book list of keys plus a key -> position map, so a random pick
+        # and an eviction are both O(1).
+        self._book_keys = {}
+        self._book_positions = {}
+        # Called with each batch passed to add_many (e.g. the search index).
+        self.listeners = []
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
+
+    def get(self, book, hadith_number):
+        """Return a stored hadith or None"""
+        return self._entries.get((book, str(hadith_number)))
+
+    def add(self, hadith):
+        """Store a single hadith, evicting the oldest entries if needed"""
+        key = hadith_key(hadith)
+        if key[0] is None:
+            return
+
+        if key in self._entries:
+            self._entries[key] = hadith
+            self._entries.move_to_end(key)
+            return
+
+        self._entries[key] = hadith
+        keys = self._book_keys.setdefault(key[0], [])
+        self._book_positions.setdefault(key[0], {})[key] = len(keys)
+        keys.append(key)
+
+        while len(self._entries) > self.max_entries:
+            old_key, _ = self._entries.popitem(last=False)
+            self._forget(old_key)
+
+    def add_many(self, book, hadiths):
+        """Store a batch of hadiths for a book"""
+        for hadith in hadiths:
+            self.add(hadith)
+        for listener in self.listeners:
+            listener(hadiths)
+
+    def _forget(self, key):
+        book = key[0]
+        keys = self._book_keys[book]
+        positions = self._book_positions[book]
+        index = positions.pop(key)
+        last = keys.pop()
+        if last != key:
+            keys[index] = last
+            positions[last] = index
+        if not keys:
+            del self._book_keys[book]
+            del self._book_positions[book]
+
+    def count(self, book):
+        """Return how many hadiths are stored for a book"""
+        return len(self._book_keys.get(book, ()))
+
+    def random(self, book, exclude=None, tries=8):
+        """Return a random stored hadith from a book, or None on a miss.
+
+        ``exclude`` is an optional predicate; up to ``tries`` random picks
+        are made to find a hadith it does not reject.
+        """
+        keys = self._book_keys.get(book)
+        if not keys:
+            self.misses += 1
+            return None
+
+        for _ in range(tries if exclude else 1):
+            hadith = self._entries[random.choice(keys)]
+            if exclude is None or not exclude(hadith):
+                self.hits += 1
+                return hadith
+
+        self.misses += 1
+        return None
+
+    def import_hadiths(self, hadiths):
+        """Bulk-load hadiths from any source, grouped by book"""
+        by_book = {}
+        for hadith in hadiths:
+            book = hadith_book(hadith)
+            if book:
+                by_book.setdefault(book, []).append(hadith)
+
+        for book, items in by_book.items():
+            self.add_many(book, items)
+        return sum(len(items) for items in by_book.values())
+
+    def load_dump(self, path):
+        """Load hadiths from a JSON dump.
+
+        The file may hold a plain list of hadiths, a single API response
+        (``{"hadiths": {"data": [...]}}``) or a list of API responses.
+        """
+        with open(path, encoding='utf-8') as f:
+            payload = json.load(f)
+
+        return self.import_hadiths(iter_dump_hadiths(payload))
+
+    def stats(self):
+        """Return cache statistics"""
+        return {
+            'entries': len(self._entries),
+            'books': len(self._book_keys),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+def iter_dump_hadiths(payload):
+    """Yield hadith dicts from the shapes accepted by ``load_dump``"""
+    if isinstance(payload, dict):
+        payload = [payload]
+
+    for item in payload:
+        if isinstance(item, dict) and 'hadiths' in item:
+            yield from item['hadiths'].get('data', [])
+        else:
+            yield item
+
+
+corpus = HadithCorpus()
+
+
+def load_corpus_dump():
+    """Fill the shared corpus from HADITH_CORPUS_DUMP if it is configured"""
+    if not HADITH_CORPUS_DUMP:
+        return 0
+
+    try:
+        count = corpus.load_dump(HADITH_CORPUS_DUMP)
+        logger.info(f"Loaded {count} hadiths from {HADITH_CORPUS_DUMP}")
+        return count
+    except FileNotFoundError:
+        logger.warning(f"Hadith corpus dump {HADITH_CORPUS_DUMP} not found, starting empty")
+    except Exception as e:
+        logger.error(f"Error loading hadith corpus dump {HADITH_CORPUS_DUMP}: {e}")
+    return 0
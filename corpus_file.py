@@ -0,0 +1,219 @@
+import json
+import logging
+import mmap
+import os
+import random
+import struct
+
+from corpus import hadith_book, hadith_key
+
+logger = logging.getLogger(__name__)
+
+HADITH_CORPUS_FILE = os.getenv('HADITH_CORPUS_FILE')
+
+# Layout (little-endian):
+#   header   magic, version, book count, hadith count
+#   books    one fixed-size row per book: slug, first index, hadith count
+#   offsets  hadith count + 1 absolute offsets, one per record plus the end
+#   records  per hadith: three lengths, then metadata JSON, Arabic and English
+#            text, all UTF-8
+MAGIC = b'HDC1'
+VERSION = 1
+HEADER = struct.Struct('<4sHHI')
+BOOK_ROW = struct.Struct('<32sII')
+OFFSET = struct.Struct('<Q')
+RECORD = struct.Struct('<III')
+
+
+def _compact(hadith):
+    # Keep only the fields the bot reads; the API objects carry a lot more.
+    book = hadith.get('book') or {}
+    chapter = hadith.get('chapter') or {}
+    return {
+        'id': hadith.get('id'),
+        'hadithNumber': hadith.get('hadithNumber'),
+        'status': hadith.get('status'),
+        'bookSlug': hadith_book(hadith),
+        'book': {'bookName': book.get('bookName'), 'bookSlug': hadith_book(hadith)},
+        'chapter': {
+            'chapterNumber': chapter.get('chapterNumber'),
+            'chapterEnglish': chapter.get('chapterEnglish'),
+        },
+    }
+
+
+def write_corpus_file(path, hadiths, books=None):
+    """Write hadiths to a compact indexed corpus file; returns the hadith count.
+
+    Hadiths are grouped by book (in ``books`` order, then any others) and
+    de-duplicated by book and hadith number.
+    """
+    by_book = {book: {} for book in books or ()}
+    for hadith in hadiths:
+        key = hadith_key(hadith)
+        if key[0] is not None:
+            by_book.setdefault(key[0], {}).setdefault(key, hadith)
+
+    book_rows = []
+    records = []
+    for book, items in by_book.items():
+        if not items:
+            continue
+        book_rows.append((book, len(records), len(items)))
+        for hadith in items.values():
+            meta = json.dumps(_compact(hadith), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            arabic = (hadith.get('hadithArabic') or '').encode('utf-8')
+            english = (hadith.get('hadithEnglish') or '').encode('utf-8')
+            records.append(RECORD.pack(len(meta), len(arabic), len(english)) + meta + arabic + english)
+
+    offset = HEADER.size + BOOK_ROW.size * len(book_rows) + OFFSET.size * (len(records) + 1)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(book_rows), len(records)))
+        for book, first, count in book_rows:
+            f.write(BOOK_ROW.pack(book.encode('utf-8'), first, count))
+        for record in records:
+            f.write(OFFSET.pack(offset))
+            offset += len(record)
+        f.write(OFFSET.pack(offset))
+        for record in records:
+            f.write(record)
+    os.replace(tmp_path, path)
+    return len(records)
+
+
+class CorpusFile:
+    """Read-only, memory-mapped view of a corpus file written by ``write_corpus_file``.
+
+    Any hadith is decoded on demand by index in O(1); the text stays in the
+    page cache rather than on the Python heap. An unopened instance is
+    empty, so callers can consult it unconditionally.
+    """
+
+    def __init__(self):
+        self.path = None
+        self._file = None
+        self._map = None
+        self._count = 0
+        self._books = {}
+        self._offsets_at = 0
+        self.hits = 0
+
+    def open(self, path):
+        """Map a corpus file, replacing any file mapped before"""
+        f = open(path, 'rb')
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            f.close()
+            raise
+
+        magic, version, book_count, count = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            data.close()
+            f.close()
+            raise ValueError(f"{path} is not a version {VERSION} hadith corpus file")
+
+        books = {}
+        position = HEADER.size
+        for _ in range(book_count):
+            slug, first, size = BOOK_ROW.unpack_from(data, position)
+            books[slug.rstrip(b'\0').decode('utf-8')] = (first, size)
+            position += BOOK_ROW.size
+
+        self.close()
+        self.path = path
+        self._file = f
+        self._map = data
+        self._count = count
+        self._books = books
+        self._offsets_at = position
+        return count
+
+    def close(self):
+        """Unmap the file"""
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+        self.path = None
+        self._file = None
+        self._map = None
+        self._count = 0
+        self._books = {}
+
+    def __len__(self):
+        return self._count
+
+    def books(self):
+        """Return the books in the file with their hadith counts"""
+        return {book: count for book, (_, count) in self._books.items()}
+
+    def count(self, book):
+        """Return how many hadiths the file holds for a book"""
+        return self._books.get(book, (0, 0))[1]
+
+    def get(self, index):
+        """Decode the hadith stored at ``index``"""
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+
+        data = self._map
+        start, = OFFSET.unpack_from(data, self._offsets_at + index * OFFSET.size)
+        meta_len, arabic_len, english_len = RECORD.unpack_from(data, start)
+        position = start + RECORD.size
+        hadith = json.loads(data[position:position + meta_len])
+        position += meta_len
+        hadith['hadithArabic'] = data[position:position + arabic_len].decode('utf-8')
+        position += arabic_len
+        hadith['hadithEnglish'] = data[position:position + english_len].decode('utf-8')
+        return hadith
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self.get(index)
+
+    def random(self, book, exclude=None, tries=8):
+        """Return a random hadith from a book, or None if the book is not in the file.
+
+        ``exclude`` is an optional predicate; up to ``tries`` picks are made
+        to find a hadith it does not reject before settling for the last.
+        """
+        first, count = self._books.get(book, (0, 0))
+        if not count:
+            return None
+
+        for _ in range(tries if exclude else 1):
+            hadith = self.get(first + random.randrange(count))
+            if exclude is None or not exclude(hadith):
+                break
+        self.hits += 1
+        return hadith
+
+    def stats(self):
+        """Return file statistics"""
+        return {
+            'path': self.path,
+            'hadiths': self._count,
+            'books': len(self._books),
+            'bytes': len(self._map) if self._map is not None else 0,
+            'hits': self.hits,
+        }
+
+
+corpus_file = CorpusFile()
+
+
+def open_corpus_file():
+    """Map HADITH_CORPUS_FILE into the shared corpus file if it is configured"""
+    if not HADITH_CORPUS_FILE:
+        return 0
+
+    try:
+        count = corpus_file.open(HADITH_CORPUS_FILE)
+        logger.info(f"Mapped {count} hadiths from {HADITH_CORPUS_FILE}")
+        return count
+    except FileNotFoundError:
+        logger.warning(f"Hadith corpus file {HADITH_CORPUS_FILE} not found, using the API")
+    except Exception as e:
+        logger.error(f"Error opening hadith corpus file {HADITH_CORPUS_FILE}: {e}")
+    return 0
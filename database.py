@@ -1,180 +1,1106 @@
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+import asyncio
+import collections
 import logging
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
+from metrics import DB_CALL_SECONDS, DB_ERRORS
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv('DATABASE_URL')
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 5))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv('DB_POOL_HEALTHCHECK_INTERVAL', 30))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 300))
+USER_WRITE_FLUSH_INTERVAL = float(os.getenv('USER_WRITE_FLUSH_INTERVAL', 5))
+USER_WRITE_MAX_PENDING = int(os.getenv('USER_WRITE_MAX_PENDING', 500))
 
 def get_db_connection():
-    """Get database connection"""
+    """Open a new database connection"""
     return psycopg2.connect(DATABASE_URL)
 
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes free in time"""
+
+class ConnectionPool:
+    """Fixed-size, thread-safe pool of DB-API connections.
+
+    ``connect`` is any callable returning a DB-API connection, so the pool
+    can be exercised against a local Postgres or ``sqlite3.connect``.
+    Connections idle for longer than ``healthcheck_interval`` are probed
+    with ``SELECT 1`` before being handed out and replaced if dead.
+    """
+
+    def __init__(self, connect, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                 timeout=DB_POOL_TIMEOUT, healthcheck_interval=DB_POOL_HEALTHCHECK_INTERVAL):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._idle = collections.deque()
+        self._cond = threading.Condition()
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+        self._stats = {
+            'connections_opened': 0,
+            'connections_closed': 0,
+            'acquisitions': 0,
+            'timeouts': 0,
+            'healthcheck_failures': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+        }
+
+    def open(self):
+        """Pre-open ``min_size`` connections"""
+        for _ in range(self.min_size):
+            conn = self.acquire()
+            self.release(conn)
+
+    def acquire(self):
+        """Take a connection, waiting up to ``timeout`` seconds for one to free up"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        conn = None
+        last_used = None
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f"No database connection available after {self.timeout}s")
+                self._cond.wait(remaining)
+
+            self._in_use += 1
+            waited = time.monotonic() - started
+            self._stats['acquisitions'] += 1
+            self._stats['wait_seconds_total'] += waited
+            self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], waited)
+
+        try:
+            if conn is not None and time.monotonic() - last_used > self.healthcheck_interval:
+                if not self._is_healthy(conn):
+                    with self._cond:
+                        self._stats['healthcheck_failures'] += 1
+                    self._close(conn)
+                    conn = None
+            if conn is None:
+                conn = self._connect()
+                with self._cond:
+                    self._stats['connections_opened'] += 1
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def release(self, conn, discard=False):
+        """Return a connection to the pool, closing it if it is broken"""
+        if not discard and not getattr(conn, 'closed', 0):
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+
+        if discard or getattr(conn, 'closed', 0):
+            self._close(conn)
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            return
+
+        with self._cond:
+            self._in_use -= 1
+            if self._closed:
+                self._size -= 1
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager yielding a pooled connection"""
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def close(self):
+        """Close every idle connection and refuse new acquisitions"""
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def _is_healthy(self, conn):
+        if getattr(conn, 'closed', 0):
+            return False
+        try:
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            finally:
+                cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._stats['connections_closed'] += 1
+
+    def stats(self):
+        """Return pool metrics: sizes, acquisitions and wait times"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(size=self._size, in_use=self._in_use, idle=len(self._idle), max_size=self.max_size)
+        return stats
+
+_pool = None
+_pool_lock = threading.Lock()
+_db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX_SIZE, thread_name_prefix='db')
+
+def get_pool():
+    """Return the shared connection pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(get_db_connection)
+    return _pool
+
+def db_connection():
+    """Context manager yielding a connection from the shared pool"""
+    return get_pool().connection()
+
+def pool_stats():
+    """Return metrics for the shared connection pool"""
+    return get_pool().stats()
+
+def ping_database():
+    """Run a trivial query on a pooled connection; raises if the database is unreachable"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        cur.close()
+    return True
+
+def close_pool():
+    """Close the shared connection pool"""
+    if _pool is not None:
+        _pool.close()
+
+def _timed_call(func, args, kwargs):
+    name = getattr(func, '__name__', 'call')
+    started = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        DB_ERRORS.inc(name)
+        raise
+    finally:
+        DB_CALL_SECONDS.observe(time.perf_counter() - started, name)
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database function on the DB thread pool and await it"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, _timed_call, func, args, kwargs)
+
 def init_database():
     """Initialize database tables"""
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id BIGINT PRIMARY KEY,
+                    chat_id BIGINT NOT NULL,
+                    username VARCHAR(255),
+                    first_name VARCHAR(255),
+                    last_name VARCHAR(255),
+                    timezone VARCHAR(100) DEFAULT 'Europe/Rome',
+                    daily_hadith_enabled BOOLEAN DEFAULT FALSE,
+                    daily_hadith_time TIME,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+        
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS hadith_history (
+                    id SERIAL PRIMARY KEY,
+                    user_id BIGINT REFERENCES users(user_id),
+                    hadith_number VARCHAR(50),
+                    book_name VARCHAR(255),
+                    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            cur.execute("""
+                ALTER TABLE users ADD COLUMN IF NOT EXISTS delivery_minute_utc SMALLINT
+            """)
+            
+            cur.execute("""
+                ALTER TABLE hadith_history ADD COLUMN IF NOT EXISTS hadith_id INTEGER
+            """)
+            
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_hadith_history_user_hadith
+                ON hadith_history (user_id, hadith_id)
+            """)
+            
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_users_delivery_minute
+                ON users (delivery_minute_utc)
+                WHERE daily_hadith_enabled = TRUE
+            """)
+            
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS bot_workers (
+                    worker_id VARCHAR(255) PRIMARY KEY,
+                    heartbeat_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                )
+            """)
+            
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS broadcast_claims (
+                    bucket_date DATE NOT NULL,
+                    minute SMALLINT NOT NULL,
+                    shard SMALLINT NOT NULL,
+                    worker_id VARCHAR(255) NOT NULL,
+                    claimed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (bucket_date, minute, shard)
+                )
+            """)
+            
+            # done marks delivered claims; a NULL worker_id marks a released one.
+            cur.execute("""
+                ALTER TABLE broadcast_claims ADD COLUMN IF NOT EXISTS done BOOLEAN NOT NULL DEFAULT FALSE
+            """)
+            
+            cur.execute("""
+                ALTER TABLE broadcast_claims ALTER COLUMN worker_id DROP NOT NULL
+            """)
+            
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_broadcast_claims_pending
+                ON broadcast_claims (shard)
+                WHERE NOT done
+            """)
+            
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS daily_deliveries (
+                    delivery_date DATE NOT NULL,
+                    user_id BIGINT NOT NULL,
+                    PRIMARY KEY (delivery_date, user_id)
+                )
+            """)
+            
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS bot_persistence (
+                    kind VARCHAR(64) NOT NULL,
+                    key VARCHAR(255) NOT NULL,
+                    data JSONB NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (kind, key)
+                )
+            """)
+            
+            cur.execute("""
+                UPDATE users
+                SET delivery_minute_utc = (
+                    EXTRACT(HOUR FROM utc_time) * 60 + EXTRACT(MINUTE FROM utc_time)
+                )::SMALLINT
+                FROM (
+                    SELECT user_id, ((CURRENT_DATE + daily_hadith_time)
+                        AT TIME ZONE COALESCE(timezone, 'Europe/Rome')) AT TIME ZONE 'UTC' AS utc_time
+                    FROM users
+                    WHERE daily_hadith_enabled = TRUE
+                      AND daily_hadith_time IS NOT NULL
+                      AND delivery_minute_utc IS NULL
+                ) AS pending
+                WHERE users.user_id = pending.user_id
+            """)
+            if cur.rowcount:
+                logger.info(f"Backfilled delivery minute for {cur.rowcount} users")
+        
+            conn.commit()
+            logger.info("Database tables initialized successfully")
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error initializing database: {e}")
+        finally:
+            cur.close()
+
+_MISSING = object()
+
+class UserCache:
+    """Thread-safe LRU cache of user rows with a per-entry TTL.
+
+    A cached ``None`` records that the user does not exist yet.
+    """
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """Return a copy of the cached row, None for a known-missing user, or _MISSING"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return _MISSING
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            row = entry[1]
+            return dict(row) if row is not None else None
+
+    def set(self, user_id, row):
+        """Cache a row (or None for a missing user)"""
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, dict(row) if row is not None else None)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def update(self, user_id, **fields):
+        """Merge fields into a cached row; drops the entry if there is no full row to merge into"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            if entry[1] is None:
+                del self._entries[user_id]
+                return
+            entry[1].update(fields)
+
+    def invalidate(self, user_id):
+        """Forget a cached user"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        """Return hit/miss counters and size"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+user_cache = UserCache()
+
+def user_cache_stats():
+    """Return hit/miss counters for the user cache"""
+    return user_cache.stats()
+
+class UserWriteBuffer:
+    """Write-behind buffer for user upserts and last-interaction timestamps.
+
+    Repeated writes for the same user are coalesced in memory and flushed
+    in one batched statement per kind, either by the periodic flush job or
+    once ``max_pending`` users are waiting. Reads and settings updates for
+    a user with a pending upsert flush first so they never miss the row.
+    """
+
+    def __init__(self, max_pending=USER_WRITE_MAX_PENDING):
+        self.max_pending = max_pending
+        self._upserts = {}
+        self._touches = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def save(self, user_id, chat_id, username=None, first_name=None, last_name=None):
+        """Queue a user upsert; returns True once the buffer should be flushed"""
+        now = datetime.now()
+        user_cache.update(
+            user_id,
+            chat_id=chat_id,
+            username=username,
+            first_name=first_name,
+            last_name=last_name,
+            last_interaction=now
+        )
+        with self._lock:
+            self._upserts[user_id] = (user_id, chat_id, username, first_name, last_name, now)
+            self._touches.pop(user_id, None)
+            self.stats['buffered_upserts'] += 1
+            return self._pending() >= self.max_pending
+
+    def touch(self, user_id):
+        """Queue a last_interaction update; returns True once the buffer should be flushed"""
+        now = datetime.now()
+        with self._lock:
+            pending = self._upserts.get(user_id)
+            if pending is not None:
+                self._upserts[user_id] = pending[:5] + (now,)
+            else:
+                self._touches[user_id] = now
+            self.stats['buffered_touches'] += 1
+            return self._pending() >= self.max_pending
+
+    def _pending(self):
+        return len(self._upserts) + len(self._touches)
+
+    def pending(self):
+        """Return how many users have buffered writes"""
+        with self._lock:
+            return self._pending()
+
+    def has_pending_upsert(self, user_id):
+        """Return True if an upsert for the user has not been written yet"""
+        return user_id in self._upserts
+
+    def flush(self):
+        """Write every buffered change; returns (upserts, touches) written"""
+        with self._flush_lock:
+            with self._lock:
+                upserts, self._upserts = self._upserts, {}
+                touches, self._touches = self._touches, {}
+
+            if not upserts and not touches:
+                return 0, 0
+
+            with db_connection() as conn:
+                cur = conn.cursor()
+                
+                try:
+                    if upserts:
+                        execute_values(cur, """
+                            INSERT INTO users (user_id, chat_id, username, first_name, last_name, last_interaction)
+                            VALUES %s
+                            ON CONFLICT (user_id)
+                            DO UPDATE SET
+                                chat_id = EXCLUDED.chat_id,
+                                username = EXCLUDED.username,
+                                first_name = EXCLUDED.first_name,
+                                last_name = EXCLUDED.last_name,
+                                last_interaction = EXCLUDED.last_interaction
+                        """, list(upserts.values()), page_size=1000)
+                    
+                    if touches:
+                        execute_values(cur, """
+                            UPDATE users
+                            SET last_interaction = pending.last_interaction
+                            FROM (VALUES %s) AS pending (user_id, last_interaction)
+                            WHERE users.user_id = pending.user_id
+                        """, list(touches.items()), page_size=1000)
+                    
+                    conn.commit()
+                    self.stats['flushed_upserts'] += len(upserts)
+                    self.stats['flushed_touches'] += len(touches)
+                    self.stats['flushes'] += 1
+                    logger.info(f"Flushed {len(upserts)} user upserts and {len(touches)} interaction updates")
+                    return len(upserts), len(touches)
+                except Exception as e:
+                    conn.rollback()
+                    self._requeue(upserts, touches)
+                    logger.error(f"Error flushing buffered user writes: {e}")
+                    return 0, 0
+                finally:
+                    cur.close()
+
+    def _requeue(self, upserts, touches):
+        # Keep anything written to the buffer since the failed flush began.
+        with self._lock:
+            for user_id, row in upserts.items():
+                self._upserts.setdefault(user_id, row)
+            for user_id, touched_at in touches.items():
+                if user_id not in self._upserts:
+                    self._touches.setdefault(user_id, touched_at)
+
+    def flush_for(self, user_id):
+        """Flush if the user has a buffered upsert, so the row exists for a read or update"""
+        if self.has_pending_upsert(user_id):
+            self.flush()
+
+user_writes = UserWriteBuffer()
+
+def get_user(user_id):
+    """Get user from the cache, falling back to the database"""
+    cached = user_cache.get(user_id)
+    if cached is not _MISSING:
+        return cached
     
-    try:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                chat_id BIGINT NOT NULL,
-                username VARCHAR(255),
-                first_name VARCHAR(255),
-                last_name VARCHAR(255),
-                timezone VARCHAR(100) DEFAULT 'Europe/Rome',
-                daily_hadith_enabled BOOLEAN DEFAULT FALSE,
-                daily_hadith_time TIME,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    user_writes.flush_for(user_id)
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        
+        try:
+            cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
+            user = cur.fetchone()
+            user = dict(user) if user else None
+            user_cache.set(user_id, user)
+            return user
+        except Exception as e:
+            logger.error(f"Error fetching user {user_id}: {e}")
+            return None
+        finally:
+            cur.close()
+
+def update_daily_hadith_settings(user_id, enabled, time_str=None, delivery_minute=None):
+    """Update user's daily hadith settings and normalized UTC delivery minute"""
+    user_writes.flush_for(user_id)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            cur.execute("""
+                UPDATE users 
+                SET daily_hadith_enabled = %s, daily_hadith_time = %s, delivery_minute_utc = %s
+                WHERE user_id = %s
+            """, (enabled, time_str, delivery_minute, user_id))
+        
+            conn.commit()
+            user_cache.update(
+                user_id,
+                daily_hadith_enabled=enabled,
+                daily_hadith_time=datetime.strptime(time_str, '%H:%M').time() if time_str else None,
+                delivery_minute_utc=delivery_minute
             )
-        """)
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS hadith_history (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id),
-                hadith_number VARCHAR(50),
-                book_name VARCHAR(255),
-                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            logger.info(f"Daily hadith settings updated for user {user_id}")
+        except Exception as e:
+            conn.rollback()
+            user_cache.invalidate(user_id)
+            logger.error(f"Error updating daily hadith settings for {user_id}: {e}")
+        finally:
+            cur.close()
+
+def disable_daily_hadith_subscriptions(user_ids):
+    """Turn off daily hadith for many users at once (e.g. chats that blocked the bot)"""
+    if not user_ids:
+        return 0
+    
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            cur.execute("""
+                UPDATE users
+                SET daily_hadith_enabled = FALSE
+                WHERE user_id = ANY(%s) AND daily_hadith_enabled = TRUE
+            """, (list(user_ids),))
+            
+            conn.commit()
+            for user_id in user_ids:
+                user_cache.update(user_id, daily_hadith_enabled=False)
+            return cur.rowcount
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error disabling daily hadith for {len(user_ids)} users: {e}")
+            raise
+        finally:
+            cur.close()
+
+def iter_daily_hadith_subscriptions(minutes=None, batch_size=10000, shards=None):
+    """Stream (user_id, chat_id, delivery_minute_utc, timezone) for enabled users.
+
+    Uses a server-side cursor so rows are fetched in batches instead of
+    materializing the whole subscriber table in memory. ``minutes`` limits
+    the scan to the given UTC delivery minutes, and ``shards`` (a
+    ``(shard_count, shard_ids)`` pair) to users with ``user_id % shard_count``
+    in ``shard_ids``. Query errors propagate, so callers never mistake a
+    failed read for a minute without subscribers.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor(name='daily_hadith_subscriptions')
+        cur.itersize = batch_size
+        
+        try:
+            query = """
+                SELECT user_id, chat_id, delivery_minute_utc, timezone
+                FROM users
+                WHERE daily_hadith_enabled = TRUE
+            """
+            params = []
+            if minutes is None:
+                query += " AND delivery_minute_utc IS NOT NULL"
+            else:
+                query += " AND delivery_minute_utc = ANY(%s)"
+                params.append(list(minutes))
+            if shards is not None:
+                query += " AND (user_id %% %s) = ANY(%s)"
+                params.extend([shards[0], list(shards[1])])
+            cur.execute(query, params)
+            yield from cur
+        except Exception as e:
+            logger.error(f"Error streaming daily hadith subscriptions: {e}")
+            raise
+        finally:
+            cur.close()
+
+def record_worker_heartbeat(worker_id, ttl):
+    """Refresh a worker's heartbeat and return the ids of every live worker.
+
+    Workers silent for longer than ``ttl`` seconds are removed.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            cur.execute("""
+                INSERT INTO bot_workers (worker_id, heartbeat_at)
+                VALUES (%s, NOW())
+                ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = EXCLUDED.heartbeat_at
+            """, (worker_id,))
+            cur.execute("""
+                DELETE FROM bot_workers
+                WHERE heartbeat_at < NOW() - make_interval(secs => %s)
+            """, (ttl,))
+            cur.execute("SELECT worker_id FROM bot_workers ORDER BY worker_id")
+            workers = [row[0] for row in cur.fetchall()]
+            conn.commit()
+            return workers
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error recording heartbeat for worker {worker_id}: {e}")
+            raise
+        finally:
+            cur.close()
+
+def remove_worker(worker_id):
+    """Drop a worker's heartbeat so the others take over its shards at once"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            cur.execute("DELETE FROM bot_workers WHERE worker_id = %s", (worker_id,))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error removing worker {worker_id}: {e}")
+        finally:
+            cur.close()
+
+def claim_broadcast_shards(worker_id, claims):
+    """Claim (bucket_date, minute, shard) deliveries; returns the ones this call won.
+
+    A delivery can only be claimed once, so two workers that briefly
+    disagree about shard ownership never both send it.
+    """
+    if not claims:
+        return []
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            rows = execute_values(cur, """
+                INSERT INTO broadcast_claims (bucket_date, minute, shard, worker_id)
+                VALUES %s
+                ON CONFLICT DO NOTHING
+                RETURNING bucket_date, minute, shard
+            """, [(day, minute, shard, worker_id) for day, minute, shard in claims],
+                template='(%s::date, %s::smallint, %s::smallint, %s)', fetch=True)
+            conn.commit()
+            return [tuple(row) for row in rows]
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error claiming broadcast shards: {e}")
+            raise
+        finally:
+            cur.close()
+
+def reclaim_broadcast_shards(worker_id, shards, since):
+    """Take over unfinished claims on ``shards`` due since ``since``; returns the ones taken.
+
+    A claim is unfinished when it was not marked done and its worker
+    released it or stopped heartbeating, e.g. it crashed mid-bucket.
+    """
+    if not shards:
+        return []
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            cur.execute("""
+                UPDATE broadcast_claims AS claims
+                SET worker_id = %s, claimed_at = NOW()
+                WHERE NOT claims.done
+                  AND claims.shard = ANY(%s)
+                  AND (claims.bucket_date + make_interval(mins => claims.minute)) AT TIME ZONE 'UTC' >= %s
+                  AND (claims.worker_id IS NULL OR NOT EXISTS (
+                      SELECT 1 FROM bot_workers WHERE bot_workers.worker_id = claims.worker_id
+                  ))
+                RETURNING claims.bucket_date, claims.minute, claims.shard
+            """, (worker_id, list(shards), since))
+            rows = [tuple(row) for row in cur.fetchall()]
+            conn.commit()
+            return rows
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error reclaiming broadcast shards: {e}")
+            raise
+        finally:
+            cur.close()
+
+def finish_broadcast_shards(worker_id, claims, done):
+    """Mark this worker's (bucket_date, minute, shard) claims done, or release them for another attempt"""
+    if not claims:
+        return 0
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            execute_values(cur, f"""
+                UPDATE broadcast_claims AS claims
+                SET {'done = TRUE' if done else 'worker_id = NULL'}
+                FROM (VALUES %s) AS finished (bucket_date, minute, shard, worker_id)
+                WHERE claims.bucket_date = finished.bucket_date
+                  AND claims.minute = finished.minute
+                  AND claims.shard = finished.shard
+                  AND claims.worker_id = finished.worker_id
+            """, [(day, minute, shard, worker_id) for day, minute, shard in claims],
+                template='(%s::date, %s::smallint, %s::smallint, %s)', page_size=1000)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error finishing broadcast claims: {e}")
+            raise
+        finally:
+            cur.close()
+
+def prune_broadcast_claims(keep_days=2):
+    """Delete broadcast claims older than ``keep_days``"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            cur.execute(
+                "DELETE FROM broadcast_claims WHERE bucket_date < CURRENT_DATE - %s",
+                (keep_days,)
             )
-        """)
+            conn.commit()
+            return cur.rowcount
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error pruning broadcast claims: {e}")
+            return 0
+        finally:
+            cur.close()
+
+def save_daily_deliveries(rows):
+    """Record (delivery_date, user_id) daily deliveries in one batch"""
+    with db_connection() as conn:
+        cur = conn.cursor()
         
-        conn.commit()
-        logger.info("Database tables initialized successfully")
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error initializing database: {e}")
-    finally:
-        cur.close()
-        conn.close()
+        try:
+            execute_values(cur, """
+                INSERT INTO daily_deliveries (delivery_date, user_id)
+                VALUES %s
+                ON CONFLICT DO NOTHING
+            """, rows, page_size=1000)
+            
+            conn.commit()
+            return len(rows)
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error saving daily deliveries: {e}")
+            raise
+        finally:
+            cur.close()
 
-def save_user(user_id, chat_id, username=None, first_name=None, last_name=None):
-    """Save or update user in database"""
-    conn = get_db_connection()
-    cur = conn.cursor()
+def get_delivered_users(delivery_date, user_ids):
+    """Return the users among ``user_ids`` whose delivery for the date is recorded"""
+    if not user_ids:
+        return set()
     
-    try:
-        cur.execute("""
-            INSERT INTO users (user_id, chat_id, username, first_name, last_name, last_interaction)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            ON CONFLICT (user_id) 
-            DO UPDATE SET 
-                chat_id = EXCLUDED.chat_id,
-                username = EXCLUDED.username,
-                first_name = EXCLUDED.first_name,
-                last_name = EXCLUDED.last_name,
-                last_interaction = EXCLUDED.last_interaction
-        """, (user_id, chat_id, username, first_name, last_name, datetime.now()))
-        
-        conn.commit()
-        logger.info(f"User {user_id} saved/updated")
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error saving user {user_id}: {e}")
-    finally:
-        cur.close()
-        conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            cur.execute("""
+                SELECT user_id
+                FROM daily_deliveries
+                WHERE delivery_date = %s AND user_id = ANY(%s)
+            """, (delivery_date, list(user_ids)))
+            return {row[0] for row in cur.fetchall()}
+        except Exception as e:
+            logger.error(f"Error checking daily deliveries: {e}")
+            raise
+        finally:
+            cur.close()
 
-def get_user(user_id):
-    """Get user from database"""
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    try:
-        cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-        user = cur.fetchone()
-        return dict(user) if user else None
-    except Exception as e:
-        logger.error(f"Error fetching user {user_id}: {e}")
-        return None
-    finally:
-        cur.close()
-        conn.close()
+def prune_daily_deliveries(keep_days=7):
+    """Delete daily delivery records older than ``keep_days``"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            cur.execute(
+                "DELETE FROM daily_deliveries WHERE delivery_date < CURRENT_DATE - %s",
+                (keep_days,)
+            )
+            conn.commit()
+            return cur.rowcount
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error pruning daily deliveries: {e}")
+            return 0
+        finally:
+            cur.close()
+
+def load_persistence(kind, max_age_days=None):
+    """Return the (key, data) rows stored for one kind of bot state.
+
+    ``max_age_days`` skips rows not written for that long.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            query = "SELECT key, data FROM bot_persistence WHERE kind = %s"
+            params = [kind]
+            if max_age_days is not None:
+                query += " AND updated_at > NOW() - make_interval(days => %s)"
+                params.append(max_age_days)
+            cur.execute(query, params)
+            return cur.fetchall()
+        except Exception as e:
+            logger.error(f"Error loading persisted {kind} data: {e}")
+            raise
+        finally:
+            cur.close()
 
-def update_daily_hadith_settings(user_id, enabled, time_str=None):
-    """Update user's daily hadith settings"""
-    conn = get_db_connection()
-    cur = conn.cursor()
+def save_persistence(upserts, deletes):
+    """Write (kind, key, json) rows and delete (kind, key) rows in one transaction"""
+    if not upserts and not deletes:
+        return
     
-    try:
-        cur.execute("""
-            UPDATE users 
-            SET daily_hadith_enabled = %s, daily_hadith_time = %s
-            WHERE user_id = %s
-        """, (enabled, time_str, user_id))
-        
-        conn.commit()
-        logger.info(f"Daily hadith settings updated for user {user_id}")
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error updating daily hadith settings for {user_id}: {e}")
-    finally:
-        cur.close()
-        conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            if upserts:
+                execute_values(cur, """
+                    INSERT INTO bot_persistence (kind, key, data, updated_at)
+                    VALUES %s
+                    ON CONFLICT (kind, key) DO UPDATE
+                    SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+                """, upserts, template="(%s, %s, %s::JSONB, NOW())", page_size=1000)
+            if deletes:
+                execute_values(cur, """
+                    DELETE FROM bot_persistence
+                    WHERE (kind, key) IN (VALUES %s)
+                """, deletes, page_size=1000)
+            
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error saving persisted bot state: {e}")
+            raise
+        finally:
+            cur.close()
 
-def get_all_daily_hadith_users():
-    """Get all users with daily hadith enabled"""
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+def save_hadith_history_batch(rows):
+    """Insert (user_id, hadith_id, hadith_number, book_name) history rows in one statement.
+
+    Rows for users that do not exist in ``users`` are skipped instead of
+    failing the whole batch on the foreign key.
+    """
+    if not rows:
+        return 0
     
-    try:
-        cur.execute("""
-            SELECT user_id, chat_id, daily_hadith_time, timezone 
-            FROM users 
-            WHERE daily_hadith_enabled = TRUE
-        """)
-        users = cur.fetchall()
-        return [dict(user) for user in users]
-    except Exception as e:
-        logger.error(f"Error fetching daily hadith users: {e}")
-        return []
-    finally:
-        cur.close()
-        conn.close()
+    if any(user_writes.has_pending_upsert(row[0]) for row in rows):
+        user_writes.flush()
+    
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            execute_values(cur, """
+                INSERT INTO hadith_history (user_id, hadith_id, hadith_number, book_name)
+                SELECT pending.user_id, pending.hadith_id, pending.hadith_number, pending.book_name
+                FROM (VALUES %s) AS pending (user_id, hadith_id, hadith_number, book_name)
+                WHERE EXISTS (SELECT 1 FROM users WHERE users.user_id = pending.user_id)
+            """, rows, template="(%s::BIGINT, %s::INTEGER, %s::VARCHAR, %s::VARCHAR)", page_size=1000)
+            
+            conn.commit()
+            return len(rows)
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error saving hadith history: {e}")
+            raise
+        finally:
+            cur.close()
 
-def save_hadith_history(user_id, hadith_number, book_name):
-    """Save hadith to user's history"""
-    conn = get_db_connection()
-    cur = conn.cursor()
+def get_seen_hadith_ids(user_id):
+    """Return every hadith id already sent to a user"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            cur.execute("""
+                SELECT DISTINCT hadith_id
+                FROM hadith_history
+                WHERE user_id = %s AND hadith_id IS NOT NULL
+            """, (user_id,))
+            return [row[0] for row in cur.fetchall()]
+        except Exception as e:
+            logger.error(f"Error fetching hadith history for {user_id}: {e}")
+            return []
+        finally:
+            cur.close()
+
+def get_seen_hadith_pairs(user_ids, hadith_ids):
+    """Return the (user_id, hadith_id) pairs among the given users and hadiths that were already sent"""
+    if not user_ids or not hadith_ids:
+        return set()
     
-    try:
-        cur.execute("""
-            INSERT INTO hadith_history (user_id, hadith_number, book_name)
-            VALUES (%s, %s, %s)
-        """, (user_id, hadith_number, book_name))
-        
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error saving hadith history: {e}")
-    finally:
-        cur.close()
-        conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            cur.execute("""
+                SELECT DISTINCT user_id, hadith_id
+                FROM hadith_history
+                WHERE user_id = ANY(%s) AND hadith_id = ANY(%s)
+            """, (list(user_ids), list(hadith_ids)))
+            return set(cur.fetchall())
+        except Exception as e:
+            logger.error(f"Error checking hadith history: {e}")
+            return set()
+        finally:
+            cur.close()
+
+def update_user_timezone(user_id, timezone_str, delivery_minute=None):
+    """Update user's timezone, and their UTC delivery minute if one is given"""
+    user_writes.flush_for(user_id)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            cur.execute("""
+                UPDATE users 
+                SET timezone = %s,
+                    delivery_minute_utc = COALESCE(%s, delivery_minute_utc)
+                WHERE user_id = %s
+            """, (timezone_str, delivery_minute, user_id))
+        
+            conn.commit()
+            user_cache.update(user_id, timezone=timezone_str)
+            if delivery_minute is not None:
+                user_cache.update(user_id, delivery_minute_utc=delivery_minute)
+            logger.info(f"Timezone updated for user {user_id}: {timezone_str}")
+        except Exception as e:
+            conn.rollback()
+            user_cache.invalidate(user_id)
+            logger.error(f"Error updating timezone for {user_id}: {e}")
+        finally:
+            cur.close()
 
-def update_user_timezone(user_id, timezone_str):
-    """Update user's timezone"""
-    conn = get_db_connection()
-    cur = conn.cursor()
+def get_subscriber_timezones():
+    """Return the distinct timezones of users with daily hadith enabled"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            cur.execute("""
+                SELECT DISTINCT COALESCE(timezone, 'Europe/Rome')
+                FROM users
+                WHERE daily_hadith_enabled = TRUE AND daily_hadith_time IS NOT NULL
+            """)
+            return [row[0] for row in cur.fetchall()]
+        except Exception as e:
+            logger.error(f"Error fetching subscriber timezones: {e}")
+            return []
+        finally:
+            cur.close()
+
+def rebucket_daily_hadith_subscriptions(offsets):
+    """Recompute delivery_minute_utc for every subscriber in the given zones.
+
+    ``offsets`` maps a timezone name to its current UTC offset in minutes.
+    One statement moves every affected user, and only users whose minute
+    actually changes are written. Returns their (user_id, chat_id,
+    delivery_minute_utc, timezone) rows.
+    """
+    if not offsets:
+        return []
     
-    try:
-        cur.execute("""
-            UPDATE users 
-            SET timezone = %s
-            WHERE user_id = %s
-        """, (timezone_str, user_id))
-        
-        conn.commit()
-        logger.info(f"Timezone updated for user {user_id}: {timezone_str}")
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error updating timezone for {user_id}: {e}")
-    finally:
-        cur.close()
-        conn.close()
\ No newline at end of file
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        try:
+            rows = execute_values(cur, """
+                UPDATE users
+                SET delivery_minute_utc = moved.minute
+                FROM (
+                    SELECT users.user_id, ((
+                        (EXTRACT(HOUR FROM users.daily_hadith_time) * 60
+                            + EXTRACT(MINUTE FROM users.daily_hadith_time))::INTEGER
+                        - zones.offset_minutes + 1440) %% 1440)::SMALLINT AS minute
+                    FROM users
+                    JOIN (VALUES %s) AS zones (timezone, offset_minutes)
+                      ON COALESCE(users.timezone, 'Europe/Rome') = zones.timezone
+                    WHERE users.daily_hadith_enabled = TRUE
+                      AND users.daily_hadith_time IS NOT NULL
+                ) AS moved
+                WHERE users.user_id = moved.user_id
+                  AND users.delivery_minute_utc IS DISTINCT FROM moved.minute
+                RETURNING users.user_id, users.chat_id, users.delivery_minute_utc, users.timezone
+            """, list(offsets.items()), template="(%s::VARCHAR, %s::INTEGER)", page_size=len(offsets), fetch=True)
+            
+            conn.commit()
+            for row in rows:
+                user_cache.invalidate(row[0])
+            return rows
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error rebucketing daily hadith subscriptions: {e}")
+            raise
+        finally:
+            cur.close()
\ No newline at end of file
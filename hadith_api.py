@@ -0,0 +1,437 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import OrderedDict
+
+import httpx
+
+from corpus import corpus
+from corpus_file import corpus_file
+from metrics import API_REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+HADITH_API_KEY = os.getenv('HADITH_API_KEY')
+HADITH_API_BASE = os.getenv('HADITH_API_BASE', "https://hadithapi.com/api")
+
+HADITH_API_MAX_CONNECTIONS = int(os.getenv('HADITH_API_MAX_CONNECTIONS', 10))
+HADITH_API_ATTEMPT_TIMEOUT = float(os.getenv('HADITH_API_ATTEMPT_TIMEOUT', 10))
+HADITH_API_TOTAL_TIMEOUT = float(os.getenv('HADITH_API_TOTAL_TIMEOUT', 20))
+HADITH_API_BREAKER_FAILURES = int(os.getenv('HADITH_API_BREAKER_FAILURES', 3))
+HADITH_API_BREAKER_COOLDOWN = float(os.getenv('HADITH_API_BREAKER_COOLDOWN', 30))
+HADITH_API_BREAKER_MAX_COOLDOWN = float(os.getenv('HADITH_API_BREAKER_MAX_COOLDOWN', 600))
+HADITH_SAMPLE_PAGE_SIZE = int(os.getenv('HADITH_SAMPLE_PAGE_SIZE', 1))
+HADITH_SAMPLE_REDRAWS = int(os.getenv('HADITH_SAMPLE_REDRAWS', 3))
+HADITH_SAMPLE_FETCH_RATE = float(os.getenv('HADITH_SAMPLE_FETCH_RATE', 0.1))
+HADITH_PAGE_CACHE_SIZE = int(os.getenv('HADITH_PAGE_CACHE_SIZE', 4096))
+HADITH_TOTALS_TTL = float(os.getenv('HADITH_TOTALS_TTL', 24 * 60 * 60))
+
+BOOKS = [
+    "sahih-bukhari",
+    "sahih-muslim",
+    "al-tirmidhi",
+    "abu-dawood",
+    "ibn-e-majah",
+    "sunan-nasai"
+]
+
+_client = None
+_semaphore = None
+_inflight = {}
+_background = set()
+
+
+class BookNotFound(Exception):
+    """Raised when the API answers 404 for a book"""
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling the API for a book whose circuit is open"""
+
+
+class CircuitBreaker:
+    """Tracks consecutive API failures for one book.
+
+    After ``failures`` consecutive errors the circuit opens and requests
+    fail fast for ``cooldown`` seconds. The first request after that is let
+    through as a probe (half-open): success closes the circuit, failure
+    opens it again with the cooldown doubled up to ``max_cooldown``.
+    """
+
+    def __init__(self, failures=HADITH_API_BREAKER_FAILURES, cooldown=HADITH_API_BREAKER_COOLDOWN,
+                 max_cooldown=HADITH_API_BREAKER_MAX_COOLDOWN):
+        self.threshold = failures
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def is_open(self):
+        """Return True while requests should not be sent"""
+        if self.state == 'open':
+            return time.monotonic() - self.opened_at < self.cooldown
+        return self.state == 'half_open'
+
+    def allow(self):
+        """Return True if a request may be sent now, claiming the probe when half-open"""
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = 'half_open'
+            return True
+        return False
+
+    def success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+
+    def failure(self):
+        self.failures += 1
+        if self.state == 'half_open':
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+        elif self.failures < self.threshold:
+            return
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+
+
+breakers = {book: CircuitBreaker() for book in BOOKS}
+
+
+def get_breaker(book):
+    """Return the circuit breaker guarding a book"""
+    breaker = breakers.get(book)
+    if breaker is None:
+        breaker = breakers[book] = CircuitBreaker()
+    return breaker
+
+
+def get_http_client():
+    """Return the shared keep-alive HTTP client, creating it on first use"""
+    global _client, _semaphore
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=HADITH_API_BASE,
+            timeout=httpx.Timeout(HADITH_API_ATTEMPT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HADITH_API_MAX_CONNECTIONS,
+                max_keepalive_connections=HADITH_API_MAX_CONNECTIONS,
+            ),
+        )
+        _semaphore = asyncio.Semaphore(HADITH_API_MAX_CONNECTIONS)
+    return _client
+
+
+async def close_http_client():
+    """Close the shared HTTP client"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def fetch_hadith_page(book, paginate=50, page=None):
+    """Fetch one page of hadiths for a book and return the decoded JSON"""
+    client = get_http_client()
+    params = {'apiKey': HADITH_API_KEY, 'book': book, 'paginate': paginate}
+    if page is not None:
+        params['page'] = page
+
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        async with _semaphore:
+            response = await client.get('/hadiths', params=params)
+
+        if response.status_code == 404:
+            outcome = 'not_found'
+            raise BookNotFound(book)
+        response.raise_for_status()
+        outcome = 'ok'
+        return response.json()
+    finally:
+        API_REQUEST_SECONDS.observe(time.perf_counter() - started, book, outcome)
+
+
+class HadithSampler:
+    """Draws hadiths uniformly across every book.
+
+    Each book's hadith count is learned from the API's pagination metadata
+    (or taken from the corpus file) and trusted for ``totals_ttl`` seconds.
+    A draw picks a global index uniformly, so every hadith is equally
+    likely whichever book it is in, and only the page holding that index is
+    fetched (``paginate=page_size``, one hadith by default). Fetched pages
+    are kept in an LRU cache and reused by later draws, and their hadiths
+    join the in-memory corpus that most draws are served from.
+    """
+
+    def __init__(self, page_size=HADITH_SAMPLE_PAGE_SIZE, cache_size=HADITH_PAGE_CACHE_SIZE,
+                 totals_ttl=HADITH_TOTALS_TTL):
+        self.page_size = page_size
+        self.cache_size = cache_size
+        self.totals_ttl = totals_ttl
+        self._totals = {}
+        self._pages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def total(self, book):
+        """Return a book's hadith count, or None if it has not been learned"""
+        count = corpus_file.count(book)
+        if count:
+            return count
+        entry = self._totals.get(book)
+        return entry[0] if entry else None
+
+    def is_stale(self, book):
+        """Return True if a learned count is older than ``totals_ttl``"""
+        entry = self._totals.get(book)
+        return entry is not None and time.monotonic() - entry[1] > self.totals_ttl
+
+    def learn(self, book, data):
+        """Record a book's count from a /hadiths response's pagination metadata"""
+        meta = data.get('hadiths') or {}
+        total = meta.get('total')
+        if total is None and meta.get('last_page') is not None:
+            total = int(meta['last_page']) * int(meta.get('per_page') or self.page_size)
+        if total is not None:
+            self._totals[book] = (int(total), time.monotonic())
+
+    def locate(self, index):
+        """Return the (page, offset) holding a book-relative index"""
+        return index // self.page_size + 1, index % self.page_size
+
+    def cached_page(self, book, page):
+        """Return a cached page's hadiths, or None"""
+        hadiths = self._pages.get((book, page))
+        if hadiths is None:
+            self.misses += 1
+            return None
+        self._pages.move_to_end((book, page))
+        self.hits += 1
+        return hadiths
+
+    def store_page(self, book, page, hadiths):
+        self._pages[(book, page)] = hadiths
+        self._pages.move_to_end((book, page))
+        while len(self._pages) > self.cache_size:
+            self._pages.popitem(last=False)
+
+    def choose(self, books):
+        """Pick (book, index) uniformly over every hadith of the books with a known count"""
+        known = [(book, self.total(book)) for book in books]
+        known = [(book, total) for book, total in known if total]
+        if not known:
+            return None
+        index = random.randrange(sum(total for _, total in known))
+        for book, total in known:
+            if index < total:
+                return book, index
+            index -= total
+
+    def stats(self):
+        """Return learned counts and page cache counters"""
+        return {
+            'totals': {book: entry[0] for book, entry in self._totals.items()},
+            'pages': len(self._pages),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+sampler = HadithSampler()
+
+
+async def _fetch_page(book, page):
+    breaker = get_breaker(book)
+    try:
+        data = await fetch_hadith_page(book, paginate=sampler.page_size, page=page)
+    except Exception:
+        breaker.failure()
+        if breaker.state == 'open':
+            logger.warning(f"Circuit for '{book}' opened for {breaker.cooldown:.0f}s")
+        raise
+    breaker.success()
+    sampler.learn(book, data)
+    hadiths = data.get('hadiths', {}).get('data') or []
+    sampler.store_page(book, page, hadiths)
+    if hadiths:
+        corpus.add_many(book, hadiths)
+    return hadiths
+
+
+async def fetch_page(book, page=1, cached=True):
+    """Return one sampling page of a book, sharing one request between concurrent callers.
+
+    Served from the page cache when ``cached`` and present. Raises
+    CircuitOpen without touching the network while the book's circuit is
+    open.
+    """
+    if cached:
+        hadiths = sampler.cached_page(book, page)
+        if hadiths is not None:
+            return hadiths
+
+    key = (book, page)
+    task = _inflight.get(key)
+    if task is None:
+        if not get_breaker(book).allow():
+            raise CircuitOpen(f"circuit open for {book}")
+        task = asyncio.ensure_future(_fetch_page(book, page))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def _revalidate(book):
+    try:
+        await fetch_page(book, 1, cached=False)
+    except CircuitOpen:
+        pass
+    except Exception as e:
+        logger.warning(f"Background refresh of '{book}' failed: {e}")
+
+
+def revalidate(book):
+    """Re-learn a book's count in the background unless a refresh is already running"""
+    if (book, 1) in _inflight or get_breaker(book).is_open():
+        return
+    task = asyncio.ensure_future(_revalidate(book))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+async def learn_totals(books):
+    """Learn the counts of books not seen yet; stale counts are refreshed in the background"""
+    unknown = []
+    for book in books:
+        if sampler.total(book) is None:
+            unknown.append(book)
+        elif sampler.is_stale(book):
+            revalidate(book)
+    if not unknown:
+        return
+
+    results = await asyncio.gather(*(fetch_page(book, 1) for book in unknown), return_exceptions=True)
+    for book, result in zip(unknown, results):
+        if isinstance(result, BookNotFound):
+            logger.warning(f"Book '{book}' returned 404")
+        elif isinstance(result, Exception) and not isinstance(result, CircuitOpen):
+            logger.error(f"Could not learn the size of '{book}': {result}")
+
+
+def _available_books():
+    # Books worth trying: a closed circuit, or something cached to fall back on.
+    return [
+        book for book in BOOKS
+        if not get_breaker(book).is_open() or corpus.count(book) or corpus_file.count(book)
+    ]
+
+
+async def _draw(book, index, exclude=None):
+    if corpus_file.count(book):
+        return corpus_file.random(book, exclude=exclude)
+
+    # Fetched hadiths are a uniform sample of the book, so a pick from the
+    # corpus is as uniform as a fetch. Only a HADITH_SAMPLE_FETCH_RATE share
+    # of draws (and corpus misses) fetch a page, to widen its coverage.
+    if random.random() >= HADITH_SAMPLE_FETCH_RATE:
+        hadith = corpus.random(book, exclude=exclude)
+        if hadith:
+            return hadith
+
+    page, offset = sampler.locate(index)
+    hadiths = await fetch_page(book, page)
+    if not hadiths:
+        return None
+    # Counts derived from last_page * per_page may overshoot the last page.
+    return hadiths[offset] if offset < len(hadiths) else random.choice(hadiths)
+
+
+async def fetch_random_from_book(book):
+    """Return a uniformly random hadith from one book, raising on API errors"""
+    if sampler.total(book) is None:
+        await fetch_page(book, 1)
+    total = sampler.total(book)
+    if not total:
+        return None
+    return await _draw(book, random.randrange(total))
+
+
+async def _fetch_random_hadith(max_attempts, exclude):
+    attempt = 0
+    redraws = 0
+    fallback = None
+
+    while attempt < max_attempts:
+        books = _available_books()
+        if not books:
+            logger.error("Every book's circuit is open and nothing is cached")
+            return None
+        await learn_totals(books)
+
+        picked = sampler.choose(books)
+        if picked is None:
+            logger.warning("No book's size is known yet")
+            attempt += 1
+            book = random.choice(books)
+        else:
+            book, index = picked
+            try:
+                hadith = await _draw(book, index, exclude)
+
+                if hadith:
+                    if exclude is None or not exclude(hadith) or redraws >= HADITH_SAMPLE_REDRAWS:
+                        return hadith
+                    # Seen already: draw again, keeping this one in case every draw is seen.
+                    fallback = fallback or hadith
+                    redraws += 1
+                    continue
+
+                logger.warning(f"No hadiths found in {book}, trying another book...")
+            except CircuitOpen:
+                logger.info(f"Circuit for '{book}' is open, trying another book...")
+            except BookNotFound:
+                logger.warning(f"Book '{book}' returned 404, trying another book...")
+            except httpx.HTTPError as e:
+                logger.error(f"Request error fetching hadith (attempt {attempt + 1}/{max_attempts}): {e}")
+            except Exception as e:
+                logger.error(f"Error fetching hadith (attempt {attempt + 1}/{max_attempts}): {e}")
+            attempt += 1
+
+        hadith = fallback or corpus.random(book, exclude=exclude)
+        if hadith:
+            logger.info(f"Serving cached hadith from {book}")
+            return hadith
+
+    logger.error("Failed to fetch hadith after all attempts")
+    return None
+
+
+async def fetch_random_hadith(max_attempts=3, exclude=None):
+    """Fetch a hadith drawn uniformly from every book.
+
+    Books present in the memory-mapped corpus file are never fetched.
+    Other books are served from the in-memory corpus, except for a
+    ``HADITH_SAMPLE_FETCH_RATE`` share of draws and corpus misses, which
+    cost one small page request (none when the page is cached). Books
+    whose circuit is open are skipped without a request, so
+    an upstream outage costs no waiting once the circuit trips, and a
+    cached hadith is served when a fetch fails.
+
+    Each HTTP attempt is bounded by HADITH_API_ATTEMPT_TIMEOUT and the whole
+    call by HADITH_API_TOTAL_TIMEOUT, so a dead upstream cannot hold a
+    handler for longer than that. ``exclude`` is an optional predicate for
+    hadiths to avoid (e.g. ones the user has already seen); it is a
+    preference, not a guarantee.
+    """
+    try:
+        return await asyncio.wait_for(_fetch_random_hadith(max_attempts, exclude), HADITH_API_TOTAL_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"Fetching hadith exceeded {HADITH_API_TOTAL_TIMEOUT}s deadline")
+        return None
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import logging
+import os
+from urllib.parse import parse_qs
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+HEALTH_READ_TIMEOUT = float(os.getenv('HEALTH_READ_TIMEOUT', 5))
+HEALTH_CHECK_TIMEOUT = float(os.getenv('HEALTH_CHECK_TIMEOUT', 2))
+HEALTH_MAX_BODY = 1024 * 1024
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    503: 'Service Unavailable',
+}
+
+
+class Request:
+    """Parsed HTTP request passed to route handlers"""
+
+    __slots__ = ('method', 'path', 'query', 'headers', 'body')
+
+    def __init__(self, method, path, headers, body, query=None):
+        self.method = method
+        self.path = path
+        self.query = query or {}
+        self.headers = headers
+        self.body = body
+
+
+class HealthServer:
+    """Minimal asyncio HTTP server for health, readiness and metrics.
+
+    It runs on the bot's own event loop, and every connection is handled
+    in its own task with a read deadline, so a slow or stuck client cannot
+    delay other probes. Liveness (``/health``, and any unknown GET path for
+    the uptime pinger) answers without touching anything else. Readiness
+    (``/ready``) runs the registered checks concurrently and answers 503
+    if any of them fails.
+
+    Other modules can mount extra routes with ``add_route``.
+    """
+
+    def __init__(self, port, host='0.0.0.0'):
+        self.port = port
+        self.host = host
+        self._server = None
+        self._checks = {}
+        self._routes = {
+            ('GET', '/ready'): self._ready,
+            ('GET', '/metrics'): self._metrics,
+        }
+
+    def add_check(self, name, check):
+        """Register a readiness check: an async callable returning True when healthy"""
+        self._checks[name] = check
+
+    def add_route(self, method, path, handler):
+        """Serve ``handler(request) -> (status, content_type, body)`` at a path"""
+        self._routes[(method, path)] = handler
+
+    async def start(self):
+        if self._server is None:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            logger.info(f"Health check server running on port {self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3:
+            return None
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length') or 0)
+        if length > HEALTH_MAX_BODY:
+            raise ValueError('body too large')
+        body = await reader.readexactly(length) if length else b''
+        path, _, query = parts[1].partition('?')
+        params = {name: values[-1] for name, values in parse_qs(query).items()}
+        return Request(parts[0].upper(), path, headers, body, params)
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                request = await asyncio.wait_for(self._read_request(reader), HEALTH_READ_TIMEOUT)
+            except ValueError:
+                request = None
+                status, content_type, body = 413, 'text/plain', b'Payload too large'
+            else:
+                if request is None:
+                    status, content_type, body = 400, 'text/plain', b'Bad request'
+                else:
+                    status, content_type, body = await self._dispatch(request)
+
+            head = (
+                f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode('latin-1')
+            writer.write(head if request is not None and request.method == 'HEAD' else head + body)
+            await asyncio.wait_for(writer.drain(), HEALTH_READ_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Health server error: {e}")
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request):
+        method = 'GET' if request.method == 'HEAD' else request.method
+        handler = self._routes.get((method, request.path))
+        if handler is not None:
+            return await handler(request)
+        if method == 'GET':
+            return 200, 'text/plain', b'Bot is running'
+        if any(path == request.path for _, path in self._routes):
+            return 405, 'text/plain', b'Method not allowed'
+        return 404, 'text/plain', b'Not found'
+
+    async def _run_check(self, check):
+        try:
+            return bool(await asyncio.wait_for(check(), HEALTH_CHECK_TIMEOUT))
+        except Exception:
+            return False
+
+    async def _ready(self, request):
+        names = list(self._checks)
+        results = await asyncio.gather(*(self._run_check(self._checks[name]) for name in names))
+        checks = dict(zip(names, results))
+        status = 200 if all(results) else 503
+        return status, 'application/json', json.dumps({'ready': status == 200, 'checks': checks}).encode('utf-8')
+
+    async def _metrics(self, request):
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', registry.render().encode('utf-8')
@@ -0,0 +1,138 @@
+import collections
+import logging
+import os
+import threading
+
+from database import get_seen_hadith_ids, run_db, save_hadith_history_batch
+from metrics import DROPPED_WRITES
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', 10))
+HISTORY_MAX_PENDING = int(os.getenv('HISTORY_MAX_PENDING', 5000))
+HISTORY_MAX_BUFFERED = int(os.getenv('HISTORY_MAX_BUFFERED', 50000))
+SEEN_CACHE_USERS = int(os.getenv('SEEN_CACHE_USERS', 5000))
+
+
+def hadith_index(hadith):
+    """Return the API's numeric hadith id, used as the corpus index"""
+    try:
+        return int(hadith.get('id'))
+    except (TypeError, ValueError):
+        return None
+
+
+class SeenSet:
+    """Bitmap of hadith indices a user has already received"""
+
+    __slots__ = ('_bits',)
+
+    def __init__(self, indices=()):
+        self._bits = bytearray()
+        for index in indices:
+            self.add(index)
+
+    def add(self, index):
+        if index is None or index < 0:
+            return
+        byte = index >> 3
+        if byte >= len(self._bits):
+            self._bits.extend(bytes(byte + 1 - len(self._bits)))
+        self._bits[byte] |= 1 << (index & 7)
+
+    def __contains__(self, index):
+        if index is None or index < 0:
+            return False
+        byte = index >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] & (1 << (index & 7)))
+
+    def __len__(self):
+        return sum(bin(byte).count('1') for byte in self._bits)
+
+    def excludes(self, hadith):
+        """Return True if the hadith was already seen"""
+        return hadith_index(hadith) in self
+
+
+class HistoryRecorder:
+    """Batches hadith_history inserts and keeps per-user seen-sets in memory.
+
+    Seen-sets are loaded from the database once per user and then kept in
+    an LRU, so picking an unseen hadith is a bitmap lookup instead of a
+    query. Deliveries are recorded in both the seen-set and the pending
+    batch that the flush job writes with a single INSERT. While the
+    database is down, at most ``max_buffered`` rows are kept; the oldest
+    are dropped beyond that.
+    """
+
+    def __init__(self, max_pending=HISTORY_MAX_PENDING, cache_users=SEEN_CACHE_USERS,
+                 max_buffered=HISTORY_MAX_BUFFERED):
+        self.max_pending = max_pending
+        self.max_buffered = max_buffered
+        self.cache_users = cache_users
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._seen = collections.OrderedDict()
+
+    def record(self, user_id, hadith):
+        """Queue a delivery; returns True once the batch should be flushed"""
+        index = hadith_index(hadith)
+        seen = self._seen.get(user_id)
+        if seen is not None:
+            seen.add(index)
+
+        row = (
+            user_id,
+            index,
+            str(hadith.get('hadithNumber', '')),
+            hadith.get('book', {}).get('bookName'),
+        )
+        with self._lock:
+            self._pending.append(row)
+            return len(self._pending) >= self.max_pending
+
+    def pending(self):
+        """Return how many deliveries wait to be written"""
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Write pending deliveries in one batch; returns how many were written"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return 0
+            try:
+                return save_hadith_history_batch(rows)
+            except Exception:
+                with self._lock:
+                    self._pending[:0] = rows
+                    overflow = len(self._pending) - self.max_buffered
+                    if overflow > 0:
+                        del self._pending[:overflow]
+                if overflow > 0:
+                    DROPPED_WRITES.inc('hadith_history', amount=overflow)
+                    logger.warning(f"Hadith history buffer is full, dropped the {overflow} oldest deliveries")
+                return 0
+
+    async def seen(self, user_id):
+        """Return the user's seen-set, loading it from the database on first use"""
+        seen = self._seen.get(user_id)
+        if seen is not None:
+            self._seen.move_to_end(user_id)
+            return seen
+
+        indices = await run_db(get_seen_hadith_ids, user_id)
+        seen = self._seen.get(user_id)
+        if seen is None:
+            seen = SeenSet(indices)
+            with self._lock:
+                for row in self._pending:
+                    if row[0] == user_id:
+                        seen.add(row[1])
+            self._seen[user_id] = seen
+            while len(self._seen) > self.cache_users:
+                self._seen.popitem(last=False)
+        return seen
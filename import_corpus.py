@@ -0,0 +1,78 @@
+"""Build the compact hadith corpus file used by HADITH_CORPUS_FILE.
+
+Pages through every book once via the hadith API, or reads a local JSON
+dump (any shape HADITH_CORPUS_DUMP accepts), and writes an indexed file
+the bot memory-maps at startup.
+
+    python import_corpus.py hadiths.bin
+    python import_corpus.py hadiths.bin --dump hadiths.json
+    python import_corpus.py hadiths.bin --books sahih-bukhari sahih-muslim
+"""
+import argparse
+import asyncio
+import json
+import logging
+
+from corpus import hadith_book, iter_dump_hadiths
+from corpus_file import write_corpus_file
+from hadith_api import BOOKS, BookNotFound, close_http_client, fetch_hadith_page
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+IMPORT_PAGE_SIZE = 100
+
+
+async def fetch_book(book, paginate=IMPORT_PAGE_SIZE):
+    """Return every hadith of a book, one API page at a time"""
+    hadiths = []
+    page = 1
+    last_page = 1
+    while page <= last_page:
+        data = await fetch_hadith_page(book, paginate=paginate, page=page)
+        result = data.get('hadiths', {})
+        hadiths.extend(result.get('data') or [])
+        last_page = result.get('last_page') or page
+        if page % 10 == 0 or page == last_page:
+            logger.info(f"{book}: page {page}/{last_page}, {len(hadiths)} hadiths")
+        page += 1
+    return hadiths
+
+
+async def fetch_books(books, paginate=IMPORT_PAGE_SIZE):
+    """Return every hadith of the given books, skipping books the API does not know"""
+    hadiths = []
+    try:
+        for book in books:
+            try:
+                hadiths.extend(await fetch_book(book, paginate))
+            except BookNotFound:
+                logger.warning(f"Book '{book}' returned 404, skipping")
+    finally:
+        await close_http_client()
+    return hadiths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', help='corpus file to write')
+    parser.add_argument('--dump', help='read hadiths from this JSON dump instead of the API')
+    parser.add_argument('--books', nargs='+', default=BOOKS, help='books to import (default: all)')
+    parser.add_argument('--page-size', type=int, default=IMPORT_PAGE_SIZE)
+    args = parser.parse_args()
+
+    if args.dump:
+        with open(args.dump, encoding='utf-8') as f:
+            hadiths = [hadith for hadith in iter_dump_hadiths(json.load(f)) if hadith_book(hadith) in args.books]
+    else:
+        hadiths = asyncio.run(fetch_books(args.books, args.page_size))
+
+    count = write_corpus_file(args.output, hadiths, books=args.books)
+    logger.info(f"Wrote {count} hadiths to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
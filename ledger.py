@@ -0,0 +1,82 @@
+import collections
+import logging
+import os
+import threading
+
+from database import get_delivered_users, prune_daily_deliveries, run_db, save_daily_deliveries
+
+logger = logging.getLogger(__name__)
+
+LEDGER_FLUSH_INTERVAL = float(os.getenv('LEDGER_FLUSH_INTERVAL', 5))
+LEDGER_MAX_PENDING = int(os.getenv('LEDGER_MAX_PENDING', 5000))
+LEDGER_KEEP_DAYS = int(os.getenv('LEDGER_KEEP_DAYS', 7))
+
+# Flushes between prunes of old ledger rows (about hourly by default).
+PRUNE_EVERY_FLUSHES = 720
+
+
+class DeliveryLedger:
+    """Batched record of daily deliveries, one row per (date, user).
+
+    A successful daily send is recorded here and written to
+    ``daily_deliveries`` by the flush job. ``delivered`` answers from the
+    table plus the rows still waiting for a flush, so a bucket that is
+    retried or caught up after a restart skips every user who already got
+    that day's hadith. A crash loses at most the last unflushed batch, so
+    the flush interval bounds how many sends can repeat.
+    """
+
+    def __init__(self, max_pending=LEDGER_MAX_PENDING, keep_days=LEDGER_KEEP_DAYS):
+        self.max_pending = max_pending
+        self.keep_days = keep_days
+        self._pending = collections.defaultdict(set)
+        self._count = 0
+        self._flushes = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def record(self, day, user_id):
+        """Queue a delivery; returns True once the batch should be flushed"""
+        with self._lock:
+            users = self._pending[day]
+            if user_id not in users:
+                users.add(user_id)
+                self._count += 1
+            return self._count >= self.max_pending
+
+    def pending(self):
+        """Return how many deliveries wait to be written"""
+        with self._lock:
+            return self._count
+
+    def flush(self):
+        """Write pending deliveries in one batch; returns how many were written"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, collections.defaultdict(set)
+                self._count = 0
+            rows = [(day, user_id) for day, users in pending.items() for user_id in users]
+
+            if rows:
+                try:
+                    save_daily_deliveries(rows)
+                except Exception:
+                    with self._lock:
+                        for day, users in pending.items():
+                            self._pending[day] |= users
+                        self._count = sum(len(users) for users in self._pending.values())
+                    return 0
+
+            self._flushes += 1
+            if self._flushes % PRUNE_EVERY_FLUSHES == 1:
+                prune_daily_deliveries(self.keep_days)
+            return len(rows)
+
+    async def delivered(self, day, user_ids):
+        """Return which of the users already received the delivery for ``day``"""
+        delivered = await run_db(get_delivered_users, day, user_ids)
+        with self._lock:
+            pending = self._pending.get(day)
+            if pending:
+                delivered |= pending.intersection(user_ids)
+        return delivered
@@ -0,0 +1,240 @@
+import os
+from collections import OrderedDict
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+from telegram.helpers import escape_markdown
+
+from corpus import hadith_key
+
+MAX_MESSAGE_LENGTH = 4096
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', 2048))
+SEARCH_PAGE_SIZE = 5
+SNIPPET_LENGTH = 160
+
+FETCH_FAILED_MESSAGE = "❌ Could not fetch hadith. Please try again."
+
+# Keyboards never change, so they are built once and shared
+# (InlineKeyboardMarkup is immutable).
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📿 Get Random Hadith", callback_data='get_hadith')],
+    [InlineKeyboardButton("⏰ Daily Hadith Settings", callback_data='daily_settings')],
+    [InlineKeyboardButton("ℹ️ Help", callback_data='help')]
+])
+
+DAILY_SETTINGS_ENABLED_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⏰ Change Time", callback_data='set_time')],
+    [InlineKeyboardButton("🌍 Change Timezone", callback_data='set_timezone')],
+    [InlineKeyboardButton("🔕 Disable Daily Hadith", callback_data='disable_daily')],
+    [InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]
+])
+
+DAILY_SETTINGS_DISABLED_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Enable Daily Hadith", callback_data='set_time')],
+    [InlineKeyboardButton("🌍 Set Timezone", callback_data='set_timezone')],
+    [InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]
+])
+
+HADITH_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Get Another Hadith", callback_data='get_hadith')],
+    [InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]
+])
+
+DAILY_HADITH_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Get Another", callback_data='get_hadith')],
+    [InlineKeyboardButton("⚙️ Settings", callback_data='daily_settings')]
+])
+
+BACK_TO_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]
+])
+
+TIME_SET_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Back to Settings", callback_data='daily_settings')],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data='main_menu')]
+])
+
+HOME_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏠 Main Menu", callback_data='main_menu')]
+])
+
+LOCATION_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton("📍 Share Location", request_location=True)]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+TIMEZONE_PROMPT = (
+    "🌍 *Set Your Timezone*\n\n"
+    "Send your timezone name or UTC offset.\n"
+    "Examples: Europe/London, Asia/Karachi, +3 or UTC+05:30\n\n"
+    "Send /cancel to go back."
+)
+
+VARIANTS = {
+    'hadith': ("", HADITH_KEYBOARD),
+    'daily': ("🌅 *Daily Hadith*\n\n", DAILY_HADITH_KEYBOARD),
+}
+
+_render_cache = OrderedDict()
+render_stats = {'hits': 0, 'misses': 0}
+
+
+def get_main_menu_keyboard():
+    """Create main menu keyboard"""
+    return MAIN_MENU_KEYBOARD
+
+
+def get_daily_settings_keyboard(is_enabled=False):
+    """Create daily hadith settings keyboard"""
+    return DAILY_SETTINGS_ENABLED_KEYBOARD if is_enabled else DAILY_SETTINGS_DISABLED_KEYBOARD
+
+
+def format_daily_time(time_obj):
+    """Format a stored daily hadith time (TIME, timedelta or string) as HH:MM"""
+    if isinstance(time_obj, str):
+        return time_obj
+    if hasattr(time_obj, 'hour') and hasattr(time_obj, 'minute'):
+        return f"{time_obj.hour:02d}:{time_obj.minute:02d}"
+    total_seconds = int(time_obj.total_seconds())
+    return f"{total_seconds // 3600:02d}:{(total_seconds % 3600) // 60:02d}"
+
+
+def format_hadith_message(hadith):
+    """Format hadith data into a readable message"""
+    if not hadith:
+        return FETCH_FAILED_MESSAGE
+
+    english = hadith.get('hadithEnglish', 'N/A')
+    arabic = hadith.get('hadithArabic', '')
+    book_name = hadith.get('book', {}).get('bookName', 'Unknown')
+    hadith_number = hadith.get('hadithNumber', 'N/A')
+    chapter = hadith.get('chapter', {}).get('chapterEnglish', 'N/A')
+
+    parts = [
+        f"📖 *{book_name}*\n",
+        f"📚 Hadith #{hadith_number}\n",
+        f"📑 Chapter: {chapter}\n\n",
+    ]
+    if arabic:
+        parts.append(f"🔤 *Arabic:*\n{arabic}\n\n")
+    parts.append(f"🇬🇧 *English:*\n{english}")
+
+    return "".join(parts)
+
+
+def telegram_length(text):
+    """Length of text as Telegram counts it (UTF-16 code units)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _cut(text, limit):
+    # Longest prefix of ``text`` whose UTF-16 length fits in ``limit``.
+    low, high = 0, min(len(text), limit)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if telegram_length(text[:mid]) <= limit:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    """Split text into chunks Telegram accepts.
+
+    Prefers paragraph breaks, then line breaks, then spaces, in the back
+    half of each chunk, so Markdown markers (which this bot only uses
+    within a single line) stay balanced.
+    """
+    chunks = []
+    while telegram_length(text) > limit:
+        cut = _cut(text, limit)
+        window = text[:cut]
+        for separator in ("\n\n", "\n", " "):
+            position = window.rfind(separator)
+            if position >= cut // 2:
+                cut = position
+                break
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+def render_hadith(hadith, variant='hadith'):
+    """Return (chunks, reply_markup) for a hadith, memoized by hadith and variant"""
+    header, reply_markup = VARIANTS[variant]
+    if not hadith:
+        return (header + FETCH_FAILED_MESSAGE,), reply_markup
+
+    key = (hadith.get('id') or hadith_key(hadith), variant)
+    chunks = _render_cache.get(key)
+    if chunks is not None:
+        _render_cache.move_to_end(key)
+        render_stats['hits'] += 1
+        return chunks, reply_markup
+
+    render_stats['misses'] += 1
+    chunks = tuple(split_message(header + format_hadith_message(hadith)))
+    _render_cache[key] = chunks
+    if len(_render_cache) > RENDER_CACHE_SIZE:
+        _render_cache.popitem(last=False)
+    return chunks, reply_markup
+
+
+def search_result_keyboard(page):
+    """Keyboard shown under a hadith opened from search results"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔙 Back to Results", callback_data=f'search_page:{page}')],
+        [InlineKeyboardButton("🏠 Main Menu", callback_data='main_menu')]
+    ])
+
+
+def _snippet(text):
+    text = " ".join(text.split())
+    if len(text) > SNIPPET_LENGTH:
+        text = text[:SNIPPET_LENGTH].rsplit(" ", 1)[0] + "…"
+    return escape_markdown(text)
+
+
+def render_search_page(query, results, page, get_hadith):
+    """Return (text, reply_markup) for one page of search results.
+
+    ``results`` are ranked document ids and ``get_hadith`` resolves one to
+    its hadith.
+    """
+    if not results:
+        return f"🔎 No hadiths found for \"{escape_markdown(query)}\".", HOME_KEYBOARD
+
+    pages = (len(results) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    page = max(0, min(page, pages - 1))
+    first = page * SEARCH_PAGE_SIZE
+    docs = results[first:first + SEARCH_PAGE_SIZE]
+
+    lines = [
+        f"🔎 *Search:* {escape_markdown(query)}\n"
+        f"{len(results)} results, page {page + 1}/{pages}\n"
+    ]
+    for number, doc in enumerate(docs, start=first + 1):
+        hadith = get_hadith(doc)
+        book_name = escape_markdown(hadith.get('book', {}).get('bookName') or 'Unknown')
+        lines.append(
+            f"{number}. *{book_name}* #{escape_markdown(str(hadith.get('hadithNumber', 'N/A')))}\n"
+            f"{_snippet(hadith.get('hadithEnglish') or hadith.get('hadithArabic') or '')}\n"
+        )
+
+    keyboard = [[
+        InlineKeyboardButton(str(number), callback_data=f'search_open:{doc}')
+        for number, doc in enumerate(docs, start=first + 1)
+    ]]
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ Previous", callback_data=f'search_page:{page - 1}'))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("Next ▶️", callback_data=f'search_page:{page + 1}'))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("🏠 Main Menu", callback_data='main_menu')])
+
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
@@ -0,0 +1,204 @@
+import functools
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield self.name, _labels(self.labels, labels), value
+
+
+class Histogram:
+    """Cumulative-bucket histogram, optionally split by labels"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labels):
+        """Context manager that observes the elapsed time of its block"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = {labels: ([*series[0]], series[1], series[2]) for labels, series in self._values.items()}
+        for labels, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', _labels(self.labels, labels, [('le', _number(bound))]), cumulative
+            yield f'{self.name}_sum', _labels(self.labels, labels), total
+            yield f'{self.name}_count', _labels(self.labels, labels), count
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+
+class Collected:
+    """Gauge or counter read from a callback at scrape time.
+
+    ``collect`` returns a number, or a dict of label value tuples to
+    numbers; it should be cheap and must not block.
+    """
+
+    def __init__(self, name, help, collect, labels=(), type='gauge'):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.type = type
+        self.collect = collect
+
+    def samples(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            yield self.name, _labels(self.labels, labels), value
+
+
+class Registry:
+    """Ordered set of metrics rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def collect(self, name, help, collect, labels=(), type='gauge'):
+        return self.register(Collected(name, help, collect, labels, type))
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                lines.append(f'# {metric.name} unavailable: {_escape(e)}')
+                continue
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(f'{name}{labels} {_number(value)}' for name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+API_REQUEST_SECONDS = registry.histogram(
+    'hadith_api_request_seconds', 'Latency of hadith API page requests', ['book', 'outcome'])
+DB_CALL_SECONDS = registry.histogram(
+    'db_call_seconds', 'Latency of database calls run on the DB thread pool', ['function'])
+DB_ERRORS = registry.counter(
+    'db_errors_total', 'Database calls that raised', ['function'])
+TELEGRAM_REQUEST_SECONDS = registry.histogram(
+    'telegram_request_seconds', 'Latency of Telegram API calls, excluding rate-limit waits', ['endpoint'])
+OUTBOX_WAIT_SECONDS = registry.histogram(
+    'outbox_wait_seconds', 'Time outgoing messages waited for rate-limit tokens', ['priority'])
+TELEGRAM_ERRORS = registry.counter(
+    'telegram_errors_total', 'Telegram API calls that failed', ['endpoint', 'error'])
+HANDLER_UPDATES = registry.counter(
+    'handler_updates_total', 'Updates processed per handler', ['handler'])
+HANDLER_SECONDS = registry.histogram(
+    'handler_seconds', 'Time spent in each update handler', ['handler'])
+HANDLER_ERRORS = registry.counter(
+    'handler_errors_total', 'Errors raised while handling updates', ['handler'])
+BROADCAST_LAG_SECONDS = registry.histogram(
+    'broadcast_lag_seconds', 'Delay between a daily hadith\'s scheduled minute and its delivery',
+    buckets=LAG_BUCKETS)
+BROADCAST_MESSAGES = registry.counter(
+    'broadcast_messages_total', 'Daily hadith deliveries by outcome', ['outcome'])
+DROPPED_WRITES = registry.counter(
+    'dropped_writes_total', 'Buffered rows dropped because the database stayed unavailable', ['kind'])
+
+
+def instrument(name=None):
+    """Decorator counting and timing an async update handler"""
+    def decorate(callback):
+        label = name or callback.__name__
+
+        @functools.wraps(callback)
+        async def wrapper(*args, **kwargs):
+            HANDLER_UPDATES.inc(label)
+            started = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(label)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - started, label)
+        return wrapper
+    return decorate
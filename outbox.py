@@ -0,0 +1,268 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import os
+import random
+import time
+
+import httpx
+from telegram.error import NetworkError, RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import OUTBOX_WAIT_SECONDS, TELEGRAM_ERRORS, TELEGRAM_REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BROADCAST = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BROADCAST: 'broadcast'}
+
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', 30))
+OUTBOX_PRIVATE_CHAT_RATE = float(os.getenv('OUTBOX_PRIVATE_CHAT_RATE', 1))
+OUTBOX_GROUP_CHAT_RATE = float(os.getenv('OUTBOX_GROUP_CHAT_RATE', 20 / 60))
+OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', 3))
+OUTBOX_MAX_TRACKED_CHATS = int(os.getenv('OUTBOX_MAX_TRACKED_CHATS', 10000))
+
+# Endpoints that deliver or change a message in a chat and therefore count
+# against Telegram's flood limits. Everything else (getUpdates,
+# answerCallbackQuery, ...) is passed straight through.
+LIMITED_ENDPOINTS = frozenset({
+    'sendMessage',
+    'editMessageText',
+    'editMessageReplyMarkup',
+    'sendPhoto',
+    'sendDocument',
+    'copyMessage',
+    'forwardMessage',
+})
+
+
+def retry_after_seconds(error):
+    """Return the wait requested by a RetryAfter error in seconds"""
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+def request_never_sent(error):
+    """Return True if a failed request provably never reached Telegram.
+
+    Only failures to open a connection or to get one from the pool qualify.
+    Any other network error or timeout may come after Telegram accepted
+    the message, so retrying it could deliver it twice.
+    """
+    return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+class TokenBucket:
+    """Async token bucket allowing ``rate`` acquisitions per second"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """Take a token if one is available; otherwise return the seconds to wait"""
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            while True:
+                wait = self.try_acquire()
+                if not wait:
+                    return
+                await asyncio.sleep(wait)
+
+
+class PriorityTokenBucket(TokenBucket):
+    """Token bucket that hands out tokens to the lowest priority value first"""
+
+    def __init__(self, rate, capacity=None):
+        super().__init__(rate, capacity)
+        self._waiters = []
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self._wakeup = asyncio.Event()
+        self.paused_until = 0.0
+
+    def pause(self, seconds):
+        """Stop handing out tokens for ``seconds`` (flood control)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self._wakeup.set()
+
+    def waiting(self, priority=None):
+        """Return how many callers are queued, optionally for one priority"""
+        return sum(
+            1 for waiter in self._waiters
+            if not waiter[2].done() and (priority is None or waiter[0] == priority)
+        )
+
+    async def acquire(self, priority=INTERACTIVE):
+        """Wait for a token; lower ``priority`` values are served first"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        await future
+
+    async def _dispatch(self):
+        while self._waiters:
+            paused = self.paused_until - time.monotonic()
+            if paused > 0:
+                await asyncio.sleep(paused)
+                continue
+
+            while self._waiters and self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+            if not self._waiters:
+                break
+
+            wait = self.try_acquire()
+            if wait:
+                self._wakeup.clear()
+                try:
+                    # Wake early if a flood pause starts or a new waiter arrives.
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # Cancelled caller: give the token back.
+                self._tokens += 1
+            else:
+                future.set_result(None)
+
+    async def close(self):
+        """Stop the dispatcher and fail every queued caller"""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+        for _, _, future in self._waiters:
+            if not future.done():
+                future.cancel()
+        self._waiters.clear()
+
+
+class OutboxRateLimiter(BaseRateLimiter):
+    """Outbound Telegram request queue used as the bot's rate limiter.
+
+    Every message-sending request waits for a per-chat token (private and
+    group chats have separate rates) and then for a global token. Global
+    tokens go to interactive replies before broadcast sends; pass
+    ``rate_limit_args={'priority': BROADCAST}`` to mark a request as
+    broadcast. A RetryAfter answer pauses all sending for the requested
+    time and the request is retried. Requests that provably never reached
+    Telegram (see ``request_never_sent``) are retried with backoff. Both
+    retries are capped at ``max_retries``, which ``rate_limit_args`` can
+    override per request. Other network errors and timeouts are raised,
+    because the message may already have been delivered.
+    """
+
+    def __init__(self, global_rate=OUTBOX_GLOBAL_RATE, private_chat_rate=OUTBOX_PRIVATE_CHAT_RATE,
+                 group_chat_rate=OUTBOX_GROUP_CHAT_RATE, max_retries=OUTBOX_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.max_retries = max_retries
+        self._global = None
+        self._chats = collections.OrderedDict()
+        self.stats = collections.Counter()
+
+    async def initialize(self):
+        self._global = PriorityTokenBucket(self.global_rate)
+
+    async def shutdown(self):
+        if self._global is not None:
+            await self._global.close()
+
+    def queue_size(self, priority=None):
+        """Return how many requests are waiting for a global token"""
+        return self._global.waiting(priority) if self._global is not None else 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_chat_rate if is_group else self.private_chat_rate
+            # Private chats tolerate short bursts (answer + edit + follow-up).
+            bucket = TokenBucket(rate, capacity=1 if is_group else 3)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > OUTBOX_MAX_TRACKED_CHATS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _call(self, callback, args, kwargs, endpoint):
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(endpoint, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint not in LIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+
+        rate_limit_args = rate_limit_args or {}
+        priority = rate_limit_args.get('priority', INTERACTIVE)
+        max_retries = rate_limit_args.get('max_retries', self.max_retries)
+        chat_id = data.get('chat_id')
+        attempt = 0
+
+        while True:
+            waiting_since = time.perf_counter()
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+            await self._global.acquire(priority)
+            OUTBOX_WAIT_SECONDS.observe(time.perf_counter() - waiting_since, PRIORITY_NAMES.get(priority, priority))
+
+            try:
+                result = await self._call(callback, args, kwargs, endpoint)
+                self.stats['sent'] += 1
+                return result
+            except RetryAfter as e:
+                attempt += 1
+                delay = retry_after_seconds(e)
+                self._global.pause(delay)
+                self.stats['retry_after'] += 1
+                logger.warning(f"Flood control on {endpoint} for chat {chat_id}: pausing sends for {delay:.0f}s")
+                if attempt > max_retries:
+                    self.stats['gave_up'] += 1
+                    raise
+            except NetworkError as e:
+                if not request_never_sent(e):
+                    raise
+                attempt += 1
+                self.stats['network_retries'] += 1
+                if attempt > max_retries:
+                    self.stats['gave_up'] += 1
+                    raise
+                delay = min(30.0, 2 ** attempt) * random.uniform(0.8, 1.2)
+                logger.warning(f"Network error on {endpoint} for chat {chat_id} ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
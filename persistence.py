@@ -0,0 +1,153 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from database import load_persistence, run_db, save_persistence
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCE = os.getenv('PERSISTENCE', 'postgres')
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', 10))
+PERSISTENCE_MAX_AGE_DAYS = int(os.getenv('PERSISTENCE_MAX_AGE_DAYS', 30))
+
+BOT_DATA_KEY = 'bot'
+
+
+def _dump(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+
+class PostgresPersistence(BasePersistence):
+    """Keeps user, chat and bot data and conversation states in Postgres.
+
+    Every ``update_interval`` seconds PTB hands over only the users, chats
+    and conversations touched since its previous run. They are coalesced
+    here and written in one batched upsert (and one batched delete for
+    emptied entries), so a run costs a single round trip however many
+    users changed. Entries equal to what is already stored are skipped.
+
+    At startup only entries written in the last ``max_age_days`` days are
+    loaded. Keys listed in ``transient`` (e.g. search results, which point
+    into an index rebuilt on every start) are never stored. Values must be
+    JSON-serializable; anything that is not is logged and skipped.
+    """
+
+    def __init__(self, update_interval=PERSISTENCE_INTERVAL, max_age_days=PERSISTENCE_MAX_AGE_DAYS,
+                 transient=('search',)):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.max_age_days = max_age_days
+        self.transient = frozenset(transient)
+        self._pending = {}
+        # What the table holds, so unchanged entries are not rewritten and
+        # emptied entries that were never stored cost no delete.
+        self._stored = {}
+        self._write_task = None
+        self.stats = collections.Counter()
+
+    async def _load(self, kind):
+        rows = await run_db(load_persistence, kind, self.max_age_days)
+        self._stored.update(((kind, key), _dump(data)) for key, data in rows)
+        return rows
+
+    async def get_user_data(self):
+        return {int(key): data for key, data in await self._load('user')}
+
+    async def get_chat_data(self):
+        return {int(key): data for key, data in await self._load('chat')}
+
+    async def get_bot_data(self):
+        return dict(await self._load('bot')).get(BOT_DATA_KEY, {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {tuple(json.loads(key)): state for key, state in await self._load(f"conversation:{name}")}
+
+    def _queue(self, kind, key, data):
+        item = (kind, str(key))
+        try:
+            data = _dump(data) if data is not None else None
+        except (TypeError, ValueError) as e:
+            logger.error(f"Not persisting {kind} {key}: {e}")
+            return
+        if data == self._stored.get(item):
+            self._pending.pop(item, None)
+            return
+        self._pending[item] = data
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.ensure_future(self._write())
+
+    def _without_transient(self, data):
+        data = {key: value for key, value in data.items() if key not in self.transient}
+        return data or None
+
+    async def update_conversation(self, name, key, new_state):
+        self._queue(f"conversation:{name}", json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id, data):
+        self._queue('user', user_id, self._without_transient(data))
+
+    async def update_chat_data(self, chat_id, data):
+        self._queue('chat', chat_id, self._without_transient(data))
+
+    async def update_bot_data(self, data):
+        self._queue('bot', BOT_DATA_KEY, self._without_transient(data))
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._queue('user', user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._queue('chat', chat_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def _write(self):
+        # PTB queues a whole run's updates before this task gets to run, so
+        # they all land in one batch.
+        await asyncio.sleep(0)
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        upserts = [(kind, key, data) for (kind, key), data in pending.items() if data is not None]
+        deletes = [(kind, key) for (kind, key), data in pending.items() if data is None]
+        try:
+            await run_db(save_persistence, upserts, deletes)
+        except Exception as e:
+            # Keep the batch for the next run unless newer data replaced it.
+            for item, data in pending.items():
+                self._pending.setdefault(item, data)
+            self.stats['failed_writes'] += 1
+            logger.error(f"Persisting {len(pending)} entries failed, will retry: {e}")
+            return
+
+        for item, data in pending.items():
+            if data is None:
+                self._stored.pop(item, None)
+            else:
+                self._stored[item] = data
+        self.stats['writes'] += 1
+        self.stats['entries'] += len(pending)
+        if self._pending:
+            self._write_task = asyncio.ensure_future(self._write())
+
+    async def flush(self):
+        """Write everything still pending (called by PTB on shutdown)"""
+        if self._write_task is not None:
+            await self._write_task
+        await self._write()
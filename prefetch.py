@@ -0,0 +1,142 @@
+import asyncio
+import collections
+import logging
+import os
+import random
+import time
+
+from corpus import hadith_key
+from hadith_api import BOOKS, BookNotFound, fetch_random_from_book, sampler
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_LOW_WATERMARK = int(os.getenv('PREFETCH_LOW_WATERMARK', 5))
+PREFETCH_HIGH_WATERMARK = int(os.getenv('PREFETCH_HIGH_WATERMARK', 20))
+PREFETCH_INTERVAL = float(os.getenv('PREFETCH_INTERVAL', 30))
+PREFETCH_BASE_BACKOFF = float(os.getenv('PREFETCH_BASE_BACKOFF', 5))
+PREFETCH_MAX_BACKOFF = float(os.getenv('PREFETCH_MAX_BACKOFF', 600))
+
+
+class HadithPrefetchPool:
+    """Per-book queues of ready-to-send hadiths kept filled in the background.
+
+    ``take`` never touches the network. When a book's queue drops below
+    ``low`` the refill task tops it up to ``high``. A book that answers 404
+    or errors is backed off exponentially before it is tried again.
+    """
+
+    def __init__(self, books=BOOKS, low=PREFETCH_LOW_WATERMARK, high=PREFETCH_HIGH_WATERMARK):
+        self.low = low
+        self.high = high
+        self._queues = {book: collections.deque() for book in books}
+        self._failures = {book: 0 for book in books}
+        self._backoff_until = {book: 0.0 for book in books}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.served = 0
+        self.empty = 0
+
+    def _weighted_books(self):
+        # Non-empty books in random order, each book drawn with probability
+        # proportional to its hadith count so small books are not favoured.
+        # Books whose count is still unknown weigh as much as the average.
+        books = [name for name, queue in self._queues.items() if queue]
+        totals = {name: sampler.total(name) for name in books}
+        known = [total for total in totals.values() if total]
+        default = sum(known) / len(known) if known else 1
+        return sorted(books, key=lambda name: random.random() ** (1 / (totals[name] or default)), reverse=True)
+
+    def take(self, book=None, exclude=None):
+        """Pop a prefetched hadith, from ``book`` or a non-empty book weighted by its size.
+
+        ``exclude`` is an optional predicate for hadiths to skip; skipped
+        hadiths stay queued for other users.
+        """
+        if book is None:
+            books = self._weighted_books()
+        else:
+            books = [book] if self._queues.get(book) else []
+
+        for name in books:
+            queue = self._queues[name]
+            for hadith in queue:
+                if exclude is None or not exclude(hadith):
+                    queue.remove(hadith)
+                    self.served += 1
+                    if len(queue) < self.low:
+                        self._wakeup.set()
+                    return hadith
+
+        self.empty += 1
+        self._wakeup.set()
+        return None
+
+    def size(self, book=None):
+        """Return the number of queued hadiths, for one book or all of them"""
+        if book is not None:
+            return len(self._queues.get(book, ()))
+        return sum(len(queue) for queue in self._queues.values())
+
+    def start(self, application):
+        """Start the background refill task on the application's loop"""
+        if self._task is None:
+            self._task = application.create_task(self._run())
+            self._wakeup.set()
+
+    async def stop(self):
+        """Cancel the background refill task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), PREFETCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            books = [book for book, queue in self._queues.items() if len(queue) < self.low]
+            await asyncio.gather(*(self._refill(book) for book in books))
+
+    async def _refill(self, book):
+        if time.monotonic() < self._backoff_until[book]:
+            return
+
+        queue = self._queues[book]
+        queued = {hadith_key(hadith) for hadith in queue}
+        # Allow a few misses for duplicates before giving up on this round.
+        attempts = (self.high - len(queue)) * 2
+        while len(queue) < self.high and attempts > 0:
+            attempts -= 1
+            try:
+                hadith = await fetch_random_from_book(book)
+            except BookNotFound:
+                self._back_off(book, "returned 404")
+                return
+            except Exception as e:
+                self._back_off(book, f"failed: {e}")
+                return
+
+            if hadith is None:
+                self._back_off(book, "returned no hadiths")
+                return
+
+            key = hadith_key(hadith)
+            if key not in queued:
+                queued.add(key)
+                queue.append(hadith)
+
+        self._failures[book] = 0
+
+    def _back_off(self, book, reason):
+        self._failures[book] += 1
+        delay = min(PREFETCH_MAX_BACKOFF, PREFETCH_BASE_BACKOFF * 2 ** (self._failures[book] - 1))
+        delay *= random.uniform(0.8, 1.2)
+        self._backoff_until[book] = time.monotonic() + delay
+        logger.warning(f"Prefetch for '{book}' {reason}, backing off {delay:.0f}s")
@@ -0,0 +1,197 @@
+import heapq
+import logging
+import math
+import os
+import re
+import threading
+from array import array
+from collections import Counter, OrderedDict
+
+from corpus import corpus, hadith_key
+from corpus_file import corpus_file
+
+logger = logging.getLogger(__name__)
+
+SEARCH_MAX_RESULTS = int(os.getenv('SEARCH_MAX_RESULTS', 50))
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', 512))
+SEARCH_TERM_LIMIT = int(os.getenv('SEARCH_TERM_LIMIT', 2000))
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+ARABIC_MARKS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+ARABIC_LETTERS = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه',
+})
+WORD = re.compile(r'\w+')
+
+STOPWORDS = frozenset("""
+a an and are as at be but by for from had has have he her him his i if in
+into is it its me my no not of on or our she so than that the their them
+then there they this to upon us was we were what when which who will with
+would you your
+""".split())
+
+
+def normalize(text):
+    """Lowercase text and fold Arabic diacritics and letter variants"""
+    return ARABIC_MARKS.sub('', text.lower()).translate(ARABIC_LETTERS)
+
+
+def tokenize(text):
+    """Split text into index terms"""
+    terms = []
+    for word in WORD.findall(normalize(text)):
+        # Drop the Arabic definite article so "الصلاه" matches "صلاه".
+        if word.startswith('ال') and len(word) > 4:
+            word = word[2:]
+        if len(word) > 1 and word not in STOPWORDS:
+            terms.append(word)
+    return terms
+
+
+class SearchIndex:
+    """In-memory inverted index over hadith English and Arabic text.
+
+    Each term maps to parallel arrays of document ids and precomputed BM25
+    term weights, so a query is a few array scans and a heap selection.
+    For common terms only the ``term_limit`` highest-weighted postings are
+    scanned (impact ordering), which bounds query time on the full corpus.
+    Length normalisation uses the average document length at the time a
+    document is added, which settles quickly once the corpus is loaded.
+    Documents from the corpus file are stored as file indices and decoded
+    only when a result is shown.
+    """
+
+    def __init__(self, max_results=SEARCH_MAX_RESULTS, cache_size=SEARCH_CACHE_SIZE,
+                 term_limit=SEARCH_TERM_LIMIT):
+        self.max_results = max_results
+        self.cache_size = cache_size
+        self.term_limit = term_limit
+        self._docs = []
+        self._keys = {}
+        self._postings = {}
+        self._weights = {}
+        self._impacts = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, hadith, ref=None):
+        """Index a hadith; ``ref`` is its corpus file index if it has one"""
+        key = hadith_key(hadith)
+        if key[0] is None or key in self._keys:
+            return False
+
+        terms = Counter(tokenize(hadith.get('hadithEnglish') or ''))
+        terms.update(tokenize(hadith.get('hadithArabic') or ''))
+        length = sum(terms.values())
+
+        with self._lock:
+            if key in self._keys:
+                return False
+            doc = len(self._docs)
+            self._docs.append(hadith if ref is None else ref)
+            self._keys[key] = doc
+            self._total_length += length
+
+            norm = K1 * (1 - B + B * length / (self._total_length / len(self._docs)))
+            for term, tf in terms.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = array('I')
+                    self._weights[term] = array('f')
+                postings.append(doc)
+                self._weights[term].append(tf * (K1 + 1) / (tf + norm))
+        return True
+
+    def add_many(self, hadiths):
+        """Index a batch of hadiths; returns how many were new"""
+        return sum(self.add(hadith) for hadith in hadiths)
+
+    def add_corpus_file(self, source):
+        """Index every hadith in a memory-mapped corpus file"""
+        added = 0
+        for index in range(len(source)):
+            added += self.add(source.get(index), ref=index)
+        return added
+
+    def _top_postings(self, term):
+        # Highest-weighted postings of a term, re-sorted whenever it has grown.
+        postings = self._postings[term]
+        weights = self._weights[term]
+        if len(postings) <= self.term_limit:
+            return zip(postings, weights)
+
+        impact = self._impacts.get(term)
+        if impact is None or impact[0] != len(postings):
+            top = heapq.nlargest(self.term_limit, zip(postings, weights), key=lambda item: item[1])
+            impact = (len(postings), top)
+            self._impacts[term] = impact
+        return impact[1]
+
+    def prepare(self):
+        """Precompute impact-ordered postings for every common term"""
+        for term, postings in list(self._postings.items()):
+            if len(postings) > self.term_limit:
+                self._top_postings(term)
+
+    def get(self, doc):
+        """Return the hadith for a document id"""
+        ref = self._docs[doc]
+        return corpus_file.get(ref) if isinstance(ref, int) else ref
+
+    def search(self, query):
+        """Return up to ``max_results`` document ids ranked by BM25 score"""
+        terms = tuple(sorted(set(tokenize(query))))
+        if not terms:
+            return []
+
+        cache_key = (terms, len(self._docs))
+        results = self._cache.get(cache_key)
+        if results is not None:
+            self._cache.move_to_end(cache_key)
+            return results
+
+        count = len(self._docs)
+        scores = {}
+        get = scores.get
+        for term in terms:
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc, weight in self._top_postings(term):
+                scores[doc] = get(doc, 0.0) + idf * weight
+
+        results = [doc for doc, _ in heapq.nlargest(self.max_results, scores.items(), key=lambda item: item[1])]
+        self._cache[cache_key] = results
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return results
+
+    def stats(self):
+        """Return index statistics"""
+        return {'documents': len(self._docs), 'terms': len(self._postings)}
+
+
+search_index = SearchIndex()
+
+
+def build_search_index():
+    """Index the corpus file and cached hadiths, and keep indexing newly fetched ones.
+
+    Runs in a worker thread at startup; searches work on the partial index
+    while it is being built.
+    """
+    corpus.listeners.append(search_index.add_many)
+    added = search_index.add_corpus_file(corpus_file)
+    added += search_index.add_many(list(corpus))
+    search_index.prepare()
+    logger.info(f"Search index built: {added} hadiths, {search_index.stats()['terms']} terms")
+    return added
@@ -0,0 +1,142 @@
+import hashlib
+import logging
+import os
+import socket
+import threading
+
+from telegram.ext import ContextTypes
+
+from database import (
+    claim_broadcast_shards,
+    finish_broadcast_shards,
+    prune_broadcast_claims,
+    reclaim_broadcast_shards,
+    record_worker_heartbeat,
+    remove_worker,
+    run_db,
+)
+
+logger = logging.getLogger(__name__)
+
+BOT_MODE = os.getenv('BOT_MODE', 'standalone')
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 64))
+WORKER_HEARTBEAT_INTERVAL = float(os.getenv('WORKER_HEARTBEAT_INTERVAL', 10))
+WORKER_TTL = float(os.getenv('WORKER_TTL', 30))
+
+# primary: handles Telegram updates and delivers its shards; worker: only
+# delivers its shards. standalone (the default) delivers everything from
+# memory and needs neither table.
+SHARDED = BOT_MODE in ('primary', 'worker')
+
+
+def _weight(worker_id, shard):
+    digest = hashlib.blake2b(f"{worker_id}:{shard}".encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def assign_shards(workers, shard_count=SHARD_COUNT):
+    """Map each worker id to the shards it owns (rendezvous hashing).
+
+    Every worker computes the same assignment from the same worker list,
+    and a worker joining or leaving only moves the shards it gains or held.
+    """
+    owners = {worker: set() for worker in workers}
+    for shard in range(shard_count):
+        if workers:
+            owners[max(workers, key=lambda worker: _weight(worker, shard))].add(shard)
+    return owners
+
+
+def user_shard(user_id, shard_count=SHARD_COUNT):
+    """Return the virtual shard a user belongs to"""
+    return user_id % shard_count
+
+
+class ShardCoordinator:
+    """Tracks live workers through heartbeats and the shards this worker owns.
+
+    Shard ownership is recomputed on every heartbeat. Deliveries are still
+    claimed per (day, minute, shard) in the database before sending, so a
+    delivery is sent once even while workers disagree during a rebalance.
+    Shards taken over from another worker are caught up for the previous
+    few minutes, in case their old owner died before claiming them. A
+    claim is marked done once its bucket was sent; unfinished claims of
+    dead workers, or released after a failure, are taken over again.
+    """
+
+    def __init__(self, worker_id=WORKER_ID, shard_count=SHARD_COUNT, ttl=WORKER_TTL):
+        self.worker_id = worker_id
+        self.shard_count = shard_count
+        self.ttl = ttl
+        self.workers = []
+        self.owned = frozenset()
+        self.adopted = set()
+        self._heartbeats = 0
+        # heartbeat runs on a DB thread, claim on the event loop.
+        self._lock = threading.Lock()
+
+    def heartbeat(self):
+        """Record this worker's heartbeat and recompute owned shards (blocking)"""
+        workers = record_worker_heartbeat(self.worker_id, self.ttl)
+        if self.worker_id not in workers:
+            workers.append(self.worker_id)
+        owned = frozenset(assign_shards(workers, self.shard_count)[self.worker_id])
+
+        with self._lock:
+            changed = owned != self.owned
+            if changed and self.owned:
+                self.adopted |= owned - self.owned
+            self.workers = workers
+            self.owned = owned
+        if changed:
+            logger.info(
+                f"Worker {self.worker_id} owns {len(owned)}/{self.shard_count} shards "
+                f"across {len(workers)} workers"
+            )
+
+        self._heartbeats += 1
+        if self._heartbeats % 360 == 1:
+            prune_broadcast_claims()
+        return owned
+
+    async def heartbeat_job(self, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            await run_db(self.heartbeat)
+        except Exception as e:
+            logger.error(f"Worker heartbeat failed: {e}")
+
+    async def claim(self, buckets, catchup=(), since=None):
+        """Claim this worker's shards for (day, minute) buckets.
+
+        Returns the (day, minute, shard) deliveries won. ``catchup`` lists
+        earlier buckets to claim for shards adopted since the last claim.
+        With ``since``, unfinished claims on owned shards due since then
+        are taken over as well.
+        """
+        with self._lock:
+            owned = sorted(self.owned)
+            adopted, self.adopted = sorted(self.adopted & self.owned), set()
+        claims = [(day, minute, shard) for day, minute in buckets for shard in owned]
+        claims.extend((day, minute, shard) for day, minute in catchup for shard in adopted)
+
+        def claim():
+            won = claim_broadcast_shards(self.worker_id, claims)
+            if since is not None:
+                won.extend(reclaim_broadcast_shards(self.worker_id, owned, since))
+            return won
+        return await run_db(claim)
+
+    async def finish(self, claims, done=True):
+        """Mark claims done once delivered, or release them so they are retried"""
+        await run_db(finish_broadcast_shards, self.worker_id, claims, done)
+
+    def schedule(self, job_queue):
+        """Heartbeat now and then every WORKER_HEARTBEAT_INTERVAL seconds"""
+        return job_queue.run_repeating(
+            self.heartbeat_job, interval=WORKER_HEARTBEAT_INTERVAL, first=0, name='worker_heartbeat'
+        )
+
+    async def leave(self):
+        """Remove this worker so the others take over its shards right away"""
+        await run_db(remove_worker, self.worker_id)
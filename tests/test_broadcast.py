@@ -0,0 +1,158 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import broadcast
+from broadcast import LAST_TICK_KEY, BroadcastScheduler
+
+
+class FakeApplication:
+    bot = None
+
+    def __init__(self):
+        self.coroutines = []
+
+    def create_task(self, coroutine):
+        self.coroutines.append(coroutine)
+        coroutine.close()
+        return coroutine
+
+
+def caught_up_starts(monkeypatch, last_tick, grace_minutes=60):
+    scheduler = BroadcastScheduler(None, None, ledger=object())
+    if last_tick is not None:
+        scheduler.state[LAST_TICK_KEY] = last_tick.isoformat()
+    starts = []
+
+    def fake_catch_up(bot, window, pacer):
+        starts.extend(window)
+        return asyncio.sleep(0)
+
+    monkeypatch.setattr(scheduler, '_catch_up', fake_catch_up)
+    task = scheduler.catch_up(FakeApplication(), grace_minutes=grace_minutes)
+    return scheduler, task, starts
+
+
+def now_minute():
+    return datetime.now(timezone.utc).replace(second=0, microsecond=0)
+
+
+def test_catch_up_starts_after_the_last_tick(monkeypatch):
+    last_tick = now_minute() - timedelta(minutes=3)
+    scheduler, task, starts = caught_up_starts(monkeypatch, last_tick)
+
+    assert task is not None
+    assert starts[0] == last_tick + timedelta(minutes=1)
+    assert all(later - earlier == timedelta(minutes=1) for earlier, later in zip(starts, starts[1:]))
+    assert scheduler.state[LAST_TICK_KEY] == starts[-1].isoformat()
+
+
+def test_catch_up_is_clamped_to_the_grace_window(monkeypatch):
+    _, _, starts = caught_up_starts(monkeypatch, now_minute() - timedelta(days=1), grace_minutes=10)
+
+    assert len(starts) == 11
+    assert starts[-1] - starts[0] == timedelta(minutes=10)
+
+
+def test_catch_up_is_skipped_without_a_previous_tick(monkeypatch):
+    scheduler, task, starts = caught_up_starts(monkeypatch, None)
+
+    assert task is None
+    assert starts == []
+    assert LAST_TICK_KEY in scheduler.state
+
+
+class FakeBot:
+    """Records sent chunks; ``errors`` maps (chat_id, chunk number) to errors raised in order"""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        chunk = int(text.split()[-1])
+        errors = self.errors.get((chat_id, chunk))
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((chat_id, chunk))
+
+
+class FakeLedger:
+    def __init__(self, delivered=()):
+        self.already = set(delivered)
+        self.recorded = []
+
+    async def delivered(self, day, user_ids):
+        return self.already.intersection(user_ids)
+
+    def record(self, day, user_id):
+        self.recorded.append((day, user_id))
+        return False
+
+
+def never_sent():
+    try:
+        try:
+            raise httpx.ConnectError('refused')
+        except httpx.HTTPError as err:
+            raise NetworkError(str(err)) from err
+    except NetworkError as error:
+        return error
+
+
+def run_bucket(monkeypatch, bot, recipients, ledger=None, chunks=1):
+    disabled = []
+
+    async def pick_hadith():
+        return {'id': 1}
+
+    async def run_db(func, *args):
+        return func(*args)
+
+    monkeypatch.setattr(broadcast, 'run_db', run_db)
+    monkeypatch.setattr(broadcast, 'disable_daily_hadith_subscriptions', disabled.extend)
+    monkeypatch.setattr(broadcast, 'BROADCAST_RETRY_DELAY', 0)
+    render = lambda hadith: ([f"chunk {n}" for n in range(chunks)], None)
+    scheduler = BroadcastScheduler(pick_hadith, render, candidates=1, ledger=ledger)
+    for user_id in recipients:
+        scheduler.add(user_id, user_id, 0)
+    report = asyncio.run(scheduler.run_bucket(bot, 0, dict(recipients), datetime.now(timezone.utc)))
+    return scheduler, report, disabled
+
+
+def test_blocked_and_missing_chats_are_pruned(monkeypatch):
+    bot = FakeBot({
+        (1, 0): [Forbidden('Forbidden: bot was blocked by the user')],
+        (2, 0): [BadRequest('Chat not found')],
+        (3, 0): [BadRequest('Message is too long')],
+    })
+    scheduler, report, disabled = run_bucket(monkeypatch, bot, {1: 1, 2: 2, 3: 3, 4: 4})
+
+    assert sorted(disabled) == [1, 2]
+    assert scheduler.pruned == {'blocked': 1, 'chat_not_found': 1}
+    assert 1 not in scheduler._user_minutes and 3 in scheduler._user_minutes
+    assert (report['sent'], report['failed'], report['pruned']) == (1, 1, 2)
+
+
+def test_transient_errors_are_retried_on_the_first_chunk_only(monkeypatch):
+    bot = FakeBot({
+        (1, 0): [RetryAfter(1), never_sent()],
+        (2, 1): [never_sent()],
+    })
+    _, report, _ = run_bucket(monkeypatch, bot, {1: 1, 2: 2}, chunks=2)
+
+    assert bot.sent.count((1, 0)) == 1 and bot.sent.count((1, 1)) == 1
+    assert bot.sent.count((2, 0)) == 1 and (2, 1) not in bot.sent
+    assert (report['sent'], report['failed']) == (1, 1)
+
+
+def test_deliveries_are_recorded_and_delivered_users_skipped(monkeypatch):
+    ledger = FakeLedger(delivered=[2])
+    bot = FakeBot({(3, 0): [Forbidden('blocked')]})
+    _, report, _ = run_bucket(monkeypatch, bot, {1: 1, 2: 2, 3: 3}, ledger=ledger)
+
+    assert [chat_id for chat_id, _ in bot.sent] == [1]
+    assert [user_id for _, user_id in ledger.recorded] == [1]
+    assert report['recipients'] == 2
@@ -0,0 +1,104 @@
+import asyncio
+
+import hadith_api
+from corpus import HadithCorpus
+
+
+def hadith(number, book='sahih-bukhari'):
+    return {'hadithNumber': str(number), 'bookSlug': book}
+
+
+def fake_pages(monkeypatch, fetch_rate):
+    cached = HadithCorpus()
+    fetched = []
+
+    async def fetch_page(book, page=1, cached=True):
+        fetched.append(page)
+        return [hadith(page, book)]
+
+    monkeypatch.setattr(hadith_api, 'corpus', cached)
+    monkeypatch.setattr(hadith_api, 'fetch_page', fetch_page)
+    monkeypatch.setattr(hadith_api, 'HADITH_SAMPLE_FETCH_RATE', fetch_rate)
+    monkeypatch.setattr(hadith_api.corpus_file, 'count', lambda book: 0)
+    return cached, fetched
+
+
+def test_draws_come_from_the_corpus_once_it_holds_the_book(monkeypatch):
+    cached, fetched = fake_pages(monkeypatch, fetch_rate=0)
+    cached.add(hadith(7))
+
+    drawn = asyncio.run(hadith_api._draw('sahih-bukhari', 41))
+
+    assert drawn == hadith(7)
+    assert fetched == []
+
+
+def test_corpus_miss_fetches_the_page_at_the_drawn_index(monkeypatch):
+    cached, fetched = fake_pages(monkeypatch, fetch_rate=0)
+    cached.add(hadith(7))
+
+    drawn = asyncio.run(hadith_api._draw('sahih-bukhari', 41, exclude=lambda h: h['hadithNumber'] == '7'))
+
+    assert drawn == hadith(42)
+    assert fetched == [42]
+
+
+def test_fetch_rate_widens_coverage(monkeypatch):
+    cached, fetched = fake_pages(monkeypatch, fetch_rate=1)
+    cached.add(hadith(7))
+
+    asyncio.run(hadith_api._draw('sahih-bukhari', 41))
+
+    assert fetched == [42]
+
+
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(hadith_api.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_breaker_opens_after_consecutive_failures(monkeypatch):
+    clock(monkeypatch)
+    breaker = hadith_api.CircuitBreaker(failures=3, cooldown=30)
+
+    breaker.failure()
+    breaker.failure()
+    assert breaker.allow() and not breaker.is_open()
+    breaker.failure()
+
+    assert breaker.state == 'open'
+    assert breaker.is_open() and not breaker.allow()
+
+
+def test_breaker_lets_one_probe_through_after_the_cooldown(monkeypatch):
+    now = clock(monkeypatch)
+    breaker = hadith_api.CircuitBreaker(failures=1, cooldown=30)
+    breaker.failure()
+
+    now[0] += 30
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+
+    breaker.success()
+    assert breaker.state == 'closed' and breaker.failures == 0
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens_with_a_longer_cooldown(monkeypatch):
+    now = clock(monkeypatch)
+    breaker = hadith_api.CircuitBreaker(failures=1, cooldown=30, max_cooldown=45)
+    breaker.failure()
+
+    now[0] += 30
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == 'open' and breaker.cooldown == 45
+
+    now[0] += 44
+    assert not breaker.allow()
+    now[0] += 1
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.cooldown == 30
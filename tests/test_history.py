@@ -0,0 +1,46 @@
+import history
+from history import HistoryRecorder
+from metrics import DROPPED_WRITES
+
+
+def hadith(number):
+    return {'id': number, 'hadithNumber': number, 'book': {'bookName': 'Sahih Bukhari'}}
+
+
+def failing_save(rows):
+    raise RuntimeError('database is down')
+
+
+def test_record_asks_for_a_flush_once_the_batch_is_full():
+    recorder = HistoryRecorder(max_pending=2)
+
+    assert not recorder.record(1, hadith(1))
+    assert recorder.record(2, hadith(2))
+
+
+def test_failed_flush_drops_the_oldest_rows_beyond_the_cap(monkeypatch):
+    monkeypatch.setattr(history, 'save_hadith_history_batch', failing_save)
+    recorder = HistoryRecorder(max_pending=10, max_buffered=3)
+    dropped = DROPPED_WRITES._values.get(('hadith_history',), 0)
+
+    for number in range(5):
+        recorder.record(number, hadith(number))
+
+    assert recorder.flush() == 0
+    assert [row[0] for row in recorder._pending] == [2, 3, 4]
+    assert DROPPED_WRITES._values[('hadith_history',)] == dropped + 2
+
+
+def test_failed_flush_keeps_rows_for_the_next_attempt(monkeypatch):
+    monkeypatch.setattr(history, 'save_hadith_history_batch', failing_save)
+    recorder = HistoryRecorder(max_pending=10, max_buffered=10)
+    recorder.record(1, hadith(1))
+    recorder.flush()
+    recorder.record(2, hadith(2))
+
+    written = []
+    monkeypatch.setattr(history, 'save_hadith_history_batch', lambda rows: written.extend(rows) or len(rows))
+
+    assert recorder.flush() == 2
+    assert [row[0] for row in written] == [1, 2]
+    assert recorder.pending() == 0
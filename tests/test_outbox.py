@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from telegram.error import NetworkError, TimedOut
+
+import outbox
+from outbox import OutboxRateLimiter, PriorityTokenBucket, request_never_sent
+
+
+def wrapped(error_class, cause):
+    try:
+        try:
+            raise cause
+        except httpx.HTTPError as err:
+            raise error_class(str(err)) from err
+    except error_class as error:
+        return error
+
+
+def test_only_connection_failures_count_as_never_sent():
+    assert request_never_sent(wrapped(NetworkError, httpx.ConnectError('refused')))
+    assert request_never_sent(wrapped(TimedOut, httpx.PoolTimeout('pool')))
+    assert not request_never_sent(wrapped(NetworkError, httpx.RemoteProtocolError('closed')))
+    assert not request_never_sent(wrapped(TimedOut, httpx.ReadTimeout('read')))
+    assert not request_never_sent(NetworkError('Bad Gateway'))
+
+
+def send(limiter, errors, rate_limit_args=None):
+    calls = []
+
+    async def callback():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return True
+
+    async def main():
+        await limiter.initialize()
+        try:
+            return await limiter.process_request(callback, (), {}, 'sendMessage', {'chat_id': 1}, rate_limit_args)
+        finally:
+            await limiter.shutdown()
+
+    return asyncio.run(main()), len(calls)
+
+
+def test_unsent_requests_are_retried(monkeypatch):
+    monkeypatch.setattr(outbox.random, 'uniform', lambda low, high: 0)
+    limiter = OutboxRateLimiter(global_rate=100)
+    result, calls = send(limiter, [wrapped(NetworkError, httpx.ConnectError('refused'))])
+    assert result is True
+    assert calls == 2
+
+
+def test_requests_that_may_have_been_sent_are_not_retried():
+    limiter = OutboxRateLimiter(global_rate=100)
+    with pytest.raises(NetworkError):
+        send(limiter, [wrapped(NetworkError, httpx.RemoteProtocolError('closed'))])
+    assert limiter.stats['network_retries'] == 0
+
+
+def test_max_retries_can_be_overridden_per_request():
+    limiter = OutboxRateLimiter(global_rate=100)
+    with pytest.raises(NetworkError):
+        send(limiter, [wrapped(NetworkError, httpx.ConnectError('refused'))], {'max_retries': 0})
+    assert limiter.stats['gave_up'] == 1
+
+
+def test_pause_holds_back_a_waiting_token():
+    async def main():
+        bucket = PriorityTokenBucket(rate=5, capacity=1)
+        await bucket.acquire()
+        waiter = asyncio.create_task(bucket.acquire())
+        await asyncio.sleep(0.05)
+        bucket.pause(0.5)
+        started = time.monotonic()
+        await waiter
+        elapsed = time.monotonic() - started
+        await bucket.close()
+        return elapsed
+
+    assert asyncio.run(main()) >= 0.4
@@ -0,0 +1,99 @@
+import asyncio
+
+import persistence
+from persistence import PostgresPersistence
+
+
+def fake_database(monkeypatch, fail=False):
+    writes = []
+
+    async def run_db(func, *args):
+        return func(*args)
+
+    def save_persistence(upserts, deletes):
+        if fail:
+            raise RuntimeError('database is down')
+        writes.append((sorted(upserts), sorted(deletes)))
+
+    monkeypatch.setattr(persistence, 'run_db', run_db)
+    monkeypatch.setattr(persistence, 'save_persistence', save_persistence)
+    monkeypatch.setattr(persistence, 'load_persistence', lambda kind, days: [('1', {'lang': 'en'})] if kind == 'user' else [])
+    return writes
+
+
+def test_updates_in_one_run_are_written_in_one_batch(monkeypatch):
+    writes = fake_database(monkeypatch)
+
+    async def main():
+        store = PostgresPersistence()
+        await store.update_user_data(1, {'lang': 'ar'})
+        await store.update_user_data(2, {'lang': 'en'})
+        await store.update_conversation('daily', (2, 2), 1)
+        await store.flush()
+        return store
+
+    store = asyncio.run(main())
+    assert len(writes) == 1
+    upserts, deletes = writes[0]
+    assert [(kind, key) for kind, key, _ in upserts] == [('conversation:daily', '[2, 2]'), ('user', '1'), ('user', '2')]
+    assert deletes == []
+    assert store.stats['writes'] == 1
+
+
+def test_unchanged_and_never_stored_entries_are_skipped(monkeypatch):
+    writes = fake_database(monkeypatch)
+
+    async def main():
+        store = PostgresPersistence()
+        await store.get_user_data()
+        await store.update_user_data(1, {'lang': 'en'})
+        await store.drop_user_data(3)
+        await store.update_user_data(4, {})
+        await store.flush()
+
+    asyncio.run(main())
+    assert writes == []
+
+
+def test_transient_keys_are_never_stored(monkeypatch):
+    writes = fake_database(monkeypatch)
+
+    async def main():
+        store = PostgresPersistence()
+        await store.get_user_data()
+        await store.update_user_data(1, {'lang': 'en', 'search': {'results': [1, 2]}})
+        await store.update_user_data(2, {'search': {'results': [3]}})
+        await store.update_bot_data({'broadcast_last_tick': '2024-01-01T00:00:00+00:00'})
+        await store.flush()
+
+    asyncio.run(main())
+    assert writes == [([('bot', 'bot', '{"broadcast_last_tick":"2024-01-01T00:00:00+00:00"}')], [])]
+
+
+def test_emptied_entries_are_deleted(monkeypatch):
+    writes = fake_database(monkeypatch)
+
+    async def main():
+        store = PostgresPersistence()
+        await store.get_user_data()
+        await store.update_user_data(1, {'search': {'results': [1]}})
+        await store.flush()
+
+    asyncio.run(main())
+    assert writes == [([], [('user', '1')])]
+
+
+def test_failed_write_is_kept_for_the_next_run(monkeypatch):
+    fake_database(monkeypatch, fail=True)
+
+    async def main():
+        store = PostgresPersistence()
+        await store.update_user_data(1, {'lang': 'ar'})
+        await store.flush()
+        writes = fake_database(monkeypatch)
+        await store.flush()
+        return store, writes
+
+    store, writes = asyncio.run(main())
+    assert store.stats['failed_writes'] >= 1
+    assert writes == [([('user', '1', '{"lang":"ar"}')], [])]
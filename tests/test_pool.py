@@ -0,0 +1,65 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from database import ConnectionPool, PoolTimeout
+
+
+def connect():
+    return sqlite3.connect(':memory:', check_same_thread=False)
+
+
+def test_acquire_times_out_when_the_pool_is_exhausted():
+    pool = ConnectionPool(connect, min_size=0, max_size=1, timeout=0.05)
+    pool.acquire()
+
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_release_hands_the_connection_to_a_waiter():
+    pool = ConnectionPool(connect, min_size=0, max_size=1, timeout=2)
+    conn = pool.acquire()
+    releaser = threading.Timer(0.05, pool.release, args=(conn,))
+    releaser.start()
+
+    assert pool.acquire() is conn
+    releaser.join()
+    stats = pool.stats()
+    assert stats['connections_opened'] == 1
+    assert stats['in_use'] == 1
+
+
+def test_discarded_connection_frees_its_slot():
+    pool = ConnectionPool(connect, min_size=0, max_size=1, timeout=0.05)
+    conn = pool.acquire()
+    pool.release(conn, discard=True)
+
+    assert pool.acquire() is not conn
+    assert pool.stats()['connections_closed'] == 1
+
+
+def test_dead_idle_connection_is_replaced_after_the_health_check():
+    pool = ConnectionPool(connect, min_size=0, max_size=1, timeout=0.05, healthcheck_interval=0)
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.close()
+    time.sleep(0.01)
+
+    replacement = pool.acquire()
+    assert replacement is not conn
+    replacement.execute('SELECT 1')
+    assert pool.stats()['healthcheck_failures'] == 1
+
+
+def test_healthy_idle_connection_is_reused():
+    pool = ConnectionPool(connect, min_size=1, max_size=2, timeout=0.05, healthcheck_interval=0)
+    pool.open()
+    conn = pool.acquire()
+    pool.release(conn)
+
+    assert pool.acquire() is conn
+    assert pool.stats()['healthcheck_failures'] == 0
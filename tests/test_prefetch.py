@@ -0,0 +1,32 @@
+import collections
+import random
+
+import prefetch
+from prefetch import HadithPrefetchPool
+
+
+def test_take_weights_books_by_hadith_count(monkeypatch):
+    totals = {'large': 9000, 'small': 1000}
+    monkeypatch.setattr(prefetch.sampler, 'total', totals.get)
+    random.seed(7)
+    pool = HadithPrefetchPool(books=list(totals))
+    taken = collections.Counter()
+
+    for _ in range(5000):
+        for book in totals:
+            pool._queues[book].append({'book': book})
+        taken[pool.take()['book']] += 1
+        for book in totals:
+            pool._queues[book].clear()
+
+    assert 0.87 < taken['large'] / 5000 < 0.93
+
+
+def test_take_skips_excluded_hadiths(monkeypatch):
+    monkeypatch.setattr(prefetch.sampler, 'total', lambda book: None)
+    pool = HadithPrefetchPool(books=['a', 'b'])
+    pool._queues['a'].append({'book': 'a'})
+    pool._queues['b'].append({'book': 'b'})
+
+    assert pool.take(exclude=lambda hadith: hadith['book'] == 'a') == {'book': 'b'}
+    assert pool.size('a') == 1
@@ -0,0 +1,145 @@
+import asyncio
+import threading
+from datetime import date
+
+import pytest
+
+import sharding
+from sharding import ShardCoordinator, assign_shards
+
+DAY = date(2024, 1, 1)
+
+
+class FakeDatabase:
+    """In-memory stand-in for bot_workers and broadcast_claims shared by several workers"""
+
+    def __init__(self):
+        self.workers = set()
+        self.claims = {}
+        self.done = set()
+        self.lock = threading.Lock()
+
+    def record_worker_heartbeat(self, worker_id, ttl):
+        with self.lock:
+            self.workers.add(worker_id)
+            return sorted(self.workers)
+
+    def claim_broadcast_shards(self, worker_id, claims):
+        won = []
+        with self.lock:
+            for claim in claims:
+                if claim not in self.claims:
+                    self.claims[claim] = worker_id
+                    won.append(claim)
+        return won
+
+    def reclaim_broadcast_shards(self, worker_id, shards, since):
+        won = []
+        with self.lock:
+            for claim, owner in self.claims.items():
+                if claim not in self.done and claim[2] in shards and (owner is None or owner not in self.workers):
+                    self.claims[claim] = worker_id
+                    won.append(claim)
+        return won
+
+    def finish_broadcast_shards(self, worker_id, claims, done):
+        with self.lock:
+            for claim in claims:
+                if self.claims.get(claim) == worker_id:
+                    if done:
+                        self.done.add(claim)
+                    else:
+                        self.claims[claim] = None
+
+
+@pytest.fixture
+def database(monkeypatch):
+    fake = FakeDatabase()
+    monkeypatch.setattr(sharding, 'record_worker_heartbeat', fake.record_worker_heartbeat)
+    monkeypatch.setattr(sharding, 'claim_broadcast_shards', fake.claim_broadcast_shards)
+    monkeypatch.setattr(sharding, 'reclaim_broadcast_shards', fake.reclaim_broadcast_shards)
+    monkeypatch.setattr(sharding, 'finish_broadcast_shards', fake.finish_broadcast_shards)
+    monkeypatch.setattr(sharding, 'prune_broadcast_claims', lambda: 0)
+    return fake
+
+
+def test_assign_shards_covers_every_shard_once():
+    owners = assign_shards(['a', 'b', 'c'], shard_count=64)
+    shards = [shard for owned in owners.values() for shard in owned]
+    assert sorted(shards) == list(range(64))
+    assert all(owned for owned in owners.values())
+    assert owners == assign_shards(['c', 'a', 'b'], shard_count=64)
+
+
+def test_worker_leaving_only_moves_its_shards():
+    before = assign_shards(['a', 'b', 'c'], shard_count=64)
+    after = assign_shards(['a', 'b'], shard_count=64)
+    assert after['a'] >= before['a']
+    assert after['b'] >= before['b']
+    assert after['a'] | after['b'] == set(range(64))
+
+
+def claimed_shards(database, minute):
+    return sorted(shard for (_, claimed_minute, shard) in database.claims if claimed_minute == minute)
+
+
+def test_each_delivery_is_claimed_once_and_dead_workers_shards_are_caught_up(database):
+    workers = [ShardCoordinator(worker_id, shard_count=16) for worker_id in ('a', 'b', 'c')]
+
+    async def main():
+        for _ in range(2):
+            for worker in workers:
+                worker.heartbeat()
+        for worker in workers:
+            await worker.claim([(DAY, 1)])
+
+        # c dies before claiming minute 2; a and b still think it is alive.
+        database.workers.discard('c')
+        for worker in workers[:2]:
+            await worker.claim([(DAY, 2)])
+            worker.heartbeat()
+        for worker in workers[:2]:
+            await worker.claim([(DAY, 3)], catchup=[(DAY, 2)])
+
+    asyncio.run(main())
+    assert claimed_shards(database, 1) == list(range(16))
+    assert claimed_shards(database, 2) == list(range(16))
+    assert claimed_shards(database, 3) == list(range(16))
+    assert {worker for (_, minute, _), worker in database.claims.items() if minute == 3} == {'a', 'b'}
+
+
+def test_shards_adopted_between_claims_are_kept(database):
+    survivor = ShardCoordinator('a', shard_count=16)
+    database.workers.add('b')
+    survivor.heartbeat()
+    survivor.heartbeat()
+    owned_with_b = set(survivor.owned)
+
+    database.workers.discard('b')
+    survivor.heartbeat()
+    adopted = set(range(16)) - owned_with_b
+
+    won = asyncio.run(survivor.claim([(DAY, 5)], catchup=[(DAY, 4)]))
+    assert {shard for _, minute, shard in won if minute == 4} == adopted
+    assert survivor.adopted == set()
+
+
+def test_unfinished_claims_are_taken_over(database):
+    a = ShardCoordinator('a', shard_count=4)
+    b = ShardCoordinator('b', shard_count=4)
+
+    async def main():
+        a.heartbeat()
+        won = await a.claim([(DAY, 1), (DAY, 2)])
+        await a.finish([claim for claim in won if claim[1] == 1])
+        await a.finish([(DAY, 2, 0)], done=False)
+
+        # a crashes with minute 2 unfinished; b becomes the only worker.
+        database.workers.discard('a')
+        b.heartbeat()
+        return await b.claim([], since=None), await b.claim([], since='2024-01-01')
+
+    without_since, taken = asyncio.run(main())
+    assert without_since == []
+    assert sorted(taken) == [(DAY, 2, shard) for shard in range(4)]
+    assert all(database.claims[(DAY, 1, shard)] == 'a' for shard in range(4))
@@ -0,0 +1,39 @@
+from datetime import datetime, timezone
+
+from timezones import get_zone, offset_minutes, parse_timezone, utc_minute_of_day
+
+APRIL = datetime(2024, 4, 15, tzinfo=timezone.utc)
+OCTOBER = datetime(2024, 10, 15, tzinfo=timezone.utc)
+
+
+def test_names_resolve_case_insensitively():
+    assert parse_timezone('europe/london') == 'Europe/London'
+    assert parse_timezone('New York') is None
+    assert parse_timezone('America/New York') == 'America/New_York'
+
+
+def test_whole_hour_offsets_map_to_etc_zones():
+    assert parse_timezone('+3') == 'Etc/GMT-3'
+    assert parse_timezone('UTC-5') == 'Etc/GMT+5'
+    assert parse_timezone('+0') == 'Etc/GMT'
+
+
+def test_fractional_offsets_are_fixed_and_never_drift():
+    assert parse_timezone('UTC+05:30') == 'UTC+05:30'
+    assert parse_timezone('+10:30') == 'UTC+10:30'
+    assert parse_timezone('-03:30') == 'UTC-03:30'
+    for now in (APRIL, OCTOBER):
+        assert offset_minutes('UTC+10:30', now) == 630
+        assert offset_minutes('UTC-03:30', now) == -210
+
+
+def test_out_of_range_offsets_are_rejected():
+    assert parse_timezone('+15') is None
+    assert parse_timezone('-13') is None
+    assert parse_timezone('+05:75') is None
+
+
+def test_fixed_offset_delivery_minute():
+    zone = get_zone('UTC+05:30')
+    assert utc_minute_of_day(8, 0, zone) == 2 * 60 + 30
+    assert utc_minute_of_day(2, 0, get_zone('UTC-03:30'), on_date=OCTOBER.date()) == 5 * 60 + 30
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+from telegram import Update
+
+from updates import OrderedUpdateProcessor
+
+
+def make_update(update_id, user_id):
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+            'text': 'hi',
+        },
+    }, None)
+
+
+def test_one_user_cannot_starve_another():
+    async def main():
+        processor = OrderedUpdateProcessor(max_concurrent_updates=4)
+        finished = {}
+        started = time.monotonic()
+
+        async def handle(name, delay):
+            await asyncio.sleep(delay)
+            finished[name] = time.monotonic() - started
+
+        burst = [
+            asyncio.create_task(processor.process_update(make_update(n, 1), handle(f"slow{n}", 0.2)))
+            for n in range(6)
+        ]
+        await asyncio.sleep(0.01)
+        await processor.process_update(make_update(100, 2), handle('other', 0))
+        await asyncio.gather(*burst)
+        return finished
+
+    finished = asyncio.run(main())
+    assert finished['other'] < 0.1
+    assert [name for name, _ in sorted(finished.items(), key=lambda item: item[1]) if name != 'other'] == [
+        f"slow{n}" for n in range(6)
+    ]
+
+
+def test_updates_from_one_user_run_in_order():
+    async def main():
+        processor = OrderedUpdateProcessor(max_concurrent_updates=4)
+        order = []
+
+        async def handle(n):
+            await asyncio.sleep(0.01 * (5 - n))
+            order.append(n)
+
+        await asyncio.gather(*(processor.process_update(make_update(n, 1), handle(n)) for n in range(5)))
+        return order, processor._locks
+
+    order, locks = asyncio.run(main())
+    assert order == [0, 1, 2, 3, 4]
+    assert locks == {}
@@ -0,0 +1,154 @@
+import logging
+import os
+import re
+import threading
+import time as monotonic_time
+from datetime import datetime, time, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEZONE = 'Europe/Rome'
+TIMEZONE_CHECK_INTERVAL = float(os.getenv('TIMEZONE_CHECK_INTERVAL', 60))
+TIMEZONE_REFRESH_INTERVAL = float(os.getenv('TIMEZONE_REFRESH_INTERVAL', 60 * 60))
+
+_OFFSET_PATTERN = re.compile(r'^(?:utc|gmt)?\s*([+-])\s*(\d{1,2})(?::?(\d{2}))?$', re.IGNORECASE)
+# Names stored for fixed offsets that are not whole hours, e.g. UTC+05:30.
+_FIXED_OFFSET_NAME = re.compile(r'^UTC([+-])(\d{2}):(\d{2})$')
+_finder = None
+_finder_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _zone_names():
+    # Lower-cased name -> canonical IANA name, for case-insensitive input.
+    return {name.lower(): name for name in available_timezones()}
+
+
+@lru_cache(maxsize=1024)
+def _load_zone(name):
+    match = _FIXED_OFFSET_NAME.match(name)
+    if match:
+        sign, hours, minutes = match.groups()
+        total = int(hours) * 60 + int(minutes)
+        return timezone(timedelta(minutes=-total if sign == '-' else total), name)
+    return ZoneInfo(name)
+
+
+def get_zone(name):
+    """Return the shared ZoneInfo for an IANA name, falling back to the default zone"""
+    try:
+        return _load_zone(name or DEFAULT_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning(f"Unknown timezone {name!r}, using {DEFAULT_TIMEZONE}")
+        return _load_zone(DEFAULT_TIMEZONE)
+
+
+def offset_minutes(name, now=None):
+    """Return a zone's current UTC offset in minutes"""
+    now = now or datetime.now(timezone.utc)
+    return int(now.astimezone(get_zone(name)).utcoffset().total_seconds() // 60)
+
+
+def utc_minute_of_day(hour, minute, zone, on_date=None):
+    """Convert a local HH:MM in ``zone`` to a UTC minute-of-day (0-1439)"""
+    if on_date is None:
+        on_date = datetime.now(zone).date()
+    utc = datetime.combine(on_date, time(hour=hour, minute=minute), tzinfo=zone).astimezone(timezone.utc)
+    return utc.hour * 60 + utc.minute
+
+
+def zone_for_offset(minutes):
+    """Return the name of a fixed zone ``minutes`` ahead of UTC, which never changes for DST.
+
+    Whole hours map to the ``Etc/GMT`` zones (whose sign is inverted by
+    POSIX convention); other offsets to a name like ``UTC+05:30``.
+    """
+    if minutes % 60 == 0:
+        hours = -minutes // 60
+        return 'Etc/GMT' if hours == 0 else f"Etc/GMT{hours:+d}"
+    sign = '-' if minutes < 0 else '+'
+    return f"UTC{sign}{abs(minutes) // 60:02d}:{abs(minutes) % 60:02d}"
+
+
+def parse_timezone(text):
+    """Resolve user input (an IANA name or a UTC offset like +3 or UTC+05:30) to a zone name, or None"""
+    text = text.strip()
+    name = _zone_names().get(text.lower().replace(' ', '_'))
+    if name:
+        return name
+
+    match = _OFFSET_PATTERN.match(text)
+    if not match:
+        return None
+    sign, hours, minutes = match.groups()
+    total = int(hours) * 60 + int(minutes or 0)
+    if int(minutes or 0) >= 60 or total > (12 if sign == '-' else 14) * 60:
+        return None
+    return zone_for_offset(-total if sign == '-' else total)
+
+
+def zone_at(latitude, longitude):
+    """Return the zone name at a location, or None if it has none.
+
+    The first call loads the polygon data, so call it off the event loop.
+    """
+    global _finder
+    with _finder_lock:
+        if _finder is None:
+            # Imported here so only the location lookup needs timezonefinder.
+            from timezonefinder import TimezoneFinder
+            _finder = TimezoneFinder(in_memory=True)
+    return _finder.timezone_at(lat=latitude, lng=longitude)
+
+
+class OffsetWatcher:
+    """Notices when zones' UTC offsets change, e.g. at a DST transition.
+
+    ``changed`` returns the zones whose offset differs from the previous
+    check, so every subscriber in such a zone can be moved to a new UTC
+    delivery minute in one batch. A zone seen for the first time counts as
+    changed, which also corrects transitions that happened while the bot
+    was down. The list of zones in use is re-read every
+    ``refresh_interval`` seconds; zones set in between are added with
+    ``watch``.
+    """
+
+    def __init__(self, refresh_interval=TIMEZONE_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._offsets = {}
+        self._refreshed_at = None
+
+    def needs_refresh(self):
+        """Return True when the zone list should be re-read"""
+        return self._refreshed_at is None or monotonic_time.monotonic() - self._refreshed_at >= self.refresh_interval
+
+    def changed(self, zones=None, now=None):
+        """Return {zone: offset_minutes} for zones that are new or whose offset changed.
+
+        ``zones`` is the list of zones in use, freshly read from the
+        database; without it only the zones already watched are checked.
+        """
+        now = now or datetime.now(timezone.utc)
+        if zones is None:
+            zones = list(self._offsets)
+        else:
+            self._refreshed_at = monotonic_time.monotonic()
+        changed = {}
+        for zone in zones:
+            offset = offset_minutes(zone, now)
+            if self._offsets.get(zone) != offset:
+                self._offsets[zone] = offset
+                changed[zone] = offset
+        return changed
+
+    def watch(self, zone):
+        """Start watching a zone whose subscribers already have current delivery minutes"""
+        if zone not in self._offsets:
+            self._offsets[zone] = offset_minutes(zone)
+
+    def forget(self, zones):
+        """Drop zones so the next check reports them again (e.g. after a failed update)"""
+        for zone in zones:
+            self._offsets.pop(zone, None)
@@ -0,0 +1,150 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import signal
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 16))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+
+# Only the update types the bot has handlers for.
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+
+def update_owner(update):
+    """Return the id whose updates must be handled in order (user, else chat)"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """Handles up to ``max_concurrent_updates`` updates at once, one at a time per user.
+
+    Updates from different users run concurrently. Updates from the same
+    user wait for each other in arrival order, so multi-step flows such as
+    entering the daily hadith time never see their messages reordered.
+    The per-user lock is taken before a concurrency slot, so a user's
+    queued updates never hold slots that other users could run in.
+    """
+
+    def __init__(self, max_concurrent_updates=UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}
+
+    async def process_update(self, update, coroutine):
+        owner = update_owner(update)
+        if owner is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+
+        entry = self._locks.get(owner)
+        if entry is None:
+            entry = self._locks[owner] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[owner]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def webhook_handler(application, secret=WEBHOOK_SECRET):
+    """Return a health server route that feeds webhook updates into the application"""
+    async def handle(request):
+        if secret:
+            token = request.headers.get('x-telegram-bot-api-secret-token', '')
+            if not hmac.compare_digest(token, secret):
+                return 403, 'text/plain', b'Forbidden'
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except Exception as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return 400, 'text/plain', b'Bad request'
+
+        await application.update_queue.put(update)
+        return 200, 'text/plain', b'OK'
+    return handle
+
+
+async def _serve(application, before_start=None):
+    # Application.run_polling's lifecycle without the updater.
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if before_start is not None:
+            await before_start()
+        await application.start()
+
+        await stopped.wait()
+
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_webhook(application, server):
+    """Serve Telegram webhooks on the health server's port until SIGINT/SIGTERM.
+
+    Mirrors ``Application.run_polling``'s lifecycle (post_init, post_stop,
+    post_shutdown) but receives updates through ``server`` instead of PTB's
+    own webhook server, so health checks and webhooks share one port.
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("UPDATE_MODE=webhook requires WEBHOOK_URL")
+    url = WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH
+
+    async def register_webhook():
+        server.add_route('POST', WEBHOOK_PATH, webhook_handler(application))
+        await server.start()
+        await application.bot.set_webhook(
+            url,
+            allowed_updates=ALLOWED_UPDATES,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info(f"Receiving updates through webhook {url}")
+
+    asyncio.run(_serve(application, register_webhook))
+
+
+def run_without_updates(application):
+    """Run jobs and outgoing messages only, without receiving updates, until SIGINT/SIGTERM"""
+    asyncio.run(_serve(application))